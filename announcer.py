@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import itertools
+import logging
+
+import discord
+
+logger = logging.getLogger(__name__)
+
+
+class TrackCoalescer:
+    """Collects title/artist/album changes into one announcement per track
+
+    shairport-sync sends each field as its own metadata item. A change opens a short
+    window; the track is announced when the window closes or when the `mden`
+    end-of-metadata marker arrives, whichever is first. With `art_grace` the
+    announcement waits up to that much longer after `mden` for the cover art, which
+    shairport-sync sends after the text fields.
+    """
+
+    def __init__(self, on_track, window=1.5, art_grace=None):
+        self.on_track = on_track
+        self.window = window
+        self.art_grace = art_grace
+        self._dirty = False
+        self._timer = None
+
+    def changed(self):
+        """A track field changed; (re)start the window"""
+        self._dirty = True
+        self._arm(self.window)
+
+    def end_of_metadata(self):
+        if self._dirty and self.art_grace:
+            self._arm(self.art_grace)
+        else:
+            self.flush()
+
+    def art_ready(self):
+        """Cover art for the current track is available (or known to be missing)"""
+        self.flush()
+
+    def _arm(self, delay):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self.flush)
+
+    def flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._dirty:
+            self._dirty = False
+            self.on_track()
+
+
+class ChannelAnnouncer:
+    """Outbound message queue for one text channel
+
+    A single sender task drains the queue in order. Messages submitted with a
+    `replace_key` overwrite any still-pending message with the same key, so a
+    now-playing embed replaced by a newer track is dropped instead of sent late.
+    Rate limits are honoured by waiting out Discord's Retry-After before sending again.
+
+    `prepare` returns extra send() kwargs right before each attempt (discord.File
+    objects can't be reused), and `on_sent` gets the resulting Message.
+    """
+
+    def __init__(self, channel, min_interval=0.5):
+        self.channel = channel
+        self.min_interval = min_interval
+        self.sent = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self._pending = collections.OrderedDict()
+        self._keys = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def depth(self):
+        return len(self._pending)
+
+    def submit(self, replace_key=None, prepare=None, on_sent=None, **send_kwargs):
+        key = replace_key if replace_key is not None else next(self._keys)
+        if key in self._pending:
+            # A newer message supersedes the one still waiting
+            self.dropped += 1
+            del self._pending[key]
+        self._pending[key] = (send_kwargs, prepare, on_sent)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.dropped += len(self._pending)
+        self._pending.clear()
+
+    async def _run(self):
+        try:
+            while True:
+                if not self._pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                key, entry = next(iter(self._pending.items()))
+                send_kwargs, prepare, on_sent = entry
+                try:
+                    if prepare:
+                        send_kwargs = dict(send_kwargs, **prepare())
+                    message = await self.channel.send(**send_kwargs)
+                    self.sent += 1
+                    if on_sent:
+                        on_sent(message)
+                except discord.RateLimited as e:
+                    # Raised instead of sleeping when the wait exceeds max_ratelimit_timeout
+                    self.rate_limited += 1
+                    await asyncio.sleep(e.retry_after)
+                    continue  # The pending entry may have been replaced meanwhile
+                except discord.HTTPException as e:
+                    if e.status == 429:
+                        self.rate_limited += 1
+                        retry_after = float(e.response.headers.get('Retry-After', 1))
+                        await asyncio.sleep(retry_after)
+                        continue
+                    logger.error(f"Failed to send message to channel {self.channel.id}: {e}")
+                except Exception as e:
+                    logger.error(f"Failed to send message to channel {getattr(self.channel, 'id', '?')}: {e}")
+
+                # Sent (or failed permanently): drop it unless it was replaced while sending
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                await asyncio.sleep(self.min_interval)
+        except asyncio.CancelledError:
+            pass
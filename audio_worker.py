@@ -0,0 +1,496 @@
+"""Audio engine in a separate process: pipe -> jitter buffer -> resample -> Opus, outside the bot's GIL.
+
+The worker process runs the native engine's FIFOReader, PCMRingBuffer and PCMOpusAudio
+on its own 20 ms clock and writes each packet into a shared-memory ring. WorkerAudio is
+the bot-side audio source that reads packets back out of the ring for the broadcaster.
+Gateway traffic, commands and metadata parsing in the bot process then can't delay
+encoding. The ring outlives the worker, so the worker can be restarted on its own while
+the voice clients keep playing (silence, until the new worker's first packet).
+"""
+import argparse
+import json
+import logging
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import discord
+from discord import opus
+from discord.player import OPUS_SILENCE
+
+from drift import DriftEstimator
+from latency import LatencyTracker
+from logging_config import TEXT_FORMAT
+from metrics import ENCODE_SECONDS, PCM_BYTES_READ
+from pcm_audio import PCMOpusAudio, SilenceDetector, VolumeControl, INPUT_BYTES_PER_SECOND
+from ring_buffer import FIFOReader, PCMRingBuffer, pin_current_thread
+
+logger = logging.getLogger(__name__)
+
+FRAME_DELAY = opus.Encoder.FRAME_LENGTH / 1000.0
+
+# write_seq, bytes_written, fill, underruns, overruns, frames, heartbeat, idle, reader_open
+HEADER = struct.Struct('<QQQQQQdBB')
+HEADER_SIZE = 128
+# Written by the bot, read by the worker every frame: target bitrate in kbps (0 = unchanged)
+CONTROL = struct.Struct('<I')
+CONTROL_OFFSET = 60
+# Also written by the bot: the AirPlay volume, -30..0 or -144 for mute (0 = full volume)
+VOLUME = struct.Struct('<f')
+VOLUME_OFFSET = 64
+# Written by the worker: measured clock drift and the correction applied, in ppm
+DRIFT = struct.Struct('<dd')
+DRIFT_OFFSET = 72
+# seq + 1 (0 = being written), origin (0 = none), encode seconds, length, flags
+SLOT_HEADER = struct.Struct('<QddHH')
+SLOT_SIZE = 1536  # An Opus packet is at most 1275 bytes
+SLOTS = 64
+SILENCE_FLAG = 1
+# For its first second after (re)starting the worker drops PCM beyond the jitter buffer target
+CATCH_UP_FRAMES = 50
+
+
+class SharedPacketRing:
+    """Single-producer ring of Opus packets in shared memory
+
+    Each slot carries its sequence number, written last, so a reader can tell a
+    complete packet from one that is being overwritten. Readers keep their own
+    position; a reader that falls more than SLOTS behind loses the oldest packets.
+    """
+
+    def __init__(self, name=None, slots=SLOTS):
+        self.slots = slots
+        size = HEADER_SIZE + slots * SLOT_SIZE
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creator unlinks the segment; otherwise the worker's resource
+            # tracker would remove it from under the bot when the worker exits
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+
+    def header(self):
+        return HEADER.unpack_from(self.buf, 0)
+
+    @property
+    def write_seq(self):
+        return struct.unpack_from('<Q', self.buf, 0)[0]
+
+    def write(self, packet, origin=None, encode_seconds=0.0, stats=None):
+        """Publish one packet; `stats` updates the header counters in the same step"""
+        seq = self.write_seq
+        offset = HEADER_SIZE + (seq % self.slots) * SLOT_SIZE
+        silence = packet is OPUS_SILENCE
+        length = 0 if silence else len(packet)
+        struct.pack_into('<Q', self.buf, offset, 0)
+        if length:
+            start = offset + SLOT_HEADER.size
+            self.buf[start:start + length] = packet
+        SLOT_HEADER.pack_into(self.buf, offset, seq + 1, origin or 0.0, encode_seconds, length,
+                              SILENCE_FLAG if silence else 0)
+        if stats is not None:
+            HEADER.pack_into(self.buf, 0, seq, *stats)
+        struct.pack_into('<Q', self.buf, 0, seq + 1)
+
+    def read(self, seq):
+        """Packet `seq` as (packet, origin, encode_seconds), or None if it was overwritten"""
+        offset = HEADER_SIZE + (seq % self.slots) * SLOT_SIZE
+        slot_seq, origin, encode_seconds, length, flags = SLOT_HEADER.unpack_from(self.buf, offset)
+        if slot_seq != seq + 1:
+            return None
+        if flags & SILENCE_FLAG:
+            packet = OPUS_SILENCE
+        else:
+            start = offset + SLOT_HEADER.size
+            packet = bytes(self.buf[start:start + length])
+        # The writer may have reused the slot while we copied it
+        if struct.unpack_from('<Q', self.buf, offset)[0] != seq + 1:
+            return None
+        return packet, origin or None, encode_seconds
+
+    def get_bitrate(self):
+        return CONTROL.unpack_from(self.buf, CONTROL_OFFSET)[0]
+
+    def set_bitrate(self, kbps):
+        CONTROL.pack_into(self.buf, CONTROL_OFFSET, kbps)
+
+    def get_volume(self):
+        return VOLUME.unpack_from(self.buf, VOLUME_OFFSET)[0]
+
+    def set_volume(self, airplay_volume):
+        VOLUME.pack_into(self.buf, VOLUME_OFFSET, airplay_volume)
+
+    def get_drift(self):
+        return DRIFT.unpack_from(self.buf, DRIFT_OFFSET)
+
+    def set_drift(self, drift_ppm, correction_ppm):
+        DRIFT.pack_into(self.buf, DRIFT_OFFSET, drift_ppm, correction_ppm)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class WorkerRingView:
+    """The worker's jitter buffer counters, read from the ring header
+
+    Has the PCMRingBuffer attributes the bot reports, so !debug, !latency and the
+    metrics don't care which process holds the buffer.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def _field(self, index):
+        ring = self.worker.packets
+        return ring.header()[index] if ring is not None else 0
+
+    @property
+    def bytes_written(self):
+        return self._field(1)
+
+    @property
+    def underruns(self):
+        return self._field(3)
+
+    @property
+    def overruns(self):
+        return self._field(4)
+
+    def fill(self):
+        return self._field(2)
+
+    def fill_ms(self, bytes_per_second):
+        return self.fill() * 1000 / bytes_per_second
+
+    def reset(self):
+        # The buffer lives in the worker and goes away with it
+        pass
+
+
+class AudioWorker:
+    """Runs the audio engine in a child process and restarts it without touching the ring
+
+    The child is a fresh interpreter running this file, not a multiprocessing spawn,
+    so it doesn't re-import main.py and its Discord and logging setup. It rings a
+    doorbell pipe after every packet; the bot side waits on that pipe instead of polling.
+
+    cpus: cores the worker process is pinned to; name: suffix for the process name
+    """
+
+    def __init__(self, pipe_path, bitrate=128, application=None, capacity=None, frame_bytes=None,
+                 target_depth=None, silence_threshold=None, idle_after_frames=None,
+                 volume_range_db=None, drift_max_ppm=None, cpus=None, name=None, log_level='INFO'):
+        self.options = {
+            'pipe_path': pipe_path,
+            'bitrate': bitrate,
+            'application': application,
+            'capacity': capacity,
+            'frame_bytes': frame_bytes,
+            'target_depth': target_depth,
+            'silence_threshold': silence_threshold,
+            'idle_after_frames': idle_after_frames,
+            'volume_range_db': volume_range_db,
+            'drift_max_ppm': drift_max_ppm,
+            'cpus': sorted(cpus) if cpus else None,
+            'log_level': log_level,
+        }
+        self.process_name = f"audio-worker-{name}" if name else 'audio-worker'
+        self.ring = WorkerRingView(self)
+        self.packets = None
+        self.airplay_volume = 0.0
+        self.restarts = 0
+        self.restarting = False
+        self.started_at = None
+        self._start_seq = 0
+        self._bell_read = None
+        self._bell_write = None
+        self._process = None
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process else None
+
+    @property
+    def frames_produced(self):
+        return self.packets.header()[5] if self.packets is not None else 0
+
+    @property
+    def reader_running(self):
+        # Reported by the worker with every packet
+        return self.is_running() and self.packets is not None and bool(self.packets.header()[8])
+
+    def is_running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def ready(self):
+        """Running and has published a packet; startup takes a moment (imports, priming)"""
+        return self.is_running() and self.packets.write_seq > self._start_seq
+
+    def start(self):
+        if self.is_running():
+            return
+        if self.packets is None:
+            self.packets = SharedPacketRing()
+            self.packets.set_volume(self.airplay_volume)
+            self._bell_read, self._bell_write = os.pipe()
+            os.set_blocking(self._bell_read, False)
+            os.set_blocking(self._bell_write, False)
+        self._start_seq = self.packets.write_seq
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--name', self.process_name,
+             '--shm', self.packets.name, '--slots', str(self.packets.slots),
+             '--doorbell', str(self._bell_write), '--options', json.dumps(self.options)],
+            pass_fds=(self._bell_write,)
+        )
+        self.started_at = time.time()
+        logger.info(f"Started {self.process_name} (pid {self._process.pid})")
+
+    def stop(self, timeout=2.0):
+        """Stop the worker process; blocks, so run it in an executor"""
+        process, self._process = self._process, None
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{self.process_name} did not stop in {timeout:g}s, killing it")
+            process.kill()
+            process.wait()
+
+    def restart(self):
+        """Replace the worker process; readers of the ring carry on with the new one's packets"""
+        self.restarting = True
+        try:
+            self.stop()
+            self.restarts += 1
+            self.start()
+        finally:
+            self.restarting = False
+
+    def set_bitrate(self, kbps):
+        """Change the worker's encoder bitrate at its next frame; a restarted worker keeps it"""
+        self.options['bitrate'] = kbps
+        if self.packets is not None:
+            self.packets.set_bitrate(kbps)
+
+    def drift(self):
+        """(measured drift, applied correction) in ppm as last reported by the worker"""
+        return self.packets.get_drift() if self.packets is not None else (0.0, 0.0)
+
+    def set_volume(self, airplay_volume):
+        """Pass the AirPlay volume to the worker; it lives in shared memory, so a restarted worker keeps it"""
+        self.airplay_volume = airplay_volume
+        if self.packets is not None:
+            self.packets.set_volume(airplay_volume)
+
+    def wait(self, timeout):
+        """Block until the worker publishes a packet or `timeout` passes"""
+        select.select([self._bell_read], [], [], timeout)
+
+    def drain(self):
+        # Doorbell bytes for packets already visible in the ring
+        try:
+            while os.read(self._bell_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        """Stop the worker and free the shared memory"""
+        self.stop()
+        if self.packets is not None:
+            packets, self.packets = self.packets, None
+            packets.close()
+            packets.unlink()
+            os.close(self._bell_read)
+            os.close(self._bell_write)
+
+
+class WorkerAudio(discord.AudioSource):
+    """Bot-side audio source reading the worker's packets from the shared ring
+
+    It starts at the newest packet. If the worker stops publishing (being restarted,
+    or stalled), read() returns silence after two frame times. The broadcaster keeps
+    its clock and the voice clients stay connected.
+    """
+
+    def __init__(self, worker, on_idle_change=None, max_behind=5):
+        self.worker = worker
+        self.on_idle_change = on_idle_change
+        self.max_behind = max_behind
+        self.last_origin = None
+        self.idle = False
+        self._next = None
+        self._bytes_written = None
+
+    def set_bitrate(self, kbps):
+        self.worker.set_bitrate(kbps)
+
+    def read(self):
+        ring = self.worker.packets
+        if ring is None:
+            return b''
+        if self._next is None:
+            self._next = ring.write_seq
+        self.worker.drain()
+        deadline = time.perf_counter() + FRAME_DELAY * 2
+        while True:
+            latest = ring.write_seq
+            if latest < self._next:
+                # A fresh ring (after close()) starts over
+                self._next = latest
+            if self._next < latest:
+                if latest - self._next > self.max_behind:
+                    self._next = latest - 1
+                result = ring.read(self._next)
+                self._next += 1
+                if result is None:
+                    continue
+                packet, self.last_origin, encode_seconds = result
+                if packet is not OPUS_SILENCE:
+                    ENCODE_SECONDS.observe(encode_seconds)
+                self._update_stats(ring)
+                return packet
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.last_origin = None
+                return OPUS_SILENCE
+            self.worker.wait(remaining)
+
+    def _update_stats(self, ring):
+        header = ring.header()
+        written, idle = header[1], bool(header[7])
+        if self._bytes_written is not None and written > self._bytes_written:
+            PCM_BYTES_READ.inc(written - self._bytes_written)
+        self._bytes_written = written
+        if idle != self.idle:
+            self.idle = idle
+            if self.on_idle_change:
+                self.on_idle_change(idle)
+
+    def is_opus(self):
+        return True
+
+
+def run_worker(shm_name, slots, doorbell, options):
+    """The worker process: read, buffer, resample and encode on a 20 ms clock until SIGTERM"""
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    parent = os.getppid()
+
+    # Pin before starting the reader thread so it inherits the affinity
+    pin_current_thread(set(options['cpus']) if options['cpus'] else None)
+    packets = SharedPacketRing(shm_name, slots)
+    ring = PCMRingBuffer(options['capacity'], options['frame_bytes'], options['target_depth'])
+    latency = LatencyTracker()
+    reader = FIFOReader(options['pipe_path'], ring, latency=latency)
+    silence = None
+    if options['idle_after_frames']:
+        silence = SilenceDetector(options['silence_threshold'], idle_after_frames=options['idle_after_frames'])
+    drift = None
+    if options['drift_max_ppm']:
+        drift = DriftEstimator(options['target_depth'], INPUT_BYTES_PER_SECOND, max_ppm=options['drift_max_ppm'])
+    volume = None
+    if options['volume_range_db'] is not None:
+        volume = VolumeControl(options['volume_range_db'])
+    source = PCMOpusAudio(ring, bitrate=options['bitrate'],
+                          application=options['application'] or opus.APPLICATION_AUDIO,
+                          latency=latency, silence=silence, volume=volume, drift=drift)
+    source.prime()
+    reader.start()
+    logger.info(f"Audio worker {os.getpid()} reading {options['pipe_path']}")
+
+    try:
+        frames = 0
+        dropped = 0
+        # One-shot, counted in ticks: frames_encoded stands still while silent, idle or
+        # muted, and trimming then would clip the first audio after every pause
+        catching_up = True
+        start = time.perf_counter()
+        loops = 0
+        while not stop_event.is_set():
+            if catching_up:
+                # Audio that piled up in the pipe while the worker started would otherwise
+                # stay as extra delay for the rest of the stream
+                dropped += ring.trim(ring.target_depth + ring.frame_bytes)
+                if frames >= CATCH_UP_FRAMES - 1:
+                    catching_up = False
+                    if dropped:
+                        logger.info(f"Skipped {dropped * 1000 // INPUT_BYTES_PER_SECOND} ms of audio queued during startup")
+            bitrate = packets.get_bitrate()
+            if bitrate and bitrate != source.bitrate:
+                source.set_bitrate(bitrate)
+            if volume is not None:
+                airplay_volume = packets.get_volume()
+                if airplay_volume != volume.airplay_volume:
+                    volume.set_airplay_volume(airplay_volume)
+            started = time.perf_counter()
+            encoded = source.frames_encoded
+            packet = source.read()
+            now = time.perf_counter()
+            frames += 1
+            packets.write(
+                packet, source.last_origin,
+                encode_seconds=now - started if source.frames_encoded != encoded else 0.0,
+                stats=(ring.bytes_written, ring.fill(), ring.underruns, ring.overruns, frames, now,
+                       int(bool(silence and silence.idle)), int(reader.is_running()))
+            )
+            if drift is not None:
+                packets.set_drift(drift.drift_ppm, drift.correction_ppm)
+            try:
+                os.write(doorbell, b'\0')
+            except BlockingIOError:
+                pass  # Nobody is reading; the ring still has the packet
+            loops += 1
+
+            if loops % 50 == 0 and os.getppid() != parent:
+                logger.warning("Bot process went away, stopping the audio worker")
+                break
+
+            next_time = start + FRAME_DELAY * loops
+            if now - next_time > 0.2:
+                start = now
+                loops = 0
+                continue
+            if next_time > now:
+                time.sleep(next_time - now)
+    except Exception as e:
+        logger.error(f"Audio worker error: {e}")
+        logger.error(traceback.format_exc())
+    finally:
+        reader.stop()
+        source.cleanup()
+        packets.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--name', default='audio-worker')
+    parser.add_argument('--shm', required=True, help='shared memory name of the packet ring')
+    parser.add_argument('--slots', type=int, default=SLOTS)
+    parser.add_argument('--doorbell', type=int, required=True, help='fd written after every packet')
+    parser.add_argument('--options', required=True, help='engine settings as JSON')
+    args = parser.parse_args()
+
+    options = json.loads(args.options)
+    logging.basicConfig(level=options['log_level'], format=TEXT_FORMAT.replace('%(name)s', f'{args.name}/%(name)s'))
+    run_worker(args.shm, args.slots, args.doorbell, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Compare the FFmpeg and native PCM->Opus engines on CPU per stream and time-to-first-packet.
+
+Usage: python benchmarks/bench_audio_engine.py [--seconds 10] [--runs 3] [--realtime]
+"""
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discord import FFmpegOpusAudio  # noqa: E402
+from discord.player import OPUS_SILENCE  # noqa: E402
+from pcm_audio import PCMOpusAudio, INPUT_FRAME_BYTES, INPUT_SAMPLE_RATE, INPUT_BYTES_PER_SECOND  # noqa: E402
+from ring_buffer import PCMRingBuffer, FIFOReader  # noqa: E402
+
+
+def make_pcm(seconds):
+    """Generate a stereo test signal (two tones plus a little noise) as s16le bytes"""
+    t = np.arange(int(seconds * INPUT_SAMPLE_RATE)) / INPUT_SAMPLE_RATE
+    left = 0.4 * np.sin(2 * np.pi * 440 * t) + 0.02 * np.random.randn(t.size)
+    right = 0.4 * np.sin(2 * np.pi * 660 * t) + 0.02 * np.random.randn(t.size)
+    stereo = np.stack([left, right], axis=1) * 32767
+    return np.clip(stereo, -32768, 32767).astype('<i2').tobytes()
+
+
+def write_pipe(path, pcm, realtime):
+    """Play the role of shairport-sync: write PCM into the FIFO"""
+    frame_time = INPUT_FRAME_BYTES / (INPUT_SAMPLE_RATE * 4)
+    start = time.perf_counter()
+    with open(path, 'wb', buffering=0) as pipe:
+        for index, offset in enumerate(range(0, len(pcm), INPUT_FRAME_BYTES)):
+            try:
+                pipe.write(pcm[offset:offset + INPUT_FRAME_BYTES])
+            except BrokenPipeError:
+                return
+            if realtime:
+                delay = start + (index + 1) * frame_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def build_ffmpeg(path):
+    # Mirrors AudioBot.create_audio_source
+    return FFmpegOpusAudio(
+        source=path,
+        before_options='-re -f s16le -ar 44100 -ac 2',
+        options='-vn -ar 48000 -ac 2 -b:a 128k -f opus'
+    )
+
+
+class NativeStream:
+    """FIFOReader + jitter buffer + PCMOpusAudio, wired the way AudioBot does it"""
+
+    def __init__(self, path, jitter_ms, capacity_seconds):
+        # Faster-than-realtime runs need room for the whole clip or the ring drops frames
+        self.ring = PCMRingBuffer(
+            capacity=int(INPUT_BYTES_PER_SECOND * capacity_seconds),
+            frame_bytes=INPUT_FRAME_BYTES,
+            target_depth=max(INPUT_FRAME_BYTES, INPUT_BYTES_PER_SECOND * jitter_ms // 1000)
+        )
+        self.reader = FIFOReader(path, self.ring)
+        self.reader.start()
+        self.source = PCMOpusAudio(self.ring, bitrate=128)
+
+    def read(self):
+        packet = self.source.read()
+        # The writer is done once the reader has seen EOF and the buffer can't fill a frame
+        if packet is OPUS_SILENCE and self.reader.eof_count and self.ring.fill() < INPUT_FRAME_BYTES:
+            return b''
+        return packet
+
+    def cleanup(self):
+        self.reader.stop()
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def run_once(build, path, pcm, seconds, realtime):
+    writer = threading.Thread(target=write_pipe, args=(path, pcm, realtime), daemon=True)
+    writer.start()
+
+    cpu_start = cpu_seconds()
+    started = time.perf_counter()
+    source = build(path)
+    first_packet = None
+    packets = 0
+    try:
+        while packets < seconds * 50:
+            packet = source.read()
+            if not packet:
+                break
+            if packet is OPUS_SILENCE:
+                # Native jitter buffer is priming or waiting on the writer
+                time.sleep(0.001)
+                continue
+            if first_packet is None:
+                first_packet = time.perf_counter() - started
+            packets += 1
+    finally:
+        # FFmpegOpusAudio.cleanup kills and reaps the process so its CPU time lands in RUSAGE_CHILDREN
+        source.cleanup()
+    writer.join(timeout=5)
+    cpu = cpu_seconds() - cpu_start
+    return {
+        'ttfp_ms': (first_packet or 0) * 1000,
+        'packets': packets,
+        'cpu_pct': cpu / max(packets * 0.02, 1e-9) * 100,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=10.0, help='audio seconds per run')
+    parser.add_argument('--runs', type=int, default=3, help='runs per engine')
+    parser.add_argument('--realtime', action='store_true', help='pace the writer like shairport-sync')
+    parser.add_argument('--engines', default='ffmpeg,native')
+    parser.add_argument('--jitter-ms', type=int, default=0, help='native jitter buffer target depth')
+    args = parser.parse_args()
+
+    engines = {
+        'ffmpeg': build_ffmpeg,
+        'native': lambda path: NativeStream(path, args.jitter_ms, 1 if args.realtime else args.seconds + 1),
+    }
+    pcm = make_pcm(args.seconds + 1)
+    workdir = tempfile.mkdtemp(prefix='bizzitybot-bench-')
+    path = os.path.join(workdir, 'audio')
+    os.mkfifo(path)
+
+    try:
+        print(f"{'engine':<8} {'ttfp ms':>10} {'cpu %/stream':>14} {'packets':>8}")
+        for name in args.engines.split(','):
+            if name == 'ffmpeg' and not shutil.which('ffmpeg'):
+                print(f"{name:<8} skipped (ffmpeg not found)")
+                continue
+            results = []
+            for _ in range(args.runs):
+                try:
+                    results.append(run_once(engines[name], path, pcm, args.seconds, args.realtime))
+                except Exception as e:
+                    print(f"{name:<8} failed: {e!r}")
+                    break
+            if not results:
+                continue
+            ttfp = sum(r['ttfp_ms'] for r in results) / len(results)
+            cpu = sum(r['cpu_pct'] for r in results) / len(results)
+            packets = results[-1]['packets']
+            print(f"{name:<8} {ttfp:>10.1f} {cpu:>14.2f} {packets:>8}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""End-to-end benchmark: AudioBot's audio and metadata stages fed by the shairport-sync stand-in.
+
+Joins `--guilds` fake voice channels through the real !join command. After a warm-up,
+it measures CPU, memory, frames/s, send-interval jitter, pipe-to-send latency (native
+engine), metadata items/s and announcements.
+
+Usage: python benchmarks/bench_bot.py [--seconds 20] [--runs 3] [--guilds 1] [--engine native]
+           [--speed 1.0] [--wav song.wav] [--json results.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_discord import FakeBot, FakeContext, FakeTextChannel, FakeVoiceChannel  # noqa: E402
+from shairport_standin import ShairportStandIn, generate_pcm, load_wav  # noqa: E402
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def worker_cpu_seconds(cog):
+    """CPU time of running audio worker processes (AUDIO_ENGINE=process), which RUSAGE_CHILDREN misses"""
+    total = 0.0
+    for receiver in cog.receivers.values():
+        worker = receiver.audio_worker
+        if worker is None or not worker.is_running():
+            continue
+        try:
+            with open(f'/proc/{worker.pid}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def interval_stats(times):
+    """Worst gap and p99 deviation from the 20 ms frame interval, in ms"""
+    if len(times) < 2:
+        return 0.0, 0.0
+    intervals = np.diff(np.asarray(times)) * 1000
+    return float(intervals.max()), float(np.percentile(np.abs(intervals - 20), 99))
+
+
+async def run_once(bot_module, args, audio_path, metadata_path, pcm):
+    AudioBot = bot_module.AudioBot
+    cog = AudioBot(FakeBot(asyncio.get_running_loop()))
+    await cog.cog_load()
+    standin = ShairportStandIn(audio_path, metadata_path, pcm, speed=args.speed,
+                               track_seconds=args.track_seconds, cover_art=not args.no_cover_art)
+    standin.start()
+
+    contexts = [FakeContext(guild, FakeVoiceChannel(f"voice-{guild}"), FakeTextChannel(f"text-{guild}"))
+                for guild in range(1, args.guilds + 1)]
+    try:
+        for ctx in contexts:
+            await AudioBot.join_channel.callback(cog, ctx)
+        await asyncio.sleep(args.warmup)
+
+        # Measure from here on
+        receiver = cog.default_receiver
+        parser = receiver.metadata_reader.parser
+        voice_clients = [ctx.author.voice.channel.voice_client for ctx in contexts]
+        base_packets = [vc.packets for vc in voice_clients]
+        base_times = [len(vc.send_times) for vc in voice_clients]
+        base_items = parser.items_parsed + parser.items_skipped
+        base_written = standin.items_written
+        base_announcements = sum(len(ctx.channel.messages) for ctx in contexts)
+        base_underruns = sum(s.subscriber.underruns for s in cog.sessions.values() if s.subscriber)
+        receiver.latency.reset()
+        cpu_start, standin_cpu_start, worker_cpu_start = cpu_seconds(), standin.cpu_seconds, worker_cpu_seconds(cog)
+        started = time.perf_counter()
+
+        await asyncio.sleep(args.seconds)
+
+        elapsed = time.perf_counter() - started
+        # The stand-in's own writer threads run in this process too
+        cpu = (cpu_seconds() - cpu_start) - (standin.cpu_seconds - standin_cpu_start) \
+            + (worker_cpu_seconds(cog) - worker_cpu_start)
+        fps = [(vc.packets - base) / elapsed for vc, base in zip(voice_clients, base_packets)]
+        gaps = [interval_stats(vc.send_times[base:]) for vc, base in zip(voice_clients, base_times)]
+        latency = receiver.latency.percentiles()
+        result = {
+            'cpu_pct': cpu / elapsed * 100,
+            'rss_mb': rss_mb(),
+            'fps_min': min(fps),
+            'fps_mean': sum(fps) / len(fps),
+            'max_gap_ms': max(g[0] for g in gaps),
+            'jitter_p99_ms': max(g[1] for g in gaps),
+            'underruns': sum(s.subscriber.underruns for s in cog.sessions.values() if s.subscriber) - base_underruns,
+            'latency_p50_ms': latency[50] * 1000 if latency['count'] else None,
+            'latency_p95_ms': latency[95] * 1000 if latency['count'] else None,
+            'latency_p99_ms': latency[99] * 1000 if latency['count'] else None,
+            'items_per_s': (parser.items_parsed + parser.items_skipped - base_items) / elapsed,
+            'items_written_per_s': (standin.items_written - base_written) / elapsed,
+            'announcements': sum(len(ctx.channel.messages) for ctx in contexts) - base_announcements,
+            'jitter_buffer_overruns': receiver.pcm_buffer.overruns,
+        }
+    finally:
+        for ctx in contexts:
+            await AudioBot.leave_channel.callback(cog, ctx)
+        await cog.cog_unload()
+        standin.stop()
+    return result
+
+
+def fmt(value, spec):
+    return format(value, spec) if value is not None else '-'.rjust(len(format(0, spec)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=20.0, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds before measuring')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--guilds', type=int, default=1, help='fake voice channels streaming at once')
+    parser.add_argument('--engine', default='native', choices=['native', 'process', 'ffmpeg'])
+    parser.add_argument('--profile', default='standard', help='STREAM_PROFILE')
+    parser.add_argument('--speed', type=float, default=1.0, help='stand-in speed, 1 = realtime, 0 = unpaced')
+    parser.add_argument('--track-seconds', type=float, default=10.0)
+    parser.add_argument('--wav', help='16-bit 44.1 kHz WAV file (default: generated signal)')
+    parser.add_argument('--no-cover-art', action='store_true')
+    parser.add_argument('--json', help='also write the per-run results here')
+    args = parser.parse_args()
+
+    if args.engine == 'ffmpeg' and not shutil.which('ffmpeg'):
+        sys.exit("ffmpeg not found")
+
+    workdir = tempfile.mkdtemp(prefix='bizzitybot-bench-')
+    audio_path = os.path.join(workdir, 'shairport-sync-audio')
+    metadata_path = os.path.join(workdir, 'shairport-sync-metadata')
+    # main.py reads its configuration at import time
+    os.environ.update({
+        'SHAIRPORT_PIPE_PATH': audio_path,
+        'SHAIRPORT_METADATA_PIPE_PATH': metadata_path,
+        'AUDIO_ENGINE': args.engine,
+        'STREAM_PROFILE': args.profile,
+        'LOG_DIR': workdir,
+        'METRICS_PORT': '0',
+    })
+    bot_module = importlib.import_module('main')
+    pcm = load_wav(args.wav) if args.wav else generate_pcm(30)
+
+    columns = ('cpu %', 'rss MB', 'fps min', 'gap ms', 'jit99 ms', 'lat p50', 'lat p99', 'items/s', 'ann')
+    print(f"{args.engine} engine, {args.guilds} guild(s), speed {args.speed}, {args.seconds:.0f}s per run")
+    print(f"{'run':<4}" + ''.join(f"{c:>10}" for c in columns))
+    results = []
+    try:
+        for run in range(1, args.runs + 1):
+            r = asyncio.run(run_once(bot_module, args, audio_path, metadata_path, pcm))
+            results.append(r)
+            print(f"{run:<4}{r['cpu_pct']:>10.2f}{r['rss_mb']:>10.1f}{r['fps_min']:>10.1f}"
+                  f"{r['max_gap_ms']:>10.1f}{r['jitter_p99_ms']:>10.2f}{fmt(r['latency_p50_ms'], '>10.1f')}"
+                  f"{fmt(r['latency_p99_ms'], '>10.1f')}{r['items_per_s']:>10.1f}{r['announcements']:>10}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if len(results) > 1:
+        cpu = sorted(r['cpu_pct'] for r in results)[len(results) // 2]
+        fps = sorted(r['fps_min'] for r in results)[len(results) // 2]
+        print(f"median cpu {cpu:.2f}% ({cpu / args.guilds:.2f}% per guild), median min fps {fps:.1f}")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'runs': results}, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Simulate clock drift between shairport-sync and the 20 ms frame clock, with and without compensation.
+
+A simulated writer puts 352-sample AirPlay chunks into the jitter buffer at
+(1 + drift) times the nominal rate; PCMOpusAudio drains one frame per simulated
+20 ms tick. No real time passes, so an hour of drift takes seconds. For each drift it
+reports the buffer fill over the last quarter of the run, the underruns and overruns,
+the drift the estimator measured and the CPU time per frame.
+
+Usage: python benchmarks/bench_drift.py [--drift-ppm -300,100,300] [--minutes 30] [--max-ppm 1000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from drift import DriftEstimator  # noqa: E402
+from pcm_audio import PCMOpusAudio, INPUT_BYTES_PER_SECOND, INPUT_FRAME_BYTES, INPUT_SAMPLE_RATE  # noqa: E402
+from ring_buffer import PCMRingBuffer  # noqa: E402
+from shairport_standin import CHUNK_BYTES, CHUNK_FRAMES, generate_pcm  # noqa: E402
+
+FRAME_SECONDS = 0.02
+
+
+def simulate(drift_ppm, minutes, max_ppm, target_ms, pcm):
+    target = INPUT_BYTES_PER_SECOND * target_ms // 1000
+    ring = PCMRingBuffer(INPUT_BYTES_PER_SECOND, INPUT_FRAME_BYTES, target)
+    drift = DriftEstimator(target, INPUT_BYTES_PER_SECOND, max_ppm=max_ppm) if max_ppm else None
+    source = PCMOpusAudio(ring, drift=drift)
+    chunk_seconds = CHUNK_FRAMES / INPUT_SAMPLE_RATE / (1 + drift_ppm * 1e-6)
+    frames = int(minutes * 60 / FRAME_SECONDS)
+    written = 0
+    offset = 0
+    fills = []
+    cpu = 0.0
+    for frame in range(frames):
+        now = frame * FRAME_SECONDS
+        while written * chunk_seconds <= now:
+            remaining = CHUNK_BYTES
+            while remaining:
+                # The free region may wrap around the end of the ring
+                view = ring.write_view(remaining)
+                count = len(view)
+                view[:] = pcm[offset:offset + count]
+                view.release()
+                ring.commit_write(count)
+                offset = (offset + count) % (len(pcm) - CHUNK_BYTES)
+                remaining -= count
+            written += 1
+        started = time.process_time()
+        source.read()
+        cpu += time.process_time() - started
+        if frame >= frames * 3 // 4:
+            fills.append(ring.fill() * 1000 / INPUT_BYTES_PER_SECOND)
+    return {
+        'fill_min': min(fills), 'fill_mean': sum(fills) / len(fills), 'fill_max': max(fills),
+        'underruns': ring.underruns, 'overruns': ring.overruns,
+        'measured': drift.drift_ppm if drift else None,
+        'cpu_us': cpu / frames * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--drift-ppm', default='-300,100,300', help='comma-separated writer clock errors')
+    parser.add_argument('--minutes', type=float, default=30.0, help='simulated minutes per drift')
+    parser.add_argument('--max-ppm', type=float, default=1000.0, help='DRIFT_MAX_PPM to test')
+    parser.add_argument('--target-ms', type=int, default=100, help='jitter buffer target')
+    args = parser.parse_args()
+
+    pcm = generate_pcm(10)
+    print(f"{'drift':>7} {'comp':>5} {'fill min':>9} {'mean':>7} {'max':>7} {'under':>6} {'over':>5} "
+          f"{'measured':>9} {'us/frame':>9}")
+    for drift_ppm in (float(value) for value in args.drift_ppm.split(',')):
+        for max_ppm in (0, args.max_ppm):
+            result = simulate(drift_ppm, args.minutes, max_ppm, args.target_ms, pcm)
+            measured = f"{result['measured']:+.1f}" if result['measured'] is not None else '-'
+            print(f"{drift_ppm:+7.0f} {'on' if max_ppm else 'off':>5} {result['fill_min']:9.1f} "
+                  f"{result['fill_mean']:7.1f} {result['fill_max']:7.1f} {result['underruns']:6d} "
+                  f"{result['overruns']:5d} {measured:>9} {result['cpu_us']:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
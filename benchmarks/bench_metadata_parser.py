@@ -0,0 +1,106 @@
+"""Micro-benchmark: items/sec of the incremental metadata parser vs the old ElementTree path.
+
+Usage: python benchmarks/bench_metadata_parser.py [--tracks 2000] [--chunk 65536]
+"""
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata_parser import ShairportMetadataParser  # noqa: E402
+
+
+def item(item_type, code, data=None):
+    """One item exactly as shairport-sync writes it to the metadata pipe"""
+    header = (f"<item><type>{item_type.encode().hex()}</type><code>{code.encode().hex()}</code>"
+              f"<length>{len(data) if data else 0}</length>")
+    if data is None:
+        return header + "</item>\n"
+    return header + "\n<data encoding=\"base64\">\n" + base64.b64encode(data).decode() + "</data></item>\n"
+
+
+def make_stream(tracks):
+    """A realistic mix: per track a metadata bundle plus a flood of progress and volume items"""
+    parts = []
+    for n in range(tracks):
+        parts.append(item('ssnc', 'mdst', b'1234567'))
+        for code, value in (('minm', f'Title {n}'), ('asar', f'Artist {n % 50}'), ('asal', f'Album {n % 200}'),
+                            ('asgn', 'Electronic'), ('ascp', 'Composer'), ('astn', '3'), ('asdk', '0'),
+                            ('caps', '1'), ('astm', '215000'), ('mper', '1234567890')):
+            parts.append(item('core', code, value.encode()))
+        parts.append(item('ssnc', 'mden', b'1234567'))
+        for tick in range(40):
+            parts.append(item('ssnc', 'prgr', f'{tick}/{tick + 1000}/{tick + 2000}'.encode()))
+        for step in range(20):
+            parts.append(item('ssnc', 'pvol', f'-{step}.00,-{step}.00,-96.30,0.00'.encode()))
+    return ''.join(parts).encode()
+
+
+def elementtree_path(data):
+    """The previous implementation: line buffering, ET.fromstring and fromhex on every item"""
+    count = 0
+    xml_buffer = ""
+    for line in io.StringIO(data.decode('utf-8')):
+        line = line.strip()
+        if not line:
+            continue
+        xml_buffer += line
+        if line.endswith('</item>'):
+            try:
+                root = ET.fromstring(xml_buffer)
+                metadata_type = root.find('type')
+                metadata_code = root.find('code')
+                data_element = root.find('data')
+                if metadata_type is not None and metadata_code is not None and data_element is not None:
+                    type_str = bytes.fromhex(metadata_type.text).decode('ascii', errors='ignore')
+                    bytes.fromhex(metadata_code.text).decode('ascii', errors='ignore')
+                    if type_str == 'core' and data_element.get('encoding') == 'base64':
+                        base64.b64decode(data_element.text).decode('utf-8', errors='ignore')
+            except ET.ParseError:
+                pass
+            finally:
+                xml_buffer = ""
+            count += 1
+    return count
+
+
+def incremental_path(data, chunk):
+    parser = ShairportMetadataParser({'core': {'minm', 'asar', 'asal'}})
+    view = memoryview(data)
+    for offset in range(0, len(data), chunk):
+        for parsed in parser.feed(view[offset:offset + chunk]):
+            parsed.payload.decode('utf-8', errors='ignore')
+    return parser.items_parsed + parser.items_skipped + parser.items_dropped
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    count = fn(*args)
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=2000)
+    parser.add_argument('--chunk', type=int, default=65536, help='pipe read size for the incremental parser')
+    args = parser.parse_args()
+
+    data = make_stream(args.tracks)
+    print(f"{len(data) / 1e6:.1f} MB of metadata")
+
+    count, elapsed = timed(elementtree_path, data)
+    baseline = count / elapsed
+    print(f"{'elementtree':<12} {count:>8} items {baseline:>12,.0f} items/s")
+
+    count, elapsed = timed(incremental_path, data, args.chunk)
+    rate = count / elapsed
+    print(f"{'incremental':<12} {count:>8} items {rate:>12,.0f} items/s  ({rate / baseline:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
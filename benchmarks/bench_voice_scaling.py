@@ -0,0 +1,192 @@
+"""Scaling benchmark: how many voice channels one bot process can feed with clean 20 ms pacing.
+
+For each channel count, the real !join flow runs against the shairport-sync stand-in.
+Every guild's voice client sends RTP over UDP to a local fake voice endpoint. The
+endpoint reports delivered packet rate, sequence and timestamp gaps, jitter and the
+longest silence per stream. With --reconnect, !reconnect is also run for each guild
+and the audio gap across it is measured, then a !reconnect whose connect fails must
+release every session and stop the pipeline. With --check, the exit status is non-zero
+when any level misses the thresholds, so it can gate local CI-like runs.
+
+Usage: python benchmarks/bench_voice_scaling.py [--channels 1,5,10,25,50] [--seconds 10]
+           [--engine native] [--reconnect] [--check --max-jitter-ms 5 --min-delivery 0.99]
+"""
+import argparse
+import asyncio
+import functools
+import importlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_bot import cpu_seconds, rss_mb  # noqa: E402
+from fake_discord import FakeBot, FakeContext, FakeTextChannel, FakeVoiceChannel, UnreachableVoiceChannel  # noqa: E402
+from fake_voice_endpoint import FakeVoiceEndpoint, RTPVoiceClient  # noqa: E402
+from shairport_standin import ShairportStandIn, generate_pcm  # noqa: E402
+
+FRAMES_PER_SECOND = 50
+
+
+async def run_level(bot_module, args, endpoint, channels, audio_path, metadata_path, pcm):
+    AudioBot = bot_module.AudioBot
+    cog = AudioBot(FakeBot(asyncio.get_running_loop()))
+    await cog.cog_load()
+    standin = ShairportStandIn(audio_path, metadata_path, pcm, track_seconds=args.seconds, cover_art=False)
+    standin.start()
+
+    client_class = functools.partial(RTPVoiceClient, endpoint=endpoint.address)
+    contexts = [FakeContext(guild, FakeVoiceChannel(f"voice-{guild}", client_class), FakeTextChannel(f"text-{guild}"))
+                for guild in range(1, channels + 1)]
+    result = {'channels': channels}
+    try:
+        for ctx in contexts:
+            await AudioBot.join_channel.callback(cog, ctx)
+        await asyncio.sleep(args.warmup)
+
+        endpoint.reset()
+        cpu_start, standin_cpu_start = cpu_seconds(), standin.cpu_seconds
+        started = time.perf_counter()
+        await asyncio.sleep(args.seconds)
+        elapsed = time.perf_counter() - started
+        streams = endpoint.stats()
+        cpu = (cpu_seconds() - cpu_start) - (standin.cpu_seconds - standin_cpu_start)
+
+        received = sum(s['packets'] for s in streams)
+        jitters = [s['jitter_ms'] for s in streams] or [0.0]
+        result.update({
+            'cpu_pct': cpu / elapsed * 100,
+            'rss_mb': rss_mb(),
+            'streams': len(streams),
+            'delivery': received / (FRAMES_PER_SECOND * channels * elapsed),
+            'lost': sum(s['lost'] for s in streams),
+            'timestamp_jumps': sum(s['timestamp_jumps'] for s in streams),
+            'jitter_median_ms': statistics.median(jitters),
+            'jitter_max_ms': max(jitters),
+            'max_gap_ms': max((s['max_gap_ms'] for s in streams), default=0.0),
+            'underruns': sum(s.subscriber.underruns for s in cog.sessions.values() if s.subscriber),
+        })
+
+        if args.reconnect:
+            result['reconnect_gap_ms'] = await measure_reconnects(AudioBot, cog, endpoint, contexts)
+            result['failed_reconnect_released'] = await check_failed_reconnect(AudioBot, cog, contexts)
+    finally:
+        for ctx in contexts:
+            await AudioBot.leave_channel.callback(cog, ctx)
+        await cog.cog_unload()
+        standin.stop()
+    return result
+
+
+async def measure_reconnects(AudioBot, cog, endpoint, contexts):
+    """Run !reconnect for each guild; the gap is the old SSRC's last packet to the new one's first"""
+    old = {ctx.guild.id: cog.sessions[ctx.guild.id].voice_client.ssrc for ctx in contexts}
+    await asyncio.gather(*(AudioBot.reconnect.callback(cog, ctx) for ctx in contexts))
+    await asyncio.sleep(1.0)
+
+    streams = {s['ssrc']: s for s in endpoint.stats()}
+    gaps = []
+    for ctx in contexts:
+        session = cog.sessions.get(ctx.guild.id)
+        before = streams.get(old[ctx.guild.id])
+        after = streams.get(session.voice_client.ssrc) if session else None
+        if before and after and after['first_arrival'] is not None:
+            gaps.append((after['first_arrival'] - before['last_arrival']) * 1000)
+    return max(gaps) if gaps else None
+
+
+async def check_failed_reconnect(AudioBot, cog, contexts):
+    """Run !reconnect towards channels that can't be reached; nothing may keep running for nobody"""
+    for ctx in contexts:
+        ctx.author.voice.channel = UnreachableVoiceChannel(f"unreachable-{ctx.guild.id}")
+    await asyncio.gather(*(AudioBot.reconnect.callback(cog, ctx) for ctx in contexts))
+    receivers = cog.receivers.values()
+    return (not cog.sessions and not any(r.sessions or r.stream_wanted or r.broadcaster.is_running() for r in receivers)
+            and all(ctx.replies[-1].startswith("Error reconnecting") for ctx in contexts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--channels', default='1,5,10,25,50', help='comma-separated channel counts')
+    parser.add_argument('--seconds', type=float, default=10.0, help='measured seconds per level')
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--engine', default='native', choices=['native', 'process', 'ffmpeg'])
+    parser.add_argument('--profile', default='standard', help='STREAM_PROFILE')
+    parser.add_argument('--reconnect', action='store_true', help='also measure the !reconnect audio gap')
+    parser.add_argument('--check', action='store_true', help='exit 1 if any level misses the thresholds')
+    parser.add_argument('--max-jitter-ms', type=float, default=5.0)
+    parser.add_argument('--min-delivery', type=float, default=0.99)
+    parser.add_argument('--json', help='also write the results here')
+    args = parser.parse_args()
+
+    if args.engine == 'ffmpeg' and not shutil.which('ffmpeg'):
+        sys.exit("ffmpeg not found")
+
+    workdir = tempfile.mkdtemp(prefix='bizzitybot-scaling-')
+    audio_path = os.path.join(workdir, 'shairport-sync-audio')
+    metadata_path = os.path.join(workdir, 'shairport-sync-metadata')
+    # main.py reads its configuration at import time
+    os.environ.update({
+        'SHAIRPORT_PIPE_PATH': audio_path,
+        'SHAIRPORT_METADATA_PIPE_PATH': metadata_path,
+        'AUDIO_ENGINE': args.engine,
+        'STREAM_PROFILE': args.profile,
+        'LOG_DIR': workdir,
+        'METRICS_PORT': '0',
+        'SILENCE_TIMEOUT_MS': '0',
+    })
+
+    endpoint = FakeVoiceEndpoint()
+    endpoint.start()
+    bot_module = importlib.import_module('main')
+    pcm = generate_pcm(30)
+
+    print(f"{args.engine} engine, {args.seconds:.0f}s per level, endpoint {endpoint.address[0]}:{endpoint.address[1]}")
+    header = f"{'chans':>6}{'cpu %':>9}{'rss MB':>8}{'deliv %':>9}{'lost':>7}{'ts jmp':>7}{'jit med':>9}{'jit max':>9}{'gap ms':>8}"
+    if args.reconnect:
+        header += f"{'reconn ms':>11}"
+    print(header)
+
+    results = []
+    failures = []
+    leaks = []  # levels where a failed !reconnect left something running
+    try:
+        for channels in (int(c) for c in args.channels.split(',')):
+            r = asyncio.run(run_level(bot_module, args, endpoint, channels, audio_path, metadata_path, pcm))
+            results.append(r)
+            line = (f"{channels:>6}{r['cpu_pct']:>9.1f}{r['rss_mb']:>8.1f}{r['delivery'] * 100:>9.2f}{r['lost']:>7}"
+                    f"{r['timestamp_jumps']:>7}{r['jitter_median_ms']:>9.2f}{r['jitter_max_ms']:>9.2f}{r['max_gap_ms']:>8.1f}")
+            if args.reconnect:
+                gap = r.get('reconnect_gap_ms')
+                line += f"{gap:>11.0f}" if gap is not None else f"{'-':>11}"
+            print(line)
+            if r['delivery'] < args.min_delivery or r['jitter_max_ms'] > args.max_jitter_ms:
+                failures.append(channels)
+            if r.get('failed_reconnect_released') is False:
+                leaks.append(channels)
+    finally:
+        endpoint.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print(f"Pacing degraded at {failures[0]} channel(s) "
+              f"(delivery < {args.min_delivery:.0%} or jitter > {args.max_jitter_ms} ms)")
+    else:
+        print("All levels within thresholds")
+    if leaks:
+        print(f"A failed !reconnect left sessions or the pipeline running at {leaks[0]} channel(s)")
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({'args': vars(args), 'levels': results}, out, indent=2)
+    if args.check and (failures or leaks):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Just enough of discord.py's voice and text objects to run AudioBot without Discord.
+
+FakeVoiceClient drives sources with discord.py's real AudioPlayer, so pacing, pausing
+and silence handling are the library's own; packets are counted instead of sent.
+"""
+import asyncio
+import threading
+import time
+
+from discord.player import AudioPlayer
+
+
+class _FakeGateway:
+    async def speak(self, state):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, channel, loop):
+        self.channel = channel
+        self.client = type('FakeClient', (), {'loop': loop})()
+        self.ws = _FakeGateway()
+        self.timeout = 1
+        self.packets = 0
+        self.bytes_sent = 0
+        self.send_times = []  # perf_counter of every packet
+        self._lock = threading.Lock()
+        self._player = None
+        self._connected = True
+
+    # Used by AudioPlayer
+    def wait_until_connected(self, timeout):
+        return self._connected
+
+    def send_audio_packet(self, data, encode=True):
+        with self._lock:
+            self.packets += 1
+            self.bytes_sent += len(data)
+            self.send_times.append(time.perf_counter())
+
+    # The VoiceClient surface AudioBot uses
+    def is_connected(self):
+        return self._connected
+
+    def play(self, source, after=None):
+        self._player = AudioPlayer(source, self, after=after)
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+
+
+class FakeVoiceChannel:
+    def __init__(self, name, voice_client_class=FakeVoiceClient):
+        self.name = name
+        self.voice_client_class = voice_client_class
+        self.voice_client = None
+
+    async def connect(self, **kwargs):
+        self.voice_client = self.voice_client_class(self, asyncio.get_running_loop())
+        return self.voice_client
+
+
+class UnreachableVoiceChannel(FakeVoiceChannel):
+    """A voice channel whose connect() times out, like Discord's voice server being down"""
+
+    async def connect(self, **kwargs):
+        raise asyncio.TimeoutError
+
+
+class FakeMessage:
+    def __init__(self, content=None, embed=None):
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+
+
+class FakeTextChannel:
+    _ids = iter(range(1000, 10 ** 9))
+
+    def __init__(self, name):
+        self.name = name
+        self.id = next(self._ids)
+        self.messages = []
+
+    async def send(self, content=None, embed=None, file=None, **kwargs):
+        if file is not None and embed is not None and embed.thumbnail and embed.thumbnail.url:
+            # What Discord does: attachment:// becomes a CDN URL in the returned message
+            embed = embed.copy()
+            embed.set_thumbnail(url=f"https://cdn.example/attachments/{self.id}/{file.filename}")
+        message = FakeMessage(content, embed)
+        self.messages.append(message)
+        return message
+
+
+class FakeContext:
+    """A command invocation from `guild_id` by a member sitting in `voice_channel`"""
+
+    def __init__(self, guild_id, voice_channel, text_channel):
+        self.guild = type('FakeGuild', (), {'id': guild_id})()
+        self.author = type('FakeMember', (), {'voice': type('FakeVoiceState', (), {'channel': voice_channel})()})()
+        self.channel = text_channel
+        self.replies = []
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content)
+        return FakeMessage(content, kwargs.get('embed'))
+
+
+class FakeBot:
+    """AudioBot only needs the bot's event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
@@ -0,0 +1,202 @@
+"""A local stand-in for Discord's UDP voice server, for offline throughput and pacing tests.
+
+RTPVoiceClient sends each packet the way discord.py's VoiceClient does: a 12-byte RTP
+header, with the sequence number +1 and the timestamp +960 per packet and one SSRC per
+connection. Payloads are not encrypted, since that isn't what these tests measure.
+FakeVoiceEndpoint receives them in a separate process, so it doesn't compete with the
+bot for the GIL. Per SSRC it records arrival timing, sequence gaps, timestamp jumps
+and RFC 3550 interarrival jitter.
+"""
+import multiprocessing
+import select
+import socket
+import struct
+import threading
+import time
+
+from fake_discord import FakeVoiceClient
+
+RTP_HEADER = struct.Struct('>BBHII')
+SAMPLING_RATE = 48000
+SAMPLES_PER_FRAME = 960
+
+
+class StreamStats:
+    """Receive-side statistics for one SSRC"""
+
+    def __init__(self, ssrc):
+        self.ssrc = ssrc
+        self.packets = 0
+        self.bytes = 0
+        self.lost = 0          # Sequence numbers skipped
+        self.reordered = 0     # Arrived after a later sequence number
+        self.timestamp_jumps = 0  # Timestamp advanced by something other than one frame
+        self.jitter = 0.0      # RFC 3550 estimate, in timestamp units
+        self.max_gap = 0.0     # Longest time between two arrivals, seconds
+        self.first_arrival = None
+        self.last_arrival = None
+        self._last_seq = None
+        self._last_ts = None
+        self._last_transit = None
+
+    def add(self, seq, timestamp, size, arrival):
+        self.packets += 1
+        self.bytes += size
+        if self.first_arrival is None:
+            self.first_arrival = arrival
+        else:
+            self.max_gap = max(self.max_gap, arrival - self.last_arrival)
+        self.last_arrival = arrival
+
+        if self._last_seq is not None:
+            delta = (seq - self._last_seq) & 0xFFFF
+            if delta == 0 or delta > 0x8000:
+                self.reordered += 1
+                return
+            self.lost += delta - 1
+            if (timestamp - self._last_ts) & 0xFFFFFFFF != SAMPLES_PER_FRAME * delta:
+                self.timestamp_jumps += 1
+        self._last_seq = seq
+        self._last_ts = timestamp
+
+        # J += (|D| - J) / 16 with D the change in transit time, all in timestamp units
+        transit = arrival * SAMPLING_RATE - timestamp
+        if self._last_transit is not None:
+            self.jitter += (abs(transit - self._last_transit) - self.jitter) / 16
+        self._last_transit = transit
+
+    def summary(self):
+        duration = (self.last_arrival - self.first_arrival) if self.packets > 1 else 0.0
+        return {
+            'ssrc': self.ssrc,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'duration_s': duration,
+            'pps': (self.packets - 1) / duration if duration else 0.0,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'timestamp_jumps': self.timestamp_jumps,
+            'jitter_ms': self.jitter / SAMPLING_RATE * 1000,
+            'max_gap_ms': self.max_gap * 1000,
+            # perf_counter is CLOCK_MONOTONIC, so these compare with the sender's clock
+            'first_arrival': self.first_arrival,
+            'last_arrival': self.last_arrival,
+        }
+
+
+def _serve(sock, conn):
+    streams = {}
+    while True:
+        readable, _, _ = select.select([sock, conn], [], [])
+        if sock in readable:
+            # Drain everything queued before looking at commands again
+            while True:
+                try:
+                    data = sock.recv(2048)
+                except BlockingIOError:
+                    break
+                arrival = time.perf_counter()
+                if len(data) < RTP_HEADER.size:
+                    continue
+                _, _, seq, timestamp, ssrc = RTP_HEADER.unpack_from(data)
+                stats = streams.get(ssrc)
+                if stats is None:
+                    stats = streams[ssrc] = StreamStats(ssrc)
+                stats.add(seq, timestamp, len(data), arrival)
+        if conn in readable:
+            command = conn.recv()
+            if command == 'stats':
+                conn.send([s.summary() for s in streams.values()])
+            elif command == 'reset':
+                streams.clear()
+                conn.send(True)
+            elif command == 'stop':
+                conn.send(True)
+                return
+
+
+def _endpoint_main(conn, host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind((host, 0))
+    sock.setblocking(False)
+    conn.send(sock.getsockname())
+    try:
+        _serve(sock, conn)
+    finally:
+        sock.close()
+
+
+class FakeVoiceEndpoint:
+    """UDP voice receiver in a child process; `address` is where clients send"""
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.address = None
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        # spawn: the bot under test runs threads, which don't mix with fork
+        context = multiprocessing.get_context('spawn')
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=_endpoint_main, args=(child, self.host),
+                                        name='fake-voice-endpoint', daemon=True)
+        self._process.start()
+        self.address = self._conn.recv()
+        return self.address
+
+    def _call(self, command):
+        with self._lock:
+            self._conn.send(command)
+            return self._conn.recv()
+
+    def stats(self):
+        """Summaries of every stream received since start (or the last reset)"""
+        return self._call('stats')
+
+    def reset(self):
+        self._call('reset')
+
+    def stop(self):
+        if self._process is None:
+            return
+        try:
+            self._call('stop')
+        except (EOFError, OSError):
+            pass
+        self._process.join(timeout=2)
+        if self._process.is_alive():
+            self._process.kill()
+        self._process = None
+
+
+class RTPVoiceClient(FakeVoiceClient):
+    """FakeVoiceClient that puts each packet on the wire to a FakeVoiceEndpoint"""
+
+    _ssrcs = iter(range(1, 2 ** 32))
+
+    def __init__(self, channel, loop, endpoint):
+        super().__init__(channel, loop)
+        self.endpoint = endpoint
+        self.ssrc = next(self._ssrcs)
+        self.sequence = 0
+        self.timestamp = 0
+        self._header = bytearray(RTP_HEADER.size)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send_audio_packet(self, data, encode=True):
+        super().send_audio_packet(data, encode)
+        # Same bookkeeping as discord.py's VoiceClient.send_audio_packet
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        RTP_HEADER.pack_into(self._header, 0, 0x80, 0x78, self.sequence, self.timestamp, self.ssrc)
+        try:
+            self._socket.sendto(bytes(self._header) + data, self.endpoint)
+        except OSError:
+            pass  # Dropped, like discord.py does
+        self.timestamp = (self.timestamp + SAMPLES_PER_FRAME) & 0xFFFFFFFF
+
+    async def disconnect(self, force=False):
+        await super().disconnect(force)
+        self._socket.close()
@@ -0,0 +1,250 @@
+"""Stand-in for shairport-sync: feeds the audio and metadata FIFOs like a playing iPhone would.
+
+Writes s16le 44.1 kHz stereo PCM (a generated signal or a WAV file) in AirPlay-sized
+chunks at realtime or a multiple of it, and the metadata item stream: play begin/end,
+per-track ssnc/core bundles, PICT cover art, progress and volume.
+
+Usage: python benchmarks/shairport_standin.py [--audio-pipe /tmp/shairport-sync-audio]
+           [--metadata-pipe /tmp/shairport-sync-metadata] [--wav song.wav] [--speed 1.0]
+"""
+import argparse
+import base64
+import errno
+import io
+import os
+import random
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pcm_audio import INPUT_SAMPLE_RATE, INPUT_BYTES_PER_SECOND, CHANNELS, SAMPLE_WIDTH  # noqa: E402
+
+# shairport-sync outputs an AirPlay packet's worth of audio at a time
+CHUNK_FRAMES = 352
+CHUNK_BYTES = CHUNK_FRAMES * CHANNELS * SAMPLE_WIDTH
+
+
+def generate_pcm(seconds, seed=0):
+    """A music-like test signal: a slow chord progression with an envelope and a little noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * INPUT_SAMPLE_RATE)) / INPUT_SAMPLE_RATE
+    roots = 220 * 2 ** (rng.integers(0, 12, size=max(1, int(seconds // 2) + 1)) / 12)
+    root = roots[(t // 2).astype(int)]
+    envelope = 0.6 + 0.4 * np.sin(2 * np.pi * 0.5 * t)
+    left = envelope * (0.3 * np.sin(2 * np.pi * root * t) + 0.15 * np.sin(2 * np.pi * root * 1.5 * t))
+    right = envelope * (0.3 * np.sin(2 * np.pi * root * 1.25 * t) + 0.15 * np.sin(2 * np.pi * root * 2 * t))
+    stereo = np.stack([left, right], axis=1) + 0.01 * rng.standard_normal((t.size, 2))
+    return np.clip(stereo * 32767, -32768, 32767).astype('<i2').tobytes()
+
+
+def load_wav(path):
+    """s16le stereo PCM from a 16-bit 44.1 kHz WAV file (mono is duplicated to both channels)"""
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != SAMPLE_WIDTH or wav.getframerate() != INPUT_SAMPLE_RATE:
+            raise ValueError(f"{path}: need 16-bit {INPUT_SAMPLE_RATE} Hz audio, got "
+                             f"{wav.getsampwidth() * 8}-bit {wav.getframerate()} Hz")
+        channels = wav.getnchannels()
+        frames = wav.readframes(wav.getnframes())
+    samples = np.frombuffer(frames, dtype='<i2').reshape(-1, channels)
+    if channels == 1:
+        samples = np.repeat(samples, 2, axis=1)
+    elif channels > 2:
+        samples = samples[:, :2]
+    return samples.astype('<i2').tobytes()
+
+
+def make_cover(seed, size=600):
+    """A JPEG roughly the size of real album art (noise doesn't compress, like photos)"""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    base = np.stack([gradient[None, :].repeat(size, 0), gradient[:, None].repeat(size, 1),
+                     np.full((size, size), rng.integers(0, 255), dtype=np.float32)], axis=2)
+    pixels = np.clip(base + rng.normal(0, 40, base.shape), 0, 255).astype(np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, format='JPEG', quality=90)
+    return out.getvalue()
+
+
+def item(item_type, code, data=None):
+    """One item exactly as shairport-sync writes it to the metadata pipe"""
+    header = (f"<item><type>{item_type.encode().hex()}</type><code>{code.encode().hex()}</code>"
+              f"<length>{len(data) if data else 0}</length>").encode()
+    if data is None:
+        return header + b"</item>\n"
+    return header + b"\n<data encoding=\"base64\">\n" + base64.b64encode(data) + b"</data></item>\n"
+
+
+class ShairportStandIn:
+    """Writes PCM and metadata into the two FIFOs until stopped
+
+    speed: 1.0 is realtime, 2.0 twice as fast, 0 as fast as the reader allows.
+    Track changes, progress and volume items are scheduled on the same scaled clock.
+    """
+
+    def __init__(self, audio_path, metadata_path, pcm, speed=1.0, track_seconds=20.0,
+                 progress_interval=1.0, volume_interval=5.0, albums=3, cover_art=True, seed=0):
+        self.audio_path = audio_path
+        self.metadata_path = metadata_path
+        self.pcm = pcm
+        self.speed = speed
+        self.track_seconds = track_seconds
+        self.progress_interval = progress_interval
+        self.volume_interval = volume_interval
+        self.albums = albums
+        self.covers = [make_cover(seed + n) for n in range(albums)] if cover_art else []
+        self.random = random.Random(seed)
+
+        self.pcm_bytes_written = 0
+        self.items_written = 0
+        self.tracks_started = 0
+        self.cpu_seconds = 0.0  # Our own writer threads, so a benchmark can subtract it
+        self._cpu_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+        for path in (audio_path, metadata_path):
+            if not os.path.exists(path):
+                os.mkfifo(path)
+
+    def start(self):
+        self._stop.clear()
+        self.started_at = time.perf_counter()
+        self._threads = [
+            threading.Thread(target=self._audio_writer, name='standin-audio', daemon=True),
+            threading.Thread(target=self._metadata_writer, name='standin-metadata', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        # A writer still blocked in open() waits for a reader; give it one so it can see the stop
+        for path in (self.audio_path, self.metadata_path):
+            try:
+                os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _sleep_until(self, media_time):
+        """Wait until `media_time` seconds of audio should have been played"""
+        if self.speed <= 0:
+            return
+        delay = self.started_at + media_time / self.speed - time.perf_counter()
+        if delay > 0:
+            self._stop.wait(delay)
+
+    def _account_cpu(self, started):
+        with self._cpu_lock:
+            self.cpu_seconds += time.thread_time() - started
+
+    def _audio_writer(self):
+        cpu_started = time.thread_time()
+        pcm = memoryview(self.pcm)
+        offset = 0
+        try:
+            with open(self.audio_path, 'wb', buffering=0) as pipe:
+                while not self._stop.is_set():
+                    if offset + CHUNK_BYTES > len(pcm):
+                        offset = 0  # Loop the clip
+                    pipe.write(pcm[offset:offset + CHUNK_BYTES])
+                    offset += CHUNK_BYTES
+                    self.pcm_bytes_written += CHUNK_BYTES
+                    self._sleep_until(self.pcm_bytes_written / INPUT_BYTES_PER_SECOND)
+        except BrokenPipeError:
+            pass
+        finally:
+            self._account_cpu(cpu_started)
+
+    def _metadata_writer(self):
+        cpu_started = time.thread_time()
+        try:
+            with open(self.metadata_path, 'wb', buffering=0) as pipe:
+                def write(*items):
+                    pipe.write(b''.join(items))
+                    self.items_written += len(items)
+
+                write(item('ssnc', 'pbeg'))
+                media_time = 0.0
+                next_track = next_progress = next_volume = 0.0
+                track_start = 0
+                while not self._stop.is_set():
+                    if media_time >= next_track:
+                        track_start = int(media_time * INPUT_SAMPLE_RATE)
+                        write(*self._track_items())
+                        next_track += self.track_seconds
+                    if media_time >= next_progress:
+                        position = track_start + int((media_time % self.track_seconds) * INPUT_SAMPLE_RATE)
+                        end = track_start + int(self.track_seconds * INPUT_SAMPLE_RATE)
+                        write(item('ssnc', 'prgr', f"{track_start}/{position}/{end}".encode()))
+                        next_progress += self.progress_interval
+                    if media_time >= next_volume:
+                        volume = -self.random.uniform(0, 30)
+                        write(item('ssnc', 'pvol', f"{volume:.2f},{volume:.2f},-96.30,0.00".encode()))
+                        next_volume += self.volume_interval
+                    media_time = min(next_track, next_progress, next_volume)
+                    self._sleep_until(media_time)
+                write(item('ssnc', 'pend'))
+        except BrokenPipeError:
+            pass
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            self._account_cpu(cpu_started)
+
+    def _track_items(self):
+        n = self.tracks_started
+        self.tracks_started += 1
+        album = n % self.albums if self.albums else 0
+        items = [item('ssnc', 'mdst', b'1234567')]
+        for code, value in (('minm', f"Track {n}"), ('asar', f"Stand-in Artist {album}"),
+                            ('asal', f"Stand-in Album {album}"), ('asgn', 'Electronic'),
+                            ('astm', str(int(self.track_seconds * 1000))), ('caps', '1')):
+            items.append(item('core', code, value.encode()))
+        items.append(item('ssnc', 'mden', b'1234567'))
+        if self.covers:
+            # Albums repeat, so the bot's cover art cache sees both misses and hits
+            items += [item('ssnc', 'pcst', b'1234567'), item('ssnc', 'PICT', self.covers[album]),
+                      item('ssnc', 'pcen', b'1234567')]
+        return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--audio-pipe', default='/tmp/shairport-sync-audio')
+    parser.add_argument('--metadata-pipe', default='/tmp/shairport-sync-metadata')
+    parser.add_argument('--wav', help='16-bit 44.1 kHz WAV file to play (default: generated signal)')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 = realtime, 0 = as fast as possible')
+    parser.add_argument('--track-seconds', type=float, default=20.0)
+    parser.add_argument('--seconds', type=float, default=0, help='stop after this long (default: run until Ctrl+C)')
+    parser.add_argument('--no-cover-art', action='store_true')
+    args = parser.parse_args()
+
+    pcm = load_wav(args.wav) if args.wav else generate_pcm(30)
+    standin = ShairportStandIn(args.audio_pipe, args.metadata_pipe, pcm, speed=args.speed,
+                               track_seconds=args.track_seconds, cover_art=not args.no_cover_art)
+    print(f"Writing to {args.audio_pipe} and {args.metadata_pipe} (waiting for readers)...")
+    standin.start()
+    try:
+        deadline = time.monotonic() + args.seconds if args.seconds else None
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(1)
+            seconds = standin.pcm_bytes_written / INPUT_BYTES_PER_SECOND
+            print(f"\r{seconds:8.1f} s audio, {standin.items_written} metadata items, "
+                  f"{standin.tracks_started} tracks", end='', flush=True)
+    except KeyboardInterrupt:
+        pass
+    print()
+    standin.stop()
+
+
+if __name__ == '__main__':
+    main()
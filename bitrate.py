@@ -0,0 +1,62 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BitrateController:
+    """Chooses the Opus bitrate for one shared stream, in kbps
+
+    The ceiling is the configured bitrate, lowered to the smallest bitrate cap of the voice
+    channels listening. Below that it is AIMD: when the voice senders fall behind or have to
+    skip packets, the bitrate is cut by `decrease`. After `recover_after` clean checks in a
+    row it rises again by `increase`.
+    """
+
+    def __init__(self, maximum=128, minimum=32, increase=16, decrease=0.75, recover_after=3,
+                 max_skip_ratio=0.01, max_lag_frames=3):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.recover_after = recover_after
+        self.max_skip_ratio = max_skip_ratio
+        self.max_lag_frames = max_lag_frames
+        self.bitrate = maximum
+        self.ceiling = maximum
+        self.reason = 'configured maximum'
+        self.decreases = 0
+        self._clean_checks = 0
+
+    def limit(self, caps):
+        """Apply the listening channels' caps (kbps, None if unknown) right away; returns the bitrate"""
+        known = [cap for cap in caps if cap]
+        self.ceiling = min([self.maximum] + known)
+        if self.bitrate >= self.ceiling:
+            self.bitrate = self.ceiling
+            self.reason = 'lowest channel cap' if self.ceiling < self.maximum else 'configured maximum'
+        return self.bitrate
+
+    def update(self, caps, sent, skipped, peak_lag):
+        """One health check; returns the new bitrate
+
+        caps: bitrate caps of the listening channels in kbps (None for unknown)
+        sent / skipped: frames the voice senders sent and skipped since the last check
+        peak_lag: most frames any sender had queued since the last check
+        """
+        previous = self.bitrate
+        skip_ratio = skipped / (sent + skipped) if sent + skipped else 0.0
+        if skip_ratio > self.max_skip_ratio or peak_lag > self.max_lag_frames:
+            self._clean_checks = 0
+            self.bitrate = max(self.minimum, int(self.bitrate * self.decrease))
+            self.reason = f"skipped {skip_ratio:.1%}" if skip_ratio > self.max_skip_ratio else f"send lag {peak_lag} frames"
+        else:
+            self._clean_checks += 1
+            if self._clean_checks >= self.recover_after and self.bitrate < self.ceiling:
+                self._clean_checks = 0
+                self.bitrate += self.increase
+                self.reason = 'recovering'
+
+        self.limit(caps)
+        if self.bitrate < previous:
+            self.decreases += 1
+        return self.bitrate
@@ -0,0 +1,361 @@
+import logging
+import threading
+import time
+import traceback
+
+import discord
+from discord.opus import Encoder as OpusEncoder
+from discord.player import OPUS_SILENCE
+
+from ring_buffer import pin_current_thread
+from metrics import FRAMES_ENCODED, FRAMES_SENT, PCM_TO_SEND_LATENCY, SOURCE_SWAP_GAP, VOICE_RECONNECTS, VOICE_RECONNECT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+FRAME_DELAY = OpusEncoder.FRAME_LENGTH / 1000.0
+
+
+class StreamBroadcaster:
+    """Reads one upstream Opus source on a 20 ms clock and shares each packet with every subscriber
+
+    With `warm_standby` a second, fully initialised source is kept ready. `swap()` (and
+    an unexpected end of the active source) replaces the active source with it between
+    two frames, so a restart costs at most one frame instead of a rebuild. Only sources
+    that don't consume input until their first read() can be kept warm; FFmpeg reads the
+    pipe as soon as it starts, so without `warm_standby` the replacement is built at
+    swap time instead.
+
+    `cpus` pins the broadcaster thread, which does the encoding, to a set of cores.
+    """
+
+    # Packets kept for subscribers that are briefly behind the producer
+    BACKLOG = 16
+    # A subscriber further behind than this skips ahead to keep latency bounded
+    MAX_LAG = 5
+
+    def __init__(self, source_factory, on_finished=None, latency=None, max_lag=None, warm_standby=False,
+                 cpus=None, name=None):
+        self.source_factory = source_factory
+        self.on_finished = on_finished
+        self.latency = latency
+        self.warm_standby = warm_standby
+        self.cpus = cpus
+        self.thread_name = f"stream-broadcaster-{name}" if name else 'stream-broadcaster'
+        if max_lag is not None:
+            self.MAX_LAG = max_lag
+        self.source = None
+        self.subscribers = {}
+        self.frames_published = 0
+        self.swaps = 0
+        self.last_swap_gap = None
+        self._packets = [None] * self.BACKLOG
+        self._origins = [None] * self.BACKLOG
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._standby = None
+        self._standby_lock = threading.Lock()
+        self._standby_building = False
+        self._swap_requested = threading.Event()
+        self._swapped = threading.Event()
+        self._last_publish = None
+        self._swap_pending_since = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start reading the upstream source in a background thread"""
+        if self.is_running():
+            return
+        self._stop_event = threading.Event()
+        self._swap_requested.clear()
+        self._thread = threading.Thread(target=self._run, args=(self._stop_event,),
+                                        name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the upstream reader; subscribers keep sending silence until they unsubscribe"""
+        self._stop_event.set()
+        thread = self._thread
+        self._thread = None
+        source = self.source
+        if source is not None:
+            # Unblocks a read() waiting on FFmpeg or the pipe
+            source.cleanup()
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=0.5)
+        with self._standby_lock:
+            standby, self._standby = self._standby, None
+        if standby is not None:
+            standby.cleanup()
+
+    def has_standby(self):
+        return self._standby is not None
+
+    def swap(self, timeout=0.5):
+        """Replace the active source between two frames; returns the measured gap in seconds
+
+        Returns None if this swap produced no packet within `timeout` (or the broadcaster
+        stopped). Blocks the caller (not the event loop: run it in an executor) until the
+        swap is done.
+        """
+        if not self.is_running():
+            self.start()
+            return None
+        old = self.source
+        # Only a gap measured by this swap is reported
+        self.last_swap_gap = None
+        self._swapped.clear()
+        self._swap_requested.set()
+        if not self._swapped.wait(FRAME_DELAY * 2) and old is not None:
+            # The active source is stuck in read(); closing it makes the read return.
+            # It is being replaced either way, so this never touches the new source.
+            old.cleanup()
+            if not self._swapped.wait(timeout):
+                return None
+        return self.last_swap_gap
+
+    def set_bitrate(self, kbps):
+        """Change the bitrate of the active and standby sources without rebuilding them
+
+        Returns False if the active source can't change it at runtime (FFmpeg); the
+        source factory should then use the new bitrate for the next source it builds.
+        """
+        applied = False
+        for source in (self.source, self._standby):
+            set_bitrate = getattr(source, 'set_bitrate', None)
+            if set_bitrate is not None:
+                set_bitrate(kbps)
+                applied = applied or source is self.source
+        return applied
+
+    def subscribe(self, key):
+        """Create (or replace) the audio source a voice client plays for `key`"""
+        self.unsubscribe(key)
+        with self._cond:
+            subscriber = BroadcastAudio(self, key, self._seq)
+            self.subscribers[key] = subscriber
+        return subscriber
+
+    def unsubscribe(self, key):
+        with self._cond:
+            subscriber = self.subscribers.pop(key, None)
+            if subscriber:
+                subscriber.closed = True
+                self._cond.notify_all()
+
+    def publish(self, packet, origin=None):
+        """Hand one encoded packet to every subscriber without copying it"""
+        with self._cond:
+            self._packets[self._seq % self.BACKLOG] = packet
+            self._origins[self._seq % self.BACKLOG] = origin
+            self._seq += 1
+            self.frames_published += 1
+            self._cond.notify_all()
+
+    def _build_source(self):
+        source = self.source_factory()
+        prime = getattr(source, 'prime', None)
+        if prime is not None:
+            prime()
+        return source
+
+    def _prepare_standby(self):
+        """Build the next standby source off the streaming thread"""
+        if not self.warm_standby:
+            return
+        with self._standby_lock:
+            if self._standby is not None or self._standby_building:
+                return
+            self._standby_building = True
+
+        def build():
+            try:
+                source = self._build_source()
+            except Exception as e:
+                logger.error(f"Could not prepare standby audio source: {e}")
+                source = None
+            finally:
+                with self._standby_lock:
+                    self._standby_building = False
+            if source is None:
+                return
+            with self._standby_lock:
+                if self._standby is None and not self._stop_event.is_set():
+                    self._standby, source = source, None
+            if source is not None:
+                source.cleanup()
+
+        threading.Thread(target=build, name='stream-standby', daemon=True).start()
+
+    def _take_standby(self):
+        with self._standby_lock:
+            standby, self._standby = self._standby, None
+        if standby is None:
+            # Nothing warm (or warm standby is off): build one now
+            standby = self._build_source()
+        self._prepare_standby()
+        return standby
+
+    def _swap_in(self, old):
+        """Make the next source active; the old one is closed off the streaming thread"""
+        new = self._take_standby()
+        self.source = new
+        self.swaps += 1
+        self._swap_pending_since = self._last_publish or time.perf_counter()
+        threading.Thread(target=old.cleanup, name='stream-cleanup', daemon=True).start()
+        return new
+
+    def _run(self, stop_event):
+        pin_current_thread(self.cpus)
+        error = None
+        source = None
+        self._swap_pending_since = None
+        self._last_publish = None
+        try:
+            source = self._build_source()
+            self.source = source
+            self._prepare_standby()
+            start = time.perf_counter()
+            loops = 0
+
+            while not stop_event.is_set():
+                if self._swap_requested.is_set():
+                    self._swap_requested.clear()
+                    source = self._swap_in(source)
+
+                packet = source.read()
+                if not packet:
+                    if stop_event.is_set():
+                        break
+                    if self._swap_requested.is_set():
+                        continue  # Closed by swap() to get out of a stuck read
+                    error = getattr(source, '_current_error', None)
+                    if self.has_standby():
+                        logger.warning(f"Audio source ended ({error}), switching to the standby source")
+                        source = self._swap_in(source)
+                        error = None
+                        continue
+                    break
+
+                self.publish(packet, getattr(source, 'last_origin', None))
+                now = time.perf_counter()
+                if self._swap_pending_since is not None:
+                    # Time from the old source's last packet to the new source's first
+                    self.last_swap_gap = now - self._swap_pending_since
+                    SOURCE_SWAP_GAP.observe(self.last_swap_gap)
+                    self._swap_pending_since = None
+                    self._swapped.set()
+                self._last_publish = now
+                if packet is not OPUS_SILENCE:
+                    FRAMES_ENCODED.inc()
+                loops += 1
+
+                next_time = start + FRAME_DELAY * loops
+                if now - next_time > 0.2:
+                    # The source blocked (e.g. waiting for a writer); restart the clock
+                    start = now
+                    loops = 0
+                    continue
+                if next_time > now:
+                    time.sleep(next_time - now)
+
+        except Exception as e:
+            logger.error(f"Broadcaster error: {e}")
+            logger.error(traceback.format_exc())
+            error = e
+        finally:
+            if source is not None:
+                source.cleanup()
+            if self.source is source:
+                self.source = None
+            self._swapped.set()
+
+        if not stop_event.is_set() and self.on_finished:
+            self.on_finished(error)
+
+
+class BroadcastAudio(discord.AudioSource):
+    """Per-voice-client view onto a StreamBroadcaster's packets
+
+    `connected`, if set, tells whether the voice connection is up. While discord.py
+    resumes a dropped connection its player reads one frame and then waits; that read
+    gets silence, and the first read after the connection is back continues from the
+    newest packet instead of sending what queued up during the outage.
+    """
+
+    def __init__(self, broadcaster, key, next_seq):
+        self.broadcaster = broadcaster
+        self.key = key
+        self.closed = False
+        self.frames_sent = 0
+        self.underruns = 0
+        self.skipped = 0
+        # Most packets waiting for this voice client at once; reset by whoever reads it
+        self.peak_lag = 0
+        self.connected = None
+        self.resumes = 0
+        self._disconnected_at = None
+        self._next = next_seq
+        self._sent_metric = FRAMES_SENT.labels(key)
+
+    def read(self):
+        broadcaster = self.broadcaster
+        connected = self.connected
+        if connected is not None:
+            if not connected():
+                if self._disconnected_at is None:
+                    self._disconnected_at = time.perf_counter()
+                return OPUS_SILENCE
+            if self._disconnected_at is not None:
+                outage = time.perf_counter() - self._disconnected_at
+                self._disconnected_at = None
+                self.resumes += 1
+                VOICE_RECONNECTS.inc()
+                VOICE_RECONNECT_SECONDS.labels('resume').observe(outage)
+                logger.info(f"Voice connection for guild {self.key} resumed after {outage * 1000:.0f} ms")
+                self.resync()
+        with broadcaster._cond:
+            # Wait for the producer, but never stall the voice player for long
+            broadcaster._cond.wait_for(
+                lambda: self.closed or self._next < broadcaster._seq,
+                timeout=FRAME_DELAY * 2
+            )
+            if self.closed:
+                return b''
+
+            latest = broadcaster._seq
+            if latest - self._next > self.peak_lag:
+                self.peak_lag = latest - self._next
+            if self._next >= latest:
+                # Nothing new yet: keep the voice session alive with silence
+                self.underruns += 1
+                return OPUS_SILENCE
+
+            if latest - self._next > broadcaster.MAX_LAG:
+                self.skipped += latest - 1 - self._next
+                self._next = latest - 1
+
+            packet = broadcaster._packets[self._next % broadcaster.BACKLOG]
+            origin = broadcaster._origins[self._next % broadcaster.BACKLOG]
+            self._next += 1
+
+        self.frames_sent += 1
+        self._sent_metric.inc()
+        if origin is not None and broadcaster.latency is not None:
+            # The voice player sends the packet as soon as read() returns
+            elapsed = time.perf_counter() - origin
+            broadcaster.latency.record(elapsed)
+            PCM_TO_SEND_LATENCY.observe(elapsed)
+        return packet
+
+    def resync(self):
+        """Continue from the newest packet, e.g. after the voice client was paused"""
+        self._disconnected_at = None
+        with self.broadcaster._cond:
+            self._next = max(self._next, self.broadcaster._seq - 1)
+
+    def is_opus(self):
+        return True
@@ -0,0 +1,98 @@
+import collections
+import io
+import logging
+import time
+
+import discord
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Discord CDN attachment links are signed and expire; don't reuse one for longer than this
+URL_TTL = 12 * 60 * 60
+
+
+class CoverArt:
+    """One thumbnail, addressed by the SHA-1 of the original image"""
+
+    def __init__(self, digest, thumbnail, extension):
+        self.digest = digest
+        self.thumbnail = thumbnail
+        self.filename = f"cover_{digest[:16]}.{extension}"
+        self.url = None
+        self.url_time = 0.0
+
+    def cached_url(self):
+        if self.url and time.time() - self.url_time < URL_TTL:
+            return self.url
+        return None
+
+    def message_kwargs(self, embed):
+        """send() kwargs showing this art on `embed`: the cached URL if we have one, else an upload
+
+        Built right before each send attempt: discord.py closes File objects once sent.
+        """
+        url = self.cached_url()
+        if url:
+            embed.set_thumbnail(url=url)
+            return {'embed': embed}
+        embed.set_thumbnail(url=f"attachment://{self.filename}")
+        return {'embed': embed, 'file': discord.File(io.BytesIO(self.thumbnail), filename=self.filename)}
+
+    def remember_upload(self, message):
+        """Keep the CDN URL of our uploaded thumbnail so other guilds and repeats skip the upload"""
+        for embed in message.embeds:
+            if embed.thumbnail and embed.thumbnail.url and self.filename in embed.thumbnail.url:
+                self.url = embed.thumbnail.url
+                self.url_time = time.time()
+                return
+
+
+class CoverArtCache:
+    """Size-bounded LRU of cover-art thumbnails keyed by image hash
+
+    Each distinct image is downscaled once; repeated tracks and every guild share the
+    resulting thumbnail and, after the first upload, its attachment URL.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, size=320):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest):
+        art = self._entries.get(digest)
+        if art is not None:
+            self._entries.move_to_end(digest)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return art
+
+    def make_thumbnail(self, data):
+        """Downscale an image to embed size; returns (bytes, extension). CPU-bound: run in an executor"""
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft('RGB', (self.size, self.size))  # Lets JPEG decode at reduced scale
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size))
+            out = io.BytesIO()
+            image.save(out, format='JPEG', quality=85, optimize=True)
+        return out.getvalue(), 'jpg'
+
+    def add(self, digest, thumbnail, extension):
+        art = self._entries.get(digest)
+        if art is not None:
+            return art
+        art = CoverArt(digest, thumbnail, extension)
+        self._entries[digest] = art
+        self.total_bytes += len(thumbnail)
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted.thumbnail)
+        return art
@@ -0,0 +1,71 @@
+import collections
+
+
+class DriftEstimator:
+    """Estimates the drift between shairport-sync's PCM clock and our 20 ms frame clock
+
+    shairport-sync writes PCM paced by the AirPlay clock, while frames are drained on the
+    host's monotonic clock. Any rate difference shows up as a jitter buffer fill that
+    slowly rises or falls. The fill is averaged over blocks of `block_frames` frames, and
+    the slope of a least-squares line through the last `window_blocks` block averages,
+    plus the correction that was applied meanwhile, is the drift. The correction handed
+    back is that drift plus a term that walks the fill back to `target` within
+    `settle_seconds`, limited to +-`max_ppm`.
+
+    Positive values mean shairport-sync runs fast: the backlog grows, so more input is
+    consumed per frame.
+    """
+
+    def __init__(self, target, bytes_per_second, frame_seconds=0.02, block_frames=50, window_blocks=30,
+                 min_blocks=5, settle_seconds=60.0, max_ppm=1000.0):
+        self.target = target
+        self.bytes_per_second = bytes_per_second
+        self.block_seconds = frame_seconds * block_frames
+        self.block_frames = block_frames
+        self.min_blocks = min_blocks
+        self.settle_seconds = settle_seconds
+        self.max_ppm = max_ppm
+        self.drift_ppm = 0.0
+        self.correction_ppm = 0.0
+        self.resets = 0
+        self._blocks = collections.deque(maxlen=window_blocks)  # (mean fill, correction ppm)
+        self._fill_sum = 0
+        self._frames = 0
+
+    def reset(self):
+        """Forget the history, e.g. after an underrun or dropped audio broke the fill curve"""
+        self._blocks.clear()
+        self._fill_sum = 0
+        self._frames = 0
+        self.correction_ppm = 0.0
+        self.resets += 1
+
+    def update(self, fill):
+        """Account for the fill after one frame was drained; returns the correction as a rate ratio"""
+        self._fill_sum += fill
+        self._frames += 1
+        if self._frames >= self.block_frames:
+            self._blocks.append((self._fill_sum / self._frames, self.correction_ppm))
+            self._fill_sum = 0
+            self._frames = 0
+            self._estimate()
+        return self.correction_ppm * 1e-6
+
+    def _estimate(self):
+        blocks = self._blocks
+        count = len(blocks)
+        if count < self.min_blocks:
+            return
+        # Least-squares slope of the block means, in bytes per block
+        mean_x = (count - 1) / 2
+        mean_y = sum(fill for fill, _ in blocks) / count
+        covariance = sum((index - mean_x) * (fill - mean_y) for index, (fill, _) in enumerate(blocks))
+        variance = sum((index - mean_x) ** 2 for index in range(count))
+        slope = covariance / variance / self.block_seconds / self.bytes_per_second * 1e6
+        # The fill only shows what the current correction leaves over
+        applied = sum(correction for _, correction in blocks) / count
+        self.drift_ppm = slope + applied
+
+        error_seconds = (blocks[-1][0] - self.target) / self.bytes_per_second
+        correction = self.drift_ppm + error_seconds / self.settle_seconds * 1e6
+        self.correction_ppm = max(-self.max_ppm, min(self.max_ppm, correction))
@@ -0,0 +1,49 @@
+import collections
+import threading
+
+
+class LatencyTracker:
+    """Measures how long PCM takes from leaving the FIFO to its Opus packet being sent
+
+    The FIFO reader marks the absolute byte position and time of every chunk it reads;
+    the encoder looks up when the first byte of each frame arrived, and the voice sender
+    records the difference once the packet goes out.
+    """
+
+    def __init__(self, max_samples=3000, max_marks=4096):
+        self._marks = collections.deque(maxlen=max_marks)  # (end byte position, perf_counter)
+        self._samples = collections.deque(maxlen=max_samples)  # seconds
+        self._lock = threading.Lock()
+
+    def mark_read(self, end_pos, timestamp):
+        """Called by the FIFO reader after bytes up to `end_pos` were read at `timestamp`"""
+        self._marks.append((end_pos, timestamp))
+
+    def origin_of(self, byte_pos):
+        """Time the byte at `byte_pos` left the FIFO, or None if it is no longer known"""
+        marks = self._marks
+        # Chunks ending at or before this position are fully consumed and can be dropped
+        while marks and marks[0][0] <= byte_pos:
+            marks.popleft()
+        return marks[0][1] if marks else None
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+    def percentiles(self, points=(50, 95, 99)):
+        """Return {'count': n, 50: seconds, 95: seconds, ...} over the recent window"""
+        with self._lock:
+            samples = sorted(self._samples)
+        result = {'count': len(samples)}
+        for point in points:
+            if samples:
+                index = min(len(samples) - 1, int(round(point / 100 * (len(samples) - 1))))
+                result[point] = samples[index]
+            else:
+                result[point] = None
+        return result
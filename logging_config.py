@@ -0,0 +1,148 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z'
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records when the writer falls behind instead of blocking the caller"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge the arguments and render the traceback now, but leave formatting to the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitedLogger:
+    """Passes on at most `burst` messages per `interval` seconds from each call site
+
+    For log lines that can repeat per frame or per metadata item. Suppressed messages
+    are counted, and the count is appended to the next one that gets through.
+    """
+
+    def __init__(self, logger, interval=10.0, burst=1):
+        self.logger = logger
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # key -> [window start, messages passed, messages suppressed]
+        self._lock = threading.Lock()
+
+    def _allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                return True, suppressed
+            if window[1] < self.burst:
+                window[1] += 1
+                return True, 0
+            window[2] += 1
+            return False, 0
+
+    def _log(self, level, msg, args, key, kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if key is None:
+            caller = sys._getframe(2)
+            key = (caller.f_code.co_filename, caller.f_lineno)
+        allowed, suppressed = self._allow(key)
+        if not allowed:
+            return
+        if suppressed:
+            msg = f"{msg} ({suppressed} similar messages suppressed)"
+        # Report the caller's line, not ours
+        self.logger.log(level, msg, *args, stacklevel=3, **kwargs)
+
+    def debug(self, msg, *args, key=None, **kwargs):
+        self._log(logging.DEBUG, msg, args, key, kwargs)
+
+    def info(self, msg, *args, key=None, **kwargs):
+        self._log(logging.INFO, msg, args, key, kwargs)
+
+    def warning(self, msg, *args, key=None, **kwargs):
+        self._log(logging.WARNING, msg, args, key, kwargs)
+
+    def error(self, msg, *args, key=None, **kwargs):
+        self._log(logging.ERROR, msg, args, key, kwargs)
+
+
+def setup_logging(log_dir, level='INFO', json_format=False, max_bytes=10 * 1024 * 1024, backups=5,
+                  queue_size=10000):
+    """Send every log record through a queue to a background writer thread
+
+    Callers on the event loop and the audio threads only enqueue. The file (rotated at
+    `max_bytes`, keeping `backups` old files) and the console are written by a
+    QueueListener. Returns the queue handler, whose `dropped` counts records lost to a full queue.
+    """
+    formatter = JSONFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, 'bot.log'), maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+        ))
+    except OSError as e:
+        sys.stderr.write(f"Not logging to {log_dir}: {e}\n")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener.start()
+    # Flush what's queued on exit
+    atexit.register(listener.stop)
+    return queue_handler
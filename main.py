@@ -2,500 +2,787 @@ import discord
 from discord.ext import commands
 import asyncio
 import os
-import json
-import base64
-import xml.etree.ElementTree as ET
 import logging
 import traceback
-import threading
 import time
-from discord import FFmpegPCMAudio, FFmpegOpusAudio
-
-# Set up comprehensive logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/logs/bot.log', mode='a'),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+from discord import FFmpegOpusAudio
+from discord import opus
+from pcm_audio import PCMOpusAudio, SilenceDetector, VolumeControl, FRAME_MS, INPUT_FRAME_BYTES, INPUT_BYTES_PER_SECOND
+from ring_buffer import PCMRingBuffer, FIFOReader, FIFOHolder
+from latency import LatencyTracker
+from metadata_parser import ShairportMetadataParser
+from metadata_reader import MetadataPipeReader
+from announcer import TrackCoalescer, ChannelAnnouncer
+from cover_art import CoverArtCache
+from stream_health import StreamSupervisor, Stage
+from broadcast import StreamBroadcaster
+from bitrate import BitrateController
+from drift import DriftEstimator
+from audio_worker import AudioWorker, WorkerAudio
+import metrics
+from metrics import MetricsServer, LoopLagMonitor, VOICE_RECONNECT_SECONDS
+from logging_config import setup_logging, RateLimitedLogger
+from process_supervisor import read_status, describe_status
+from receivers import load_receivers
+from play_history import PlayHistory
+from profiler import ProfileRun
 
 # Load environment variables from .env file
 import load_env
 
+# Logging goes through a queue; a background thread writes the console and the rotated file
+LOG_DIR = os.getenv('LOG_DIR', '/app/logs')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # 'text' or 'json'
+LOG_MAX_MB = int(os.getenv('LOG_MAX_MB', '10'))  # rotate bot.log at this size
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+log_handler = setup_logging(LOG_DIR, level=LOG_LEVEL, json_format=(LOG_FORMAT == 'json'),
+                            max_bytes=LOG_MAX_MB * 1024 * 1024, backups=LOG_BACKUPS)
+logger = logging.getLogger(__name__)
+# Append-only log of every track played, for !history and !top (empty disables it)
+PLAY_HISTORY_DIR = os.getenv('PLAY_HISTORY_DIR', os.path.join(LOG_DIR, 'play_history'))
+# Full !profile dumps are written here
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(LOG_DIR, 'profiles'))
+PROFILE_MAX_SECONDS = 120
+# For messages that can repeat per metadata item
+log_throttled = RateLimitedLogger(logger)
+
 # Bot configuration
 TOKEN = os.getenv('DISCORD_BOT_TOKEN')  # Set your bot token as environment variable
 PIPE_PATH = os.getenv('SHAIRPORT_PIPE_PATH', '/tmp/shairport-sync-audio')  # Use env var or default
-METADATA_PIPE_PATH = '/tmp/shairport-sync-metadata'
+METADATA_PIPE_PATH = os.getenv('SHAIRPORT_METADATA_PIPE_PATH', '/tmp/shairport-sync-metadata')
+METADATA_READ_SIZE = 65536
+# Several AirPlay receivers, each routed to its own guilds (receivers.example.json); unset = one receiver on the pipes above
+RECEIVERS_CONFIG = os.getenv('RECEIVERS_CONFIG')
+AIRPLAY_NAME = os.getenv('AIRPLAY_NAME', 'Bizzitybot')
+RECEIVERS = load_receivers(RECEIVERS_CONFIG, PIPE_PATH, METADATA_PIPE_PATH, AIRPLAY_NAME)
+# Metadata items we act on; everything else is skipped without decoding
+METADATA_ITEMS = {
+    'core': {'minm', 'asar', 'asal'},  # title, artist, album
+    'ssnc': {'mden',  # end of a track's metadata
+             'pvol',  # AirPlay volume
+             'pbeg', 'pend', 'pfls', 'prsm'},  # play begin/end, pause (flush), resume
+}
+# Cover art thumbnails kept in memory, in MB (0 disables cover art)
+COVER_ART_CACHE_MB = int(os.getenv('COVER_ART_CACHE_MB', '16'))
+# Streamed rather than buffered: PICT items are often hundreds of KB
+METADATA_STREAMED = {'ssnc': {'PICT'}} if COVER_ART_CACHE_MB else {}
+# How long to wait for the rest of a track's fields when no mden marker arrives
+ANNOUNCE_WINDOW_MS = int(os.getenv('ANNOUNCE_WINDOW_MS', '1500'))
+# A stage making no progress for this long is restarted
+STALL_TIMEOUT_MS = int(os.getenv('STALL_TIMEOUT_MS', '1000'))
+# Stop encoding and sending after this much silence (0 disables), and what counts as silent
+SILENCE_TIMEOUT_MS = int(os.getenv('SILENCE_TIMEOUT_MS', '10000'))
+SILENCE_THRESHOLD = int(os.getenv('SILENCE_THRESHOLD', '16'))  # peak int16 amplitude
+# Longer rate-limit waits raise instead of sleeping, so stale announcements can be dropped
+MAX_RATELIMIT_WAIT = 10
+# Prometheus text-format metrics at http://METRICS_HOST:METRICS_PORT/metrics (port 0 disables)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# 'ffmpeg', 'native' (in-process Opus) or 'process' (the native engine in a worker process)
+AUDIO_ENGINE = os.getenv('AUDIO_ENGINE', 'ffmpeg').lower()
+PCM_ENGINES = ('native', 'process')  # Engines that read the PCM themselves rather than through FFmpeg
+AUDIO_BITRATE = int(os.getenv('AUDIO_BITRATE', '128'))  # kbps, the most the adaptive bitrate goes to
+AUDIO_BITRATE_MIN = int(os.getenv('AUDIO_BITRATE_MIN', '32'))  # kbps; set to AUDIO_BITRATE for a fixed bitrate
+BITRATE_CHECK_SECONDS = 2
+# !history shows at most this many plays; units for "what played <n>m ago"
+HISTORY_LINES = 20
+HISTORY_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+# dB of attenuation the AirPlay volume slider spans; the native and process engines apply it themselves
+VOLUME_RANGE_DB = float(os.getenv('VOLUME_RANGE_DB', '60'))
+# Largest rate correction for clock drift between shairport-sync and the frame clock, in ppm (0 disables)
+DRIFT_MAX_PPM = float(os.getenv('DRIFT_MAX_PPM', '1000'))
+
+# Streaming profiles trade robustness against delay between AirPlay and Discord
+STREAM_PROFILES = {
+    'standard': {
+        'ffmpeg_before_options': '-re -f s16le -ar 44100 -ac 2',
+        'ffmpeg_options': '-vn -ar 48000 -ac 2 -b:a {bitrate}k -f opus',
+        'opus_application': opus.APPLICATION_AUDIO,
+        'jitter_buffer_ms': 100,
+        'jitter_buffer_max_ms': 1000,
+        'max_lag_frames': 5,
+    },
+    'lowlatency': {
+        # The pipe is already paced by shairport-sync, so no -re; skip probing and
+        # flush every 20 ms packet in its own Ogg page instead of the default 1 s pages
+        'ffmpeg_before_options': '-fflags nobuffer -flags low_delay -probesize 32 -analyzeduration 0 -f s16le -ar 44100 -ac 2',
+        'ffmpeg_options': '-vn -ar 48000 -ac 2 -b:a {bitrate}k -application lowdelay -frame_duration 20 -page_duration 20000 -flush_packets 1 -f opus',
+        'opus_application': opus.APPLICATION_LOWDELAY,
+        'jitter_buffer_ms': 40,
+        'jitter_buffer_max_ms': 300,
+        'max_lag_frames': 2,
+    },
+}
+STREAM_PROFILE = os.getenv('STREAM_PROFILE', 'standard').lower()
+PROFILE = STREAM_PROFILES.get(STREAM_PROFILE, STREAM_PROFILES['standard'])
+
+# Native engine jitter buffer: how much PCM to hold before draining, and the hard limit
+JITTER_BUFFER_MS = int(os.getenv('JITTER_BUFFER_MS', PROFILE['jitter_buffer_ms']))
+JITTER_BUFFER_MAX_MS = int(os.getenv('JITTER_BUFFER_MAX_MS', PROFILE['jitter_buffer_max_ms']))
 
 # Bot setup with intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = commands.Bot(command_prefix='!', intents=intents, max_ratelimit_timeout=MAX_RATELIMIT_WAIT)
 
-class AudioBot(commands.Cog):
-    def __init__(self, bot):
+class GuildSession:
+    """Voice connection and announcement channel for one guild, and the receiver it plays"""
+    def __init__(self, guild_id, voice_client, text_channel, receiver):
+        self.guild_id = guild_id
+        self.voice_client = voice_client
+        self.text_channel = text_channel
+        self.receiver = receiver
+        self.subscriber = None
+        self.reconnecting = False
+
+class Receiver:
+    """One AirPlay receiver's pipeline: PCM reader, encoder, metadata and the guilds listening to it
+
+    Receivers share only the event loop, the cover art cache and the announcement queues.
+    Each one has its own reader and encoder threads, pinned to its own cores when several
+    receivers run, and its own stage supervisor. A stall or restart in one receiver doesn't
+    touch the others.
+    """
+    def __init__(self, config, bot, cover_art, announcer_for, history=None):
+        self.config = config
+        self.name = config.name
         self.bot = bot
-        self.voice_client = None
-        self.audio_source = None
-        self.current_channel = None
-        self.metadata_task = None
-        self.keepalive_task = None
-        self.heartbeat_task = None
-        self.metadata_thread = None
-        self.metadata_stop_event = None
+        self.announcer_for = announcer_for
+        self.history = history
+        self.sessions = {}  # guild id -> GuildSession playing this receiver
+        # FIFO-to-send latency, measured by the native engine
+        self.latency = LatencyTracker()
+        # One reader/encoder shared by every guild's voice client
+        self.broadcaster = StreamBroadcaster(
+            self.create_audio_source,
+            on_finished=self.on_stream_finished,
+            latency=self.latency,
+            max_lag=PROFILE['max_lag_frames'],
+            # Native sources only read the shared jitter buffer, so a primed spare can wait
+            # alongside the active one; FFmpeg would start consuming the pipe
+            warm_standby=(AUDIO_ENGINE in PCM_ENGINES),
+            cpus=config.cpus,
+            name=config.name
+        )
+        # Native engine: the pipe is read into a jitter buffer that outlives encoder restarts
+        self.pcm_buffer = PCMRingBuffer(
+            capacity=INPUT_BYTES_PER_SECOND * JITTER_BUFFER_MAX_MS // 1000,
+            frame_bytes=INPUT_FRAME_BYTES,
+            target_depth=INPUT_BYTES_PER_SECOND * JITTER_BUFFER_MS // 1000
+        )
+        self.fifo_reader = FIFOReader(config.audio_pipe, self.pcm_buffer, latency=self.latency,
+                                      cpus=config.cpus, name=config.name)
+        # The bot holds the pipe open itself, so a client disconnecting is not EOF for the reader
+        self.fifo_holder = FIFOHolder(config.audio_pipe)
+        # Process engine: the same reader and encoder in a child process, packets come back
+        # through shared memory; its jitter buffer and silence detector live there too
+        self.audio_worker = None
+        if AUDIO_ENGINE == 'process':
+            self.audio_worker = AudioWorker(
+                config.audio_pipe,
+                bitrate=AUDIO_BITRATE,
+                application=PROFILE['opus_application'],
+                capacity=self.pcm_buffer.capacity,
+                frame_bytes=INPUT_FRAME_BYTES,
+                target_depth=self.pcm_buffer.target_depth,
+                silence_threshold=SILENCE_THRESHOLD,
+                idle_after_frames=SILENCE_TIMEOUT_MS // FRAME_MS,
+                volume_range_db=VOLUME_RANGE_DB,
+                drift_max_ppm=DRIFT_MAX_PPM,
+                cpus=config.cpus,
+                name=config.name,
+                log_level=LOG_LEVEL
+            )
+            self.pcm_buffer = self.audio_worker.ring
+        # Opus bitrate: capped by the listening channels, lowered while voice senders struggle
+        self.bitrate_control = BitrateController(
+            maximum=AUDIO_BITRATE,
+            minimum=AUDIO_BITRATE_MIN,
+            max_lag_frames=min(3, PROFILE['max_lag_frames'])
+        )
+        self.bitrate_task = None
+        # AirPlay volume from pvol metadata; shairport-sync applies it only for the FFmpeg engine
+        self.airplay_volume = 0.0
+        self.volume = VolumeControl(VOLUME_RANGE_DB) if AUDIO_ENGINE == 'native' else None
+        # Keeps the jitter buffer at its target although shairport-sync's clock runs slightly off ours
+        self.drift = None
+        if DRIFT_MAX_PPM and AUDIO_ENGINE == 'native':
+            self.drift = DriftEstimator(self.pcm_buffer.target_depth, INPUT_BYTES_PER_SECOND, max_ppm=DRIFT_MAX_PPM)
+        # Idle suspension: voice clients are paused while nothing but silence comes in
+        self.silence = None
+        if SILENCE_TIMEOUT_MS and AUDIO_ENGINE == 'native':
+            self.silence = SilenceDetector(SILENCE_THRESHOLD, idle_after_frames=SILENCE_TIMEOUT_MS // FRAME_MS)
+        self.stream_idle = False
+        self.idle_suspensions = 0
+        self.idle_timer = None  # FFmpeg engine: idles on the AirPlay session ending instead
+        # Metadata is read on the event loop; items go straight to process_metadata_item
+        self.metadata_reader = MetadataPipeReader(
+            config.metadata_pipe,
+            ShairportMetadataParser(METADATA_ITEMS, streamed=METADATA_STREAMED),
+            self.process_metadata_item,
+            read_size=METADATA_READ_SIZE
+        )
+        # One announcement per track, sent through a queue per text channel
+        self.track_coalescer = TrackCoalescer(
+            self.on_track,
+            window=ANNOUNCE_WINDOW_MS / 1000,
+            art_grace=1.0 if COVER_ART_CACHE_MB else None
+        )
+        self.cover_art = cover_art
+        self.current_art = None
+        self.latest_art_digest = None
+        self.track_generation = 0  # bumped on every track change, so late artwork can't land on the next track
         self.current_song = {"title": None, "artist": None, "album": None}
-        self.last_heartbeat = asyncio.get_event_loop().time()
+        # Watches throughput of each stage and restarts only the one that stalls
+        self.stream_wanted = False
+        self.airplay_active = False
+        self.airplay_sessions = 0
+        self.session_started = None
+        self.supervisor = StreamSupervisor(
+            stall_seconds=STALL_TIMEOUT_MS / 1000,
+            on_breaker_open=self.on_breaker_open
+        )
+        self.supervisor.add_stage(Stage(
+            'encoder',
+            # With a worker the broadcaster only relays, and fills gaps with silence
+            progress=lambda: self.audio_worker.frames_produced if self.audio_worker else self.broadcaster.frames_published,
+            restart=self.restart_encoder,
+            alive=lambda: self.encoder_running() if self.stream_wanted else None,
+            # FFmpeg blocks on an idle pipe; the native engine sends silence instead
+            expected=lambda: self.stream_wanted and self.worker_ready() and (AUDIO_ENGINE in PCM_ENGINES or self.airplay_active)
+        ))
+        if AUDIO_ENGINE in PCM_ENGINES:
+            self.supervisor.add_stage(Stage(
+                'pcm_reader',
+                progress=lambda: self.pcm_buffer.bytes_written,
+                restart=self.restart_reader,
+                alive=lambda: self.reader_running() if self.stream_wanted else None,
+                expected=lambda: self.stream_wanted and self.airplay_active and self.worker_ready()
+            ))
 
-    @commands.command(name='join')
-    async def join_channel(self, ctx):
-        """Join the voice channel and start streaming ultra-high quality audio from shairport-sync"""
-        try:
-            # Check if user is in a voice channel
-            if not ctx.author.voice:
-                await ctx.send("You need to be in a voice channel first!")
-                return
+    def worker_ready(self):
+        """False while the audio worker process starts up; stalls are only timed once it's ready"""
+        return self.audio_worker is None or self.audio_worker.ready()
 
-            channel = ctx.author.voice.channel
-            
-            # Disconnect from current channel if already connected
-            if self.voice_client and self.voice_client.is_connected():
-                await self.voice_client.disconnect()
+    def encoder_running(self):
+        worker = self.audio_worker
+        if worker is not None:
+            if worker.restarting:
+                return None
+            if not worker.is_running():
+                return False
+        return self.broadcaster.is_running()
 
-            # Join the voice channel
-            self.voice_client = await channel.connect()
-            self.current_channel = ctx.channel  # Store text channel for announcements
-            await ctx.send(f"Joined {channel.name} with ultra-high quality audio!")
-
-            # Start streaming ultra-high quality audio
-            await self.start_audio_stream()
-            
-            # Start metadata monitoring (now with non-blocking implementation)
+    def reader_running(self):
+        worker = self.audio_worker
+        if worker is not None:
+            return worker.reader_running if worker.ready() else None
+        return self.fifo_reader.is_running()
+
+    def footer(self):
+        """Embed footer; names the AirPlay target when there are several"""
+        if len(RECEIVERS) > 1:
+            return f"Via AirPlay ({self.config.airplay_name}) • Ultra-HQ Audio"
+        return "Via AirPlay • Ultra-HQ Audio"
+
+    async def start(self):
+        """Start the stream, metadata monitoring, stage supervisor and bitrate control unless they're running"""
+        # The first source starts at the listening channels' cap
+        self.apply_channel_caps()
+        await self.start_audio_stream()
+        if not self.metadata_reader.is_running():
             await self.start_metadata_monitoring()
-            
-            # Start keepalive task
-            await self.start_keepalive()
-            
-            # Start heartbeat monitoring
-            await self.start_heartbeat()
+        self.supervisor.start()
+        if not self.bitrate_task or self.bitrate_task.done():
+            self.bitrate_task = asyncio.create_task(self.adapt_bitrate())
 
-        except Exception as e:
-            await ctx.send(f"Error joining channel: {str(e)}")
+    async def stop_pipeline(self):
+        """Stop the stream, metadata monitoring and the stage supervisor"""
+        self.stream_wanted = False
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.broadcaster.stop)
+        await loop.run_in_executor(None, self.fifo_reader.stop)
+        if self.audio_worker is not None:
+            await loop.run_in_executor(None, self.audio_worker.stop)
+        self.fifo_holder.close()
+        self.pcm_buffer.reset()
+        self.cancel_idle_timer()
+        self.stream_idle = False
+        if self.silence:
+            self.silence.reset()
 
-    @commands.command(name='leave')
-    async def leave_channel(self, ctx):
-        """Leave the voice channel and stop streaming"""
+        # Stop metadata monitoring
+        self.metadata_reader.stop()
+
+        # Stop the stream health supervisor
+        self.supervisor.stop()
+
+        if self.bitrate_task:
+            self.bitrate_task.cancel()
+            self.bitrate_task = None
+
+    def channel_caps(self):
+        """Bitrate limit of each listening voice channel in kbps (None where unknown)"""
+        caps = []
+        for session in list(self.sessions.values()):
+            bitrate = getattr(session.voice_client.channel, 'bitrate', None)
+            caps.append(bitrate // 1000 if bitrate else None)
+        return caps
+
+    def set_bitrate(self, kbps):
+        """Switch the encoder to `kbps` between two frames"""
+        if self.audio_worker is not None:
+            self.audio_worker.set_bitrate(kbps)
+        if not self.broadcaster.set_bitrate(kbps) and self.broadcaster.is_running() and AUDIO_ENGINE == 'ffmpeg':
+            logger.info(f"FFmpeg can't change bitrate while running; {self.name} uses {kbps} kbps from its next restart")
+
+    def apply_channel_caps(self):
+        """Drop to the lowest channel cap right away, e.g. when a guild in a lower-bitrate channel joins"""
+        previous = self.bitrate_control.bitrate
+        kbps = self.bitrate_control.limit(self.channel_caps())
+        if kbps != previous:
+            logger.info(f"Opus bitrate for {self.name}: {previous} -> {kbps} kbps ({self.bitrate_control.reason})")
+            self.set_bitrate(kbps)
+
+    async def adapt_bitrate(self):
+        """Every few seconds, move the bitrate with the channel caps and the voice senders' health"""
+        control = self.bitrate_control
+        baselines = {}  # subscriber -> (frames sent, frames skipped) at the last check
         try:
-            if self.voice_client and self.voice_client.is_connected():
-                # Stop any playing audio
-                if self.voice_client.is_playing():
-                    self.voice_client.stop()
-                
-                # Stop metadata monitoring
-                if self.metadata_task:
-                    self.metadata_task.cancel()
-                    self.metadata_task = None
-                
-                # Stop metadata thread
-                if self.metadata_thread:
-                    if self.metadata_stop_event:
-                        self.metadata_stop_event.set()
-                    if self.metadata_thread.is_alive():
-                        self.metadata_thread.join(timeout=2)
-                
-                # Stop keepalive
-                if self.keepalive_task:
-                    self.keepalive_task.cancel()
-                    self.keepalive_task = None
-                
-                # Stop heartbeat
-                if self.heartbeat_task:
-                    self.heartbeat_task.cancel()
-                    self.heartbeat_task = None
-                
-                # Disconnect from voice channel
-                await self.voice_client.disconnect()
-                self.voice_client = None
-                self.current_channel = None
-                await ctx.send("Left the voice channel!")
-            else:
-                await ctx.send("I'm not in a voice channel!")
+            while True:
+                await asyncio.sleep(BITRATE_CHECK_SECONDS)
+                sent = skipped = peak_lag = 0
+                current = {}
+                for session in list(self.sessions.values()):
+                    subscriber = session.subscriber
+                    if subscriber is None:
+                        continue
+                    current[subscriber] = (subscriber.frames_sent, subscriber.skipped)
+                    last_sent, last_skipped = baselines.get(subscriber, current[subscriber])
+                    sent += subscriber.frames_sent - last_sent
+                    skipped += subscriber.skipped - last_skipped
+                    peak_lag = max(peak_lag, subscriber.peak_lag)
+                    subscriber.peak_lag = 0
+                baselines = current
 
+                previous = control.bitrate
+                kbps = control.update(self.channel_caps(), sent, skipped, peak_lag)
+                if kbps != previous:
+                    logger.info(f"Opus bitrate for {self.name}: {previous} -> {kbps} kbps ({control.reason})")
+                    self.set_bitrate(kbps)
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            await ctx.send(f"Error leaving channel: {str(e)}")
+            logger.error(f"Bitrate control error for {self.name}: {e}")
+
+    def attach_voice(self, session):
+        """Play the shared stream on a guild's voice client
+
+        A session that is still subscribed keeps its subscriber, counters and all, and
+        continues from the newest packet; only a new session subscribes.
+        """
+        voice_client = session.voice_client
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+        subscriber = session.subscriber
+        if subscriber is None or subscriber.closed:
+            subscriber = session.subscriber = self.broadcaster.subscribe(session.guild_id)
+        else:
+            subscriber.resync()
+        subscriber.connected = voice_client.is_connected
+        guild_id = session.guild_id
+        voice_client.play(
+            subscriber,
+            after=lambda e: logger.info(f"Voice playback ended for guild {guild_id}. Error: {e}")
+        )
+        self.apply_idle(session)
+        self.apply_channel_caps()
+
+        # Supervise this guild's sender; kept across re-attaches so backoff carries over
+        name = f"voice:{guild_id}"
+        if name not in self.supervisor.stages:
+            async def restart():
+                if self.sessions.get(guild_id) is session:
+                    self.attach_voice(session)
+
+            def progress():
+                subscriber = session.subscriber
+                return subscriber.frames_sent + subscriber.underruns if subscriber else None
+
+            def alive():
+                voice_client = session.voice_client
+                if session.reconnecting or not voice_client.is_connected():
+                    return None
+                return voice_client.is_playing() or voice_client.is_paused()
+
+            self.supervisor.add_stage(Stage(
+                name,
+                progress=progress,
+                restart=restart,
+                alive=alive,
+                # A paused sender is idle on purpose
+                expected=lambda: session.voice_client.is_connected() and not session.reconnecting and not self.stream_idle
+            ))
+
+    async def reconnect_voice(self, session, channel):
+        """Replace a guild's voice connection, keeping the pipeline and the guild's subscriber
+
+        Only the voice transport is rebuilt: the reader, encoder, metadata and the
+        subscriber's position in the stream carry on. The new connection starts with the
+        newest packet as soon as it's up. Returns the seconds without a voice connection.
+        """
+        session.reconnecting = True
+        started = time.perf_counter()
+        try:
+            old = session.voice_client
+            # Stopping the player leaves the subscriber subscribed
+            old.stop()
+            await old.disconnect(force=True)
+            session.voice_client = await channel.connect()
+            self.attach_voice(session)
+        finally:
+            session.reconnecting = False
+        elapsed = time.perf_counter() - started
+        metrics.VOICE_RECONNECTS.inc()
+        VOICE_RECONNECT_SECONDS.labels('command').observe(elapsed)
+        logger.info(f"Voice connection for guild {session.guild_id} replaced in {elapsed * 1000:.0f} ms")
+        return elapsed
+
+    def detach_voice(self, session):
+        """Stop a guild's voice client playing the shared stream"""
+        self.supervisor.remove_stage(f"voice:{session.guild_id}")
+        self.broadcaster.unsubscribe(session.guild_id)
+        session.subscriber = None
+        if session.voice_client.is_playing() or session.voice_client.is_paused():
+            session.voice_client.stop()
+
+    def apply_idle(self, session):
+        """Pause or resume one guild's sender to match the stream's idle state"""
+        voice_client = session.voice_client
+        if self.stream_idle:
+            if voice_client.is_playing():
+                # discord.py sends its trailing silence frames and stops transmitting
+                voice_client.pause()
+        elif voice_client.is_paused():
+            if session.subscriber:
+                # Skip the silence published while paused and start with the newest packet
+                session.subscriber.resync()
+            voice_client.resume()
+
+    def set_idle(self, idle):
+        """Suspend every voice sender while the stream is silent, resume on the first audio"""
+        if idle == self.stream_idle:
+            return
+        self.stream_idle = idle
+        if idle:
+            self.idle_suspensions += 1
+            logger.info(f"No audio on {self.name} for {SILENCE_TIMEOUT_MS} ms, suspending voice senders")
+        else:
+            logger.info(f"Audio resumed on {self.name}, resuming voice senders")
+        for session in list(self.sessions.values()):
+            self.apply_idle(session)
+
+    def on_idle_change(self, idle):
+        """Called from the broadcaster thread when the silence detector changes state"""
+        self.bot.loop.call_soon_threadsafe(self.set_idle, idle)
+
+    def cancel_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    async def notify(self, message):
+        """Queue a message for the announcement channel of every guild on this receiver"""
+        for session in list(self.sessions.values()):
+            if session.text_channel:
+                self.announcer_for(session.text_channel).submit(content=message)
 
     async def start_audio_stream(self):
-        """Start streaming ultra-high quality audio with advanced processing"""
+        """Start the shared ultra-high quality audio stream if it isn't already running"""
+        path = self.config.audio_pipe
         try:
-            logger.info("Starting audio stream...")
-            if not self.voice_client:
+            if self.broadcaster.is_running():
+                return
+
+            logger.info(f"Starting audio stream for {self.name}...")
+            if not self.sessions:
                 logger.warning("No voice client available")
                 return
 
             # Check if audio pipe exists and has data
-            if not os.path.exists(PIPE_PATH):
-                logger.error(f"Audio pipe {PIPE_PATH} does not exist!")
+            if not os.path.exists(path):
+                logger.error(f"Audio pipe {path} does not exist!")
                 return
 
-            # Simpler, more stable FFmpeg options
-            ffmpeg_options = {
-                'before_options': '-re -f s16le -ar 44100 -ac 2',
-                'options': '-vn -ar 48000 -ac 2 -b:a 128k -f opus'
-            }
-
-            logger.info(f"Creating audio source from {PIPE_PATH}")
-            # Create audio source
-            audio_source = FFmpegOpusAudio(
-                source=PIPE_PATH,
-                **ffmpeg_options
-            )
+            logger.info(f"Creating {AUDIO_ENGINE} audio source from {path}")
+            self.stream_wanted = True
+            # Hold the pipe before any reader opens it; it stays open across AirPlay sessions
+            self.fifo_holder.open()
+            if AUDIO_ENGINE == 'native':
+                self.fifo_reader.start()
+            elif AUDIO_ENGINE == 'process':
+                self.audio_worker.start()
 
-            # Start playing the audio with a callback to handle disconnections
-            logger.info("Starting playback...")
-            self.voice_client.play(
-                audio_source, 
-                after=lambda e: asyncio.run_coroutine_threadsafe(
-                    self.handle_audio_finished(e), 
-                    self.bot.loop
-                )
-            )
-            logger.info(f"Audio stream started successfully from {PIPE_PATH}")
+            # Read and encode once; every voice client subscribes to the same packets
+            self.broadcaster.start()
+            logger.info(f"Audio stream started successfully from {path}")
 
         except Exception as e:
             logger.error(f"Error starting audio stream: {str(e)}")
             logger.error(traceback.format_exc())
-            if self.current_channel:
-                try:
-                    await self.current_channel.send(f"❌ Failed to start audio stream: {str(e)}")
-                except:
-                    pass
+            await self.notify(f"❌ Failed to start audio stream: {str(e)}")
+
+    async def restart_encoder(self):
+        """Swap in a fresh audio source between two frames; voice clients stay subscribed"""
+        if not self.stream_wanted:
+            return
+        loop = asyncio.get_running_loop()
+        if self.audio_worker is not None:
+            # The encoder is the worker process; voice clients get silence until the new one's first packet
+            await loop.run_in_executor(None, self.audio_worker.restart)
+            logger.info(f"Audio worker for {self.name} restarted (pid {self.audio_worker.pid})")
+            self.broadcaster.start()
+            return
+        if not self.broadcaster.is_running():
+            if AUDIO_ENGINE == 'ffmpeg' or not self.fifo_reader.is_running():
+                # Audio that queued up while nothing read the pipe would only add latency.
+                # A running native reader still feeds the jitter buffer, so it isn't drained then
+                self.fifo_holder.drain()
+            self.broadcaster.start()
+            return
+        gap = await loop.run_in_executor(None, self.broadcaster.swap)
+        if gap is not None:
+            logger.info(f"Audio source for {self.name} swapped, gap {gap * 1000:.1f} ms")
+        else:
+            logger.warning(f"Audio source swap for {self.name} produced no packet yet; the supervisor keeps watching")
+
+    async def restart_reader(self):
+        """Reopen the PCM pipe; the jitter buffer keeps what it already holds"""
+        if self.audio_worker is not None:
+            # The reader runs inside the worker
+            await self.restart_encoder()
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.fifo_reader.stop)
+        if self.stream_wanted:
+            self.fifo_reader.start()
+
+    def on_breaker_open(self, stage, reason):
+        """A stage kept failing; stop retrying it and tell the listeners"""
+        asyncio.create_task(self.notify(
+            f"❌ Audio {stage} keeps failing ({reason}). Auto-restart paused; use `!restart` or `!reconnect`"
+        ))
+
+    def on_stream_finished(self, error):
+        """Called from the broadcaster thread when the upstream source ends"""
+        asyncio.run_coroutine_threadsafe(self.handle_audio_finished(error), self.bot.loop)
+
+    def create_audio_source(self):
+        """Build the audio source for the configured engine"""
+        if AUDIO_ENGINE == 'native':
+            # Resample and encode in-process, no FFmpeg subprocess
+            return PCMOpusAudio(
+                self.pcm_buffer,
+                bitrate=self.bitrate_control.bitrate,
+                application=PROFILE['opus_application'],
+                latency=self.latency,
+                silence=self.silence,
+                volume=self.volume,
+                drift=self.drift,
+                on_idle_change=self.on_idle_change
+            )
+        if AUDIO_ENGINE == 'process':
+            # Relays the worker's packets; encoding happens in the worker process
+            return WorkerAudio(self.audio_worker, on_idle_change=self.on_idle_change)
+
+        ffmpeg_options = {
+            'before_options': PROFILE['ffmpeg_before_options'],
+            'options': PROFILE['ffmpeg_options'].format(bitrate=self.bitrate_control.bitrate)
+        }
+        return FFmpegOpusAudio(
+            source=self.config.audio_pipe,
+            **ffmpeg_options
+        )
 
     async def handle_audio_finished(self, error):
         """Handle when audio stream finishes or errors"""
-        logger.info(f"Audio finished callback triggered. Error: {error}")
+        logger.info(f"Audio finished callback triggered for {self.name}. Error: {error}")
         if error:
             logger.error(f'Audio stream error: {error}')
-            print(f'Audio stream error: {error}')
             # Notify about the error in Discord
-            if self.current_channel:
-                try:
-                    await self.current_channel.send(f"⚠️ Audio stream error: {str(error)}")
-                except Exception as e:
-                    logger.error(f"Failed to send error message: {e}")
-            
-            # Try to restart the audio stream after a brief delay
-            await asyncio.sleep(3)
-            if self.voice_client and self.voice_client.is_connected():
-                logger.info("Attempting to restart audio stream after error...")
-                print("Attempting to restart audio stream...")
-                try:
-                    await self.start_audio_stream()
-                    if self.current_channel:
-                        try:
-                            await self.current_channel.send("✅ Audio stream restarted automatically")
-                        except:
-                            pass
-                except Exception as e:
-                    logger.error(f"Failed to restart audio stream: {e}")
-                    print(f"Failed to restart audio stream: {e}")
-                    if self.current_channel:
-                        try:
-                            await self.current_channel.send("❌ Auto-restart failed. Use `!restart` or `!reconnect`")
-                        except:
-                            pass
+            await self.notify(f"⚠️ Audio stream error: {str(error)}")
         else:
             logger.info("Audio stream finished normally")
-            print("Audio stream finished normally")
+
+        # The supervisor restarts just the encoder stage, with backoff
+        if self.stream_wanted:
+            self.supervisor.report_failure('encoder', f"source ended: {error}" if error else "source ended")
 
     async def start_metadata_monitoring(self):
-        """Start monitoring metadata from shairport-sync using a background thread"""
-        # Stop any existing monitoring
-        if self.metadata_thread:
-            if self.metadata_stop_event:
-                self.metadata_stop_event.set()
-            if self.metadata_thread.is_alive():
-                self.metadata_thread.join(timeout=2)
-        
-        # Create new thread with stop event
-        self.metadata_stop_event = threading.Event()
-        self.metadata_thread = threading.Thread(
-            target=self.metadata_thread_worker,
-            daemon=True
-        )
-        self.metadata_thread.start()
-        print("Started metadata monitoring thread")
+        """Start monitoring metadata from shairport-sync on the event loop"""
+        # Restart any existing monitoring
+        self.metadata_reader.stop()
+        self.metadata_reader.start()
+        logger.info(f"Started metadata monitoring for {self.name}")
 
-    def metadata_thread_worker(self):
-        """Background thread worker for metadata monitoring"""
-        try:
-            print("Metadata thread started")
-            xml_buffer = ""
-            
-            while not self.metadata_stop_event.is_set():
-                try:
-                    # Check if metadata pipe exists
-                    if not os.path.exists(METADATA_PIPE_PATH):
-                        print(f"Metadata pipe {METADATA_PIPE_PATH} does not exist, waiting...")
-                        time.sleep(5)
-                        continue
-                    
-                    print(f"Opening metadata pipe: {METADATA_PIPE_PATH}")
-                    
-                    # Open the pipe for reading
-                    with open(METADATA_PIPE_PATH, 'r') as pipe:
-                        print("Metadata pipe opened, waiting for data...")
-                        
-                        while not self.metadata_stop_event.is_set():
-                            try:
-                                line = pipe.readline()
-                                if not line:
-                                    time.sleep(0.1)
-                                    continue
-                                    
-                                line = line.strip()
-                                if not line:
-                                    continue
-                                
-                                xml_buffer += line
-                                print(f"Received metadata line: {line}")
-                                
-                                # Check if we have a complete XML item
-                                if line.endswith('</item>'):
-                                    try:
-                                        # Schedule the processing in the async event loop
-                                        asyncio.run_coroutine_threadsafe(
-                                            self.process_xml_metadata(xml_buffer),
-                                            self.bot.loop
-                                        )
-                                    except Exception as e:
-                                        print(f"Error processing XML metadata: {e}")
-                                    finally:
-                                        xml_buffer = ""
-                                        
-                            except Exception as e:
-                                print(f"Error reading from pipe: {e}")
-                                break
-                                
-                except FileNotFoundError:
-                    print("Metadata pipe not found, waiting...")
-                    time.sleep(5)
-                    continue
-                except Exception as e:
-                    print(f"Error in metadata thread: {e}")
-                    time.sleep(5)
-                    continue
-                    
-        except Exception as e:
-            print(f"Metadata thread exception: {e}")
-        finally:
-            print("Metadata thread stopped")
+    def start_session(self):
+        """An AirPlay client started playing; the pipeline is already warm"""
+        self.airplay_sessions += 1
+        self.session_started = time.monotonic()
+        logger.info(f"AirPlay session {self.airplay_sessions} started on {self.name}")
+        if self.stream_wanted and not self.fifo_holder.is_open():
+            # The pipe may not have existed when the stream started
+            self.fifo_holder.open()
+
+    def end_session(self):
+        """The AirPlay client went away; the reader and encoder keep running for the next one"""
+        if self.session_started is not None:
+            logger.info(f"AirPlay session on {self.name} ended after {time.monotonic() - self.session_started:.0f} s")
+        self.session_started = None
 
-    async def monitor_metadata(self):
-        """Monitor the metadata pipe for song information"""
+    def set_volume(self, payload):
+        """Apply a pvol item (airplay_volume,volume_db,lowest_db,highest_db); only the first field is used"""
         try:
-            print("Starting metadata monitoring...")
-            xml_buffer = ""
-            
-            while True:
-                try:
-                    # Check if metadata pipe exists
-                    if not os.path.exists(METADATA_PIPE_PATH):
-                        print(f"Metadata pipe {METADATA_PIPE_PATH} does not exist, waiting...")
-                        await asyncio.sleep(5)
-                        continue
-                    
-                    print(f"Opening metadata pipe: {METADATA_PIPE_PATH}")
-                    
-                    # Use a simpler approach - read file in chunks with timeout
-                    while True:
-                        try:
-                            # Read the file in a non-blocking way using asyncio
-                            proc = await asyncio.create_subprocess_shell(
-                                f'timeout 1 cat {METADATA_PIPE_PATH}',
-                                stdout=asyncio.subprocess.PIPE,
-                                stderr=asyncio.subprocess.DEVNULL
-                            )
-                            
-                            stdout, _ = await proc.wait()
-                            
-                            if proc.stdout:
-                                data = await proc.stdout.read()
-                                if data:
-                                    lines = data.decode('utf-8', errors='ignore').strip().split('\n')
-                                    for line in lines:
-                                        if not line.strip():
-                                            continue
-                                            
-                                        xml_buffer += line.strip()
-                                        print(f"Received metadata line: {line.strip()}")
-                                        
-                                        # Check if we have a complete XML item
-                                        if line.strip().endswith('</item>'):
-                                            try:
-                                                await self.process_xml_metadata(xml_buffer)
-                                            except Exception as e:
-                                                print(f"Error processing XML metadata: {e}")
-                                            finally:
-                                                xml_buffer = ""
-                            
-                            await asyncio.sleep(0.1)  # Short delay between reads
-                            
-                        except asyncio.TimeoutError:
-                            await asyncio.sleep(1)  # Wait a bit if no data
-                        except Exception as e:
-                            print(f"Error in metadata read loop: {e}")
-                            await asyncio.sleep(2)
-                            break
-                    
-                except FileNotFoundError:
-                    print("Metadata pipe not found, waiting...")
-                    await asyncio.sleep(5)
-                    continue
-                except Exception as e:
-                    print(f"Error reading metadata pipe: {e}")
-                    await asyncio.sleep(5)
-                    continue
-                    
-        except asyncio.CancelledError:
-            print("Metadata monitoring cancelled")
+            airplay_volume = float(payload.split(b',')[0])
+        except ValueError:
+            logger.warning(f"Unparseable volume on {self.name}: {payload[:40]!r}")
+            return
+        self.airplay_volume = airplay_volume
+        if self.volume is not None:
+            self.volume.set_airplay_volume(airplay_volume)
+        elif self.audio_worker is not None:
+            self.audio_worker.set_volume(airplay_volume)
+        logger.debug(f"AirPlay volume on {self.name}: {airplay_volume:.2f}")
+
+    def drift_ppm(self):
+        """(measured clock drift, applied correction) in ppm, or None without compensation"""
+        if self.drift is not None:
+            return self.drift.drift_ppm, self.drift.correction_ppm
+        if self.audio_worker is not None and DRIFT_MAX_PPM:
+            return self.audio_worker.drift()
+        return None
 
-    async def process_xml_metadata(self, xml_data):
-        """Process XML metadata and extract song information"""
+    def volume_text(self):
+        """The AirPlay volume for !status"""
+        if self.airplay_volume <= VolumeControl.MUTE:
+            return "muted"
+        if AUDIO_ENGINE not in PCM_ENGINES:
+            return f"{self.airplay_volume:.1f} of -30..0 (applied by shairport-sync)"
+        return f"{VolumeControl.to_db(self.airplay_volume, VOLUME_RANGE_DB):.1f} dB"
+
+    def process_metadata_item(self, item):
+        """Process one parsed metadata item and extract song information"""
         try:
-            # Parse XML
-            root = ET.fromstring(xml_data)
-            
-            # Extract metadata type and code
-            metadata_type = root.find('type')
-            metadata_code = root.find('code')
-            data_element = root.find('data')
-            
-            if metadata_type is None or metadata_code is None or data_element is None:
-                return
-            
-            # Convert hex codes to readable strings
-            type_hex = metadata_type.text
-            code_hex = metadata_code.text
-            
-            # Convert hex to ASCII
-            type_str = bytes.fromhex(type_hex).decode('ascii', errors='ignore')
-            code_str = bytes.fromhex(code_hex).decode('ascii', errors='ignore')
-            
-            # Only process core metadata
-            if type_str != 'core':
+            # The parser only hands over the items listed in METADATA_ITEMS
+            if item.type == 'ssnc':
+                if item.code == 'mden':  # End of a track's metadata bundle
+                    self.track_coalescer.end_of_metadata()
+                elif item.code == 'PICT':  # Cover art, decoded and hashed by the parser
+                    self.handle_cover_art(item.payload)
+                elif item.code == 'pvol':
+                    self.set_volume(item.payload)
+                elif item.code in ('pbeg', 'prsm'):  # Audio is (again) being written to the pipe
+                    if item.code == 'pbeg':
+                        self.start_session()
+                    self.airplay_active = True
+                    if AUDIO_ENGINE not in PCM_ENGINES:
+                        self.cancel_idle_timer()
+                        self.set_idle(False)
+                elif item.code in ('pend', 'pfls'):
+                    if item.code == 'pend':
+                        self.end_session()
+                    self.airplay_active = False
+                    if AUDIO_ENGINE not in PCM_ENGINES and SILENCE_TIMEOUT_MS:
+                        # FFmpeg reads the pipe itself, so idle on the session event instead of the PCM
+                        self.cancel_idle_timer()
+                        self.idle_timer = asyncio.get_running_loop().call_later(
+                            SILENCE_TIMEOUT_MS / 1000, self.set_idle, True
+                        )
                 return
-            
-            # Decode base64 data
-            if data_element.get('encoding') == 'base64':
-                decoded_data = base64.b64decode(data_element.text).decode('utf-8', errors='ignore')
-            else:
-                decoded_data = data_element.text or ''
-            
-            print(f"Metadata: type={type_str}, code={code_str}, data={decoded_data}")
-            
+
+            decoded_data = item.payload.decode('utf-8', errors='ignore')
+            code_str = item.code
+
+            logger.debug("Metadata (%s): type=%s, code=%s, data=%s", self.name, item.type, code_str, decoded_data)
+
             # Track different metadata types
             song_changed = False
-            
+
             if code_str == 'minm':  # Song title
                 if self.current_song['title'] != decoded_data:
                     self.current_song['title'] = decoded_data
                     song_changed = True
-                    print(f"Song title: {decoded_data}")
+                    logger.info(f"Song title: {decoded_data}")
             elif code_str == 'asar':  # Artist
                 if self.current_song['artist'] != decoded_data:
                     self.current_song['artist'] = decoded_data
                     song_changed = True
-                    print(f"Artist: {decoded_data}")
+                    logger.info(f"Artist: {decoded_data}")
             elif code_str == 'asal':  # Album
                 if self.current_song['album'] != decoded_data:
                     self.current_song['album'] = decoded_data
                     song_changed = True
-                    print(f"Album: {decoded_data}")
+                    logger.info(f"Album: {decoded_data}")
 
-            # Announce new song if we have title and artist
-            if song_changed and self.current_song['title'] and self.current_song['artist']:
-                print("Song changed! Announcing...")
-                await self.announce_song()
+            # Fields arrive one item at a time; announce once per track
+            if song_changed:
+                logger.debug("Song changed, announcing once metadata settles")
+                self.current_art = None
+                self.track_generation += 1
+                self.track_coalescer.changed()
 
         except Exception as e:
-            print(f"Error processing XML metadata: {e}")
+            log_throttled.error(f"Error processing metadata item: {e}")
 
-    async def start_keepalive(self):
-        """Start keepalive task to monitor connection health"""
-        if self.keepalive_task:
-            self.keepalive_task.cancel()
-        
-        self.keepalive_task = asyncio.create_task(self.keepalive_monitor())
+    def handle_cover_art(self, payload):
+        """Attach cover art to the current track, building its thumbnail if it's new"""
+        self.latest_art_digest = payload.digest
+        if not payload.data or self.cover_art is None:
+            self.current_art = None
+            self.track_coalescer.art_ready()
+            return
 
-    async def keepalive_monitor(self):
-        """Monitor connection and restart if needed"""
-        try:
-            while True:
-                await asyncio.sleep(30)  # Check every 30 seconds
-                
-                if not self.voice_client or not self.voice_client.is_connected():
-                    print("Voice client disconnected, stopping keepalive")
-                    break
-                
-                # Check if audio is playing
-                if not self.voice_client.is_playing():
-                    print("Audio not playing, attempting restart...")
-                    try:
-                        await self.start_audio_stream()
-                        print("Audio stream restarted by keepalive")
-                    except Exception as e:
-                        print(f"Keepalive restart failed: {e}")
-                        if self.current_channel:
-                            try:
-                                await self.current_channel.send("🔄 Connection lost. Use `!reconnect` to restore audio.")
-                            except:
-                                pass
-                        break
-                
-        except asyncio.CancelledError:
-            print("Keepalive monitoring cancelled")
+        art = self.cover_art.get(payload.digest)
+        if art is not None:
+            self.current_art = art
+            self.track_coalescer.art_ready()
+            return
+        asyncio.create_task(self.build_cover_art(payload, self.track_generation))
 
-    async def start_heartbeat(self):
-        """Start heartbeat monitoring to detect bot freezes"""
-        if self.heartbeat_task:
-            self.heartbeat_task.cancel()
-        
-        self.heartbeat_task = asyncio.create_task(self.heartbeat_monitor())
-
-    async def heartbeat_monitor(self):
-        """Send heartbeat messages to detect if bot is frozen"""
+    async def build_cover_art(self, payload, generation):
+        """Downscale new artwork off the event loop and cache it by hash"""
         try:
-            while True:
-                await asyncio.sleep(60)  # Heartbeat every minute
-                current_time = asyncio.get_event_loop().time()
-                self.last_heartbeat = current_time
-                logger.info(f"Heartbeat: Bot is alive at {current_time}")
-                print(f"Heartbeat: Bot is alive at {current_time}")
-                
-                # Also check voice client status
-                if self.voice_client:
-                    logger.info(f"Voice status: connected={self.voice_client.is_connected()}, playing={self.voice_client.is_playing()}")
-                    print(f"Voice status: connected={self.voice_client.is_connected()}, playing={self.voice_client.is_playing()}")
-                
-        except asyncio.CancelledError:
-            print("Heartbeat monitoring cancelled")
+            loop = asyncio.get_running_loop()
+            thumbnail, extension = await loop.run_in_executor(None, self.cover_art.make_thumbnail, payload.data)
+            art = self.cover_art.add(payload.digest, thumbnail, extension)
+            # Ignore art that a newer PICT or the next track has superseded while we were scaling
+            if self.art_current(payload, generation):
+                self.current_art = art
         except Exception as e:
-            logger.error(f"Heartbeat error: {e}")
-            print(f"Heartbeat error: {e}")
+            logger.error(f"Could not process cover art: {e}")
+        finally:
+            if self.art_current(payload, generation):
+                self.track_coalescer.art_ready()
 
-    async def process_metadata(self, data):
-        """Legacy JSON metadata processor - kept for compatibility"""
-        # This method is now unused but kept for compatibility
-        pass
+    def art_current(self, payload, generation):
+        return self.latest_art_digest == payload.digest and self.track_generation == generation
 
-    async def announce_song(self):
-        """Announce the current song in the text channel"""
+    def on_track(self):
+        """A track's metadata is complete: log the play, then announce it"""
+        song = self.current_song
+        if self.history is not None and song['title'] and song['artist']:
+            self.history.record(self.name, song['title'], song['artist'], song['album'])
+        self.announce_song()
+
+    def announce_song(self):
+        """Queue a now-playing announcement for the text channel of every guild on this receiver"""
         try:
-            if not self.current_channel:
+            if not self.sessions:
+                return
+            if not (self.current_song['title'] and self.current_song['artist']):
                 return
 
             title = self.current_song['title'] or 'Unknown Title'
@@ -511,21 +798,309 @@ class AudioBot(commands.Cog):
             embed.add_field(name="Artist", value=artist, inline=True)
             if album != 'Unknown Album':
                 embed.add_field(name="Album", value=album, inline=True)
-            
-            embed.set_footer(text="Via AirPlay • Ultra-HQ Audio")
 
-            await self.current_channel.send(embed=embed)
+            embed.set_footer(text=self.footer())
+
+            # A still-queued announcement for an older track is replaced, not sent
+            art = self.current_art
+            for session in list(self.sessions.values()):
+                if not session.text_channel:
+                    continue
+                announcer = self.announcer_for(session.text_channel)
+                if art is None:
+                    announcer.submit(replace_key='now_playing', embed=embed)
+                else:
+                    # The thumbnail is uploaded once, then its URL is reused
+                    announcer.submit(
+                        replace_key='now_playing',
+                        prepare=lambda art=art, embed=embed.copy(): art.message_kwargs(embed),
+                        on_sent=art.remember_upload
+                    )
 
         except Exception as e:
-            print(f"Error announcing song: {e}")
+            logger.error(f"Error announcing song: {e}")
+
+class AudioBot(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.sessions = {}  # guild id -> GuildSession
+        # Thumbnails by image hash, shared by repeated tracks, every receiver and every guild
+        self.cover_art = CoverArtCache(COVER_ART_CACHE_MB * 1024 * 1024) if COVER_ART_CACHE_MB else None
+        # Every play on every receiver, loaded from disk in cog_load
+        self.history = PlayHistory(PLAY_HISTORY_DIR) if PLAY_HISTORY_DIR else None
+        self.announcers = {}  # text channel id -> ChannelAnnouncer
+        # One independent pipeline per AirPlay receiver; !join picks one per guild
+        self.receivers = {
+            config.name: Receiver(config, bot, self.cover_art, self.announcer_for, self.history) for config in RECEIVERS
+        }
+        self.default_receiver = next(r for r in self.receivers.values() if r.config.default)
+        self.heartbeat_task = None
+        self.profile_run = None  # the !profile capture in progress
+        self.last_heartbeat = asyncio.get_event_loop().time()
+        self.metrics_server = MetricsServer(host=METRICS_HOST, port=METRICS_PORT) if METRICS_PORT else None
+        self.loop_lag = LoopLagMonitor()
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Expose counters that already live on pipeline objects, read at scrape time"""
+        registry = metrics.REGISTRY
+
+        def per_receiver(value):
+            return lambda: {('receiver', r.name): value(r) for r in self.receivers.values()}
+
+        registry.callback('metadata_items_parsed_total', 'Metadata items decoded from the pipe',
+                          per_receiver(lambda r: r.metadata_reader.parser.items_parsed), kind='counter')
+        registry.callback('metadata_items_dropped_total', 'Malformed or oversized metadata items discarded',
+                          per_receiver(lambda r: r.metadata_reader.parser.items_dropped), kind='counter')
+        registry.callback('metadata_bytes_read_total', 'Bytes read from the metadata pipe',
+                          per_receiver(lambda r: r.metadata_reader.bytes_read), kind='counter')
+        registry.callback('announcement_queue_depth', 'Messages waiting to be sent, per text channel',
+                          lambda: {('channel', cid): a.depth() for cid, a in self.announcers.items()})
+        registry.callback('announcements_dropped_total', 'Queued announcements superseded before sending',
+                          lambda: sum(a.dropped for a in self.announcers.values()), kind='counter')
+        registry.callback('jitter_buffer_fill_seconds', 'PCM waiting in the jitter buffer (native engine)',
+                          per_receiver(lambda r: r.pcm_buffer.fill() / INPUT_BYTES_PER_SECOND))
+        if self.cover_art is not None:
+            registry.callback('cover_art_cache_bytes', 'Thumbnail bytes held by the cover art cache',
+                              lambda: self.cover_art.total_bytes)
+        if AUDIO_ENGINE in PCM_ENGINES and DRIFT_MAX_PPM:
+            registry.callback('clock_drift_ppm', "shairport-sync's PCM clock against the frame clock (positive: fast)",
+                              per_receiver(lambda r: r.drift_ppm()[0]))
+            registry.callback('drift_correction_ppm', 'Rate correction applied to the PCM to hold the jitter buffer target',
+                              per_receiver(lambda r: r.drift_ppm()[1]))
+        registry.callback('stream_idle', '1 while the stream is suspended for silence',
+                          per_receiver(lambda r: int(r.stream_idle)))
+        registry.callback('airplay_sessions_total', 'AirPlay sessions started (ssnc pbeg)',
+                          per_receiver(lambda r: r.airplay_sessions), kind='counter')
+        registry.callback('idle_suspensions_total', 'Times the stream was suspended for silence',
+                          per_receiver(lambda r: r.idle_suspensions), kind='counter')
+        if AUDIO_ENGINE == 'process':
+            registry.callback('audio_worker_restarts_total', 'Times the audio worker process was replaced',
+                              per_receiver(lambda r: r.audio_worker.restarts), kind='counter')
+        registry.callback('opus_bitrate_kbps', 'Opus bitrate of the stream each guild is playing',
+                          lambda: {('guild', gid): s.receiver.bitrate_control.bitrate for gid, s in self.sessions.items()})
+        registry.callback('bitrate_decreases_total', 'Times the bitrate was lowered for send lag or skipped packets',
+                          per_receiver(lambda r: r.bitrate_control.decreases), kind='counter')
+        if self.history is not None:
+            registry.callback('play_history_plays', 'Plays in the play history', lambda: len(self.history))
+        registry.callback('voice_sessions', 'Guilds with a connected voice client', lambda: len(self.sessions))
+        registry.callback('log_records_dropped_total', 'Log records dropped because the log writer fell behind',
+                          lambda: log_handler.dropped, kind='counter')
+
+    async def cog_load(self):
+        self.loop_lag.start()
+        if self.history is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.history.load)
+                self.history.start()
+            except OSError as e:
+                logger.error(f"Could not open the play history in {PLAY_HISTORY_DIR}: {e}")
+                self.history = None
+                for receiver in self.receivers.values():
+                    receiver.history = None
+        if self.metrics_server:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Could not start metrics server on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+    async def cog_unload(self):
+        self.loop_lag.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        loop = asyncio.get_running_loop()
+        for receiver in self.receivers.values():
+            if receiver.audio_worker is not None:
+                # Stops the worker and frees its shared memory
+                await loop.run_in_executor(None, receiver.audio_worker.close)
+        if self.history is not None:
+            await loop.run_in_executor(None, self.history.close)
+
+    def receiver_for(self, ctx, name=None):
+        """The receiver !join plays in a guild: named explicitly, else routed by voice channel, then guild"""
+        if name:
+            return self.receivers.get(name)
+        channel = ctx.author.voice.channel if ctx.author.voice else None
+        channel_id = getattr(channel, 'id', None)
+        for receiver in self.receivers.values():
+            if channel_id in receiver.config.voice_channels:
+                return receiver
+        for receiver in self.receivers.values():
+            if ctx.guild.id in receiver.config.guilds:
+                return receiver
+        return self.default_receiver
+
+    def receiver_of(self, ctx):
+        """The receiver this guild is playing, or the one it would join"""
+        session = self.sessions.get(ctx.guild.id)
+        return session.receiver if session else self.receiver_for(ctx)
+
+    def add_session(self, session):
+        self.sessions[session.guild_id] = session
+        session.receiver.sessions[session.guild_id] = session
+
+    def drop_session(self, session):
+        """Forget a guild's session and stop its voice client playing the receiver's stream"""
+        if self.sessions.get(session.guild_id) is session:
+            del self.sessions[session.guild_id]
+        session.receiver.sessions.pop(session.guild_id, None)
+        session.receiver.detach_voice(session)
+
+    async def close_session(self, session):
+        """Forget a guild's session and free what only it used: its voice connection, its
+        announcer and, once nobody listens to it, its receiver's pipeline"""
+        self.drop_session(session)
+        if session.voice_client.is_connected():
+            await session.voice_client.disconnect(force=True)
+        self.close_announcer(session.text_channel)
+        await self.release_receiver(session.receiver)
+
+    async def release_receiver(self, receiver):
+        """Shut a receiver's pipeline down once nobody listens to it, and the monitors once nobody listens at all"""
+        if not receiver.sessions:
+            await receiver.stop_pipeline()
+        if not self.sessions and self.heartbeat_task:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+
+    @commands.command(name='join')
+    async def join_channel(self, ctx, receiver_name: str = None):
+        """Join the voice channel and stream an AirPlay receiver to it (`!join [receiver]`)"""
+        try:
+            # Check if user is in a voice channel
+            if not ctx.author.voice:
+                await ctx.send("You need to be in a voice channel first!")
+                return
+
+            receiver = self.receiver_for(ctx, receiver_name)
+            if receiver is None:
+                await ctx.send(f"No receiver called {receiver_name}. Available: {', '.join(self.receivers)}")
+                return
+
+            channel = ctx.author.voice.channel
+
+            # Disconnect this guild's current channel if already connected
+            previous = self.sessions.get(ctx.guild.id)
+            if previous:
+                self.drop_session(previous)
+                if previous.voice_client.is_connected():
+                    await previous.voice_client.disconnect()
+                if previous.receiver is not receiver:
+                    await self.release_receiver(previous.receiver)
+
+            # Join the voice channel
+            try:
+                voice_client = await channel.connect()
+            except Exception:
+                if previous:
+                    # The previous session is gone already; don't leave its announcer or a listenerless pipeline behind
+                    self.close_announcer(previous.text_channel)
+                    await self.release_receiver(receiver)
+                raise
+            session = GuildSession(ctx.guild.id, voice_client, ctx.channel, receiver)  # Text channel for announcements
+            self.add_session(session)
+            if previous:
+                self.close_announcer(previous.text_channel)
+            if len(self.receivers) > 1:
+                await ctx.send(f"Joined {channel.name}, playing AirPlay receiver {receiver.config.airplay_name}!")
+            else:
+                await ctx.send(f"Joined {channel.name} with ultra-high quality audio!")
+
+            # Start the receiver's stream, metadata and supervisor if this is its first listener
+            await receiver.start()
+            receiver.attach_voice(session)
+
+            # Start heartbeat monitoring
+            if not self.heartbeat_task or self.heartbeat_task.done():
+                await self.start_heartbeat()
+
+        except Exception as e:
+            await ctx.send(f"Error joining channel: {str(e)}")
+
+    @commands.command(name='leave')
+    async def leave_channel(self, ctx):
+        """Leave this server's voice channel and stop streaming to it"""
+        try:
+            session = self.sessions.get(ctx.guild.id)
+            if not session:
+                await ctx.send("I'm not in a voice channel!")
+                return
+            # Torn down even if the voice connection is already gone (kicked, dropped),
+            # so the receiver's pipeline doesn't keep running for nobody
+            connected = session.voice_client.is_connected()
+            await self.close_session(session)
+            if connected:
+                await ctx.send("Left the voice channel!")
+            else:
+                await ctx.send("Wasn't connected to voice any more; stopped streaming to this server")
+
+        except Exception as e:
+            await ctx.send(f"Error leaving channel: {str(e)}")
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        """Tear a guild's session down when the bot is kicked or dropped from voice"""
+        if self.bot.user is None or member.id != self.bot.user.id or after.channel is not None:
+            return
+        session = self.sessions.get(member.guild.id)
+        # !reconnect disconnects on purpose and keeps the session
+        if session is None or session.reconnecting:
+            return
+        logger.info(f"Removed from voice in guild {member.guild.id}, stopping the stream there")
+        await self.close_session(session)
+
+    def announcer_for(self, channel):
+        """Outbound message queue for a text channel"""
+        announcer = self.announcers.get(channel.id)
+        if announcer is None:
+            announcer = ChannelAnnouncer(channel)
+            self.announcers[channel.id] = announcer
+        return announcer
+
+    def close_announcer(self, channel):
+        """Drop a text channel's queue once no guild session announces there"""
+        if channel and not any(s.text_channel and s.text_channel.id == channel.id for s in self.sessions.values()):
+            announcer = self.announcers.pop(channel.id, None)
+            if announcer:
+                announcer.close()
+
+    async def start_heartbeat(self):
+        """Start heartbeat monitoring to detect bot freezes"""
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+
+        self.heartbeat_task = asyncio.create_task(self.heartbeat_monitor())
+
+    async def heartbeat_monitor(self):
+        """Send heartbeat messages to detect if bot is frozen"""
+        try:
+            while True:
+                await asyncio.sleep(60)  # Heartbeat every minute
+                current_time = asyncio.get_event_loop().time()
+                self.last_heartbeat = current_time
+                logger.info(f"Heartbeat: Bot is alive at {current_time}")
+
+                # Also check voice client status
+                for receiver in self.receivers.values():
+                    if receiver.sessions:
+                        logger.info(f"Stream status for {receiver.name}: running={receiver.broadcaster.is_running()}, frames={receiver.broadcaster.frames_published}")
+                for session in list(self.sessions.values()):
+                    voice_client = session.voice_client
+                    logger.info(f"Voice status for guild {session.guild_id}: connected={voice_client.is_connected()}, playing={voice_client.is_playing()}")
+
+        except asyncio.CancelledError:
+            logger.info("Heartbeat monitoring cancelled")
+        except Exception as e:
+            logger.error(f"Heartbeat error: {e}")
 
     @commands.command(name='song')
     async def current_song(self, ctx):
         """Display the currently playing song"""
         try:
-            title = self.current_song['title'] or 'Unknown Title'
-            artist = self.current_song['artist'] or 'Unknown Artist'
-            album = self.current_song['album'] or 'Unknown Album'
+            receiver = self.receiver_of(ctx)
+            title = receiver.current_song['title'] or 'Unknown Title'
+            artist = receiver.current_song['artist'] or 'Unknown Artist'
+            album = receiver.current_song['album'] or 'Unknown Album'
 
             embed = discord.Embed(
                 title="🎵 Current Song",
@@ -535,78 +1110,166 @@ class AudioBot(commands.Cog):
             embed.add_field(name="Artist", value=artist, inline=True)
             if album != 'Unknown Album':
                 embed.add_field(name="Album", value=album, inline=True)
-            
-            embed.set_footer(text="Via AirPlay • Ultra-HQ Audio")
 
-            await ctx.send(embed=embed)
+            embed.set_footer(text=receiver.footer())
+
+            art = receiver.current_art
+            if art is None:
+                await ctx.send(embed=embed)
+            else:
+                art.remember_upload(await ctx.send(**art.message_kwargs(embed)))
 
         except Exception as e:
             await ctx.send(f"Error getting current song: {str(e)}")
 
+    @commands.command(name='receivers')
+    async def list_receivers(self, ctx):
+        """List the AirPlay receivers, where they're routed and who is listening"""
+        lines = []
+        for receiver in self.receivers.values():
+            config = receiver.config
+            routes = [f"channel {c}" for c in sorted(config.voice_channels)] + [f"guild {g}" for g in sorted(config.guilds)]
+            if config.default:
+                routes.append("default")
+            line = f"{receiver.name}: AirPlay '{config.airplay_name}', {len(receiver.sessions)} listening"
+            if routes:
+                line += f" ({', '.join(routes)})"
+            song = receiver.current_song
+            if receiver.sessions and song['title']:
+                line += f", now playing {song['artist'] or 'Unknown'} - {song['title']}"
+            lines.append(line)
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
     @commands.command(name='debug')
     async def debug_status(self, ctx):
         """Debug audio and metadata status"""
         try:
             debug_info = []
-            
+            receiver = self.receiver_of(ctx)
+            config = receiver.config
+
             # Check if pipes exist
-            audio_exists = os.path.exists(PIPE_PATH)
-            metadata_exists = os.path.exists(METADATA_PIPE_PATH)
-            
+            audio_exists = os.path.exists(config.audio_pipe)
+            metadata_exists = os.path.exists(config.metadata_pipe)
+
+            if len(self.receivers) > 1:
+                debug_info.append(f"Receiver: {receiver.name} ('{config.airplay_name}', CPUs {sorted(config.cpus) if config.cpus else 'any'})")
             debug_info.append(f"Audio pipe exists: {audio_exists}")
             debug_info.append(f"Metadata pipe exists: {metadata_exists}")
-            
-            # Check voice client status
-            if self.voice_client:
-                debug_info.append(f"Voice client connected: {self.voice_client.is_connected()}")
-                debug_info.append(f"Voice client playing: {self.voice_client.is_playing()}")
+            debug_info.append(f"Audio pipe held open: {receiver.fifo_holder.is_open()} "
+                              f"({receiver.fifo_holder.drained_bytes} stale bytes dropped)")
+            debug_info.append(f"AirPlay session active: {receiver.session_started is not None} ({receiver.airplay_sessions} started)")
+
+            # Check the shared stream
+            broadcaster = receiver.broadcaster
+            debug_info.append(f"Audio engine: {AUDIO_ENGINE} ({STREAM_PROFILE} profile)")
+            debug_info.append(f"Stream running: {broadcaster.is_running()}")
+            debug_info.append(f"Frames encoded: {broadcaster.frames_published}")
+            swap_gap = broadcaster.last_swap_gap
+            debug_info.append(f"Source swaps: {broadcaster.swaps}"
+                              + (f" (last gap {swap_gap * 1000:.1f} ms)" if swap_gap is not None else "")
+                              + f", standby ready: {broadcaster.has_standby()}")
+            debug_info.append(f"Guilds listening: {len(receiver.sessions)}")
+            if AUDIO_ENGINE in PCM_ENGINES:
+                ring = receiver.pcm_buffer
+                debug_info.append(f"Jitter buffer: {ring.fill_ms(INPUT_BYTES_PER_SECOND):.0f}/{JITTER_BUFFER_MAX_MS} ms (target {JITTER_BUFFER_MS} ms)")
+                debug_info.append(f"Jitter buffer underruns: {ring.underruns}, overruns: {ring.overruns}")
+                debug_info.append(f"PCM reader running: {receiver.reader_running()}")
+                drift = receiver.drift_ppm()
+                if drift is not None:
+                    debug_info.append(f"Clock drift: {drift[0]:+.1f} ppm, correcting {drift[1]:+.1f} ppm")
+            worker = receiver.audio_worker
+            if worker is not None:
+                debug_info.append(f"Audio worker: {'running, pid ' + str(worker.pid) if worker.is_running() else 'stopped'}, "
+                                  f"{worker.frames_produced} frames, {worker.restarts} restart(s)")
+            if SILENCE_TIMEOUT_MS:
+                debug_info.append(f"Idle (silence) suspended: {receiver.stream_idle} ({receiver.idle_suspensions} times)")
+
+            # Check this guild's voice client status
+            session = self.sessions.get(ctx.guild.id)
+            if session:
+                debug_info.append(f"Voice client connected: {session.voice_client.is_connected()}")
+                debug_info.append(f"Voice client playing: {session.voice_client.is_playing()}")
+                if session.subscriber:
+                    debug_info.append(f"Frames sent: {session.subscriber.frames_sent} (underruns: {session.subscriber.underruns}, skipped: {session.subscriber.skipped})")
             else:
                 debug_info.append("Voice client: None")
-            
+
             # Check metadata monitoring
-            metadata_running = self.metadata_task and not self.metadata_task.done()
-            debug_info.append(f"Metadata monitoring running: {metadata_running}")
-            
+            parser = receiver.metadata_reader.parser
+            debug_info.append(f"Metadata monitoring running: {receiver.metadata_reader.is_running()}")
+            debug_info.append(f"Metadata items parsed: {parser.items_parsed} (skipped: {parser.items_skipped}, dropped: {parser.items_dropped})")
+            if self.cover_art is not None:
+                cache = self.cover_art
+                debug_info.append(f"Cover art cache: {len(cache)} images, {cache.total_bytes // 1024} KB (hits: {cache.hits}, misses: {cache.misses})")
+
+            # Stream health
+            supervisor = receiver.supervisor
+            debug_info.append(f"AirPlay active: {receiver.airplay_active}")
+            debug_info.append(f"Supervisor running: {supervisor.is_running()}, restarts: {supervisor.restarts}")
+            for name in supervisor.stages:
+                if supervisor.breaker_open(name):
+                    debug_info.append(f"Circuit breaker OPEN: {name}")
+            recent = list(supervisor.history)[-5:]
+            if recent:
+                debug_info.append("Recent restarts:")
+                for when, stage, reason, delay in recent:
+                    backoff = f" (backoff {delay:.1f}s)" if delay is not None else ""
+                    debug_info.append(f"  {time.strftime('%H:%M:%S', time.localtime(when))} {stage}: {reason}{backoff}")
+
+            # Child processes, when started by process_supervisor.py
+            processes = read_status()
+            if processes:
+                debug_info.append("Processes:")
+                debug_info.extend(f"  {line}" for line in describe_status(processes))
+
             await ctx.send("```\n" + "\n".join(debug_info) + "\n```")
-            
+
         except Exception as e:
             await ctx.send(f"Debug error: {str(e)}")
 
     @commands.command(name='reconnect')
     async def reconnect(self, ctx):
-        """Fully reconnect to voice channel and restart everything"""
+        """Reconnect this server's voice channel; the audio pipeline keeps running"""
         try:
+            session = self.sessions.get(ctx.guild.id)
+
             # Store the current voice channel
             if ctx.author.voice:
                 target_channel = ctx.author.voice.channel
-            elif self.voice_client and self.voice_client.channel:
-                target_channel = self.voice_client.channel
+            elif session and session.voice_client.channel:
+                target_channel = session.voice_client.channel
             else:
                 await ctx.send("No voice channel to reconnect to!")
                 return
+            receiver = session.receiver if session else self.receiver_for(ctx)
+
+            if session:
+                if session.reconnecting:
+                    await ctx.send("Already reconnecting!")
+                    return
+                # Only the voice connection is replaced
+                try:
+                    elapsed = await receiver.reconnect_voice(session, target_channel)
+                except Exception:
+                    # The old connection is gone; without a new one nobody listens, so release the pipeline
+                    await self.close_session(session)
+                    raise
+                # A manual reconnect clears the sender's backoff; start whatever stopped meanwhile
+                receiver.supervisor.reset(f"voice:{session.guild_id}")
+                await receiver.start()
+                await ctx.send(f"Reconnected to {target_channel.name} in {elapsed * 1000:.0f} ms!")
+                return
+
+            voice_client = await target_channel.connect()
+            metrics.VOICE_RECONNECTS.inc()
+            session = GuildSession(ctx.guild.id, voice_client, ctx.channel, receiver)
+            self.add_session(session)
+            await receiver.start()
+            receiver.attach_voice(session)
+            if not self.heartbeat_task or self.heartbeat_task.done():
+                await self.start_heartbeat()
 
-            # Clean disconnect
-            if self.voice_client:
-                if self.voice_client.is_playing():
-                    self.voice_client.stop()
-                await self.voice_client.disconnect()
-                self.voice_client = None
-
-            # Stop metadata monitoring
-            if self.metadata_task:
-                self.metadata_task.cancel()
-                self.metadata_task = None
-
-            await asyncio.sleep(2)
-
-            # Reconnect
-            self.voice_client = await target_channel.connect()
-            self.current_channel = ctx.channel
-            
-            # Restart everything
-            await self.start_audio_stream()
-            await self.start_metadata_monitoring()
-            
             await ctx.send(f"Reconnected to {target_channel.name}!")
 
         except Exception as e:
@@ -614,48 +1277,166 @@ class AudioBot(commands.Cog):
 
     @commands.command(name='restart')
     async def restart_audio(self, ctx):
-        """Restart the audio stream"""
+        """Restart the audio stream this server is playing"""
         try:
-            if not self.voice_client or not self.voice_client.is_connected():
+            session = self.sessions.get(ctx.guild.id)
+            if not session or not session.voice_client.is_connected():
                 await ctx.send("Not connected to a voice channel!")
                 return
+            receiver = session.receiver
 
-            # Stop current audio if playing
-            if self.voice_client.is_playing():
-                self.voice_client.stop()
-                await asyncio.sleep(1)
+            # A manual restart clears backoff and any open circuit breakers
+            receiver.supervisor.reset()
 
-            # Restart audio stream
-            await self.start_audio_stream()
+            # Swap in a fresh source between frames; voice clients keep their subscriptions
+            await receiver.restart_encoder()
+            await receiver.start_audio_stream()
             await ctx.send("Audio stream restarted!")
 
         except Exception as e:
             await ctx.send(f"Error restarting audio: {str(e)}")
 
+    @commands.command(name='profile')
+    @commands.has_permissions(administrator=True)
+    async def profile(self, ctx, seconds: int = 10):
+        """Profile the running bot for a few seconds and post the hot spots (administrators only)"""
+        if self.profile_run is not None:
+            await ctx.send("A profile is already being captured.")
+            return
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+        await ctx.send(f"Profiling for {seconds} s, the bot keeps running...")
+        self.profile_run = ProfileRun(seconds, PROFILE_DIR)
+        try:
+            path = await self.profile_run.run()
+            await ctx.send("```\n" + self.profile_run.summary()[:1800] + f"\n```Full dump: `{path}`")
+        except Exception as e:
+            logger.error(f"Profiling failed: {e}")
+            logger.error(traceback.format_exc())
+            await ctx.send(f"Error profiling: {str(e)}")
+        finally:
+            self.profile_run = None
+
+    @commands.command(name='latency')
+    async def latency_report(self, ctx, action: str = None):
+        """Show AirPlay-to-Discord latency percentiles (`!latency reset` clears them)"""
+        try:
+            receiver = self.receiver_of(ctx)
+            if action == 'reset':
+                receiver.latency.reset()
+                await ctx.send("Latency samples cleared.")
+                return
+
+            if AUDIO_ENGINE not in PCM_ENGINES:
+                await ctx.send("Latency is measured by the native engine; set `AUDIO_ENGINE=native` or `process` to enable it.")
+                return
+
+            stats = receiver.latency.percentiles()
+            if not stats['count']:
+                await ctx.send("No latency samples yet. Play something over AirPlay first.")
+                return
+
+            lines = [
+                f"Profile: {STREAM_PROFILE}",
+                f"FIFO read -> packet sent ({stats['count']} samples)",
+                f"p50: {stats[50] * 1000:.1f} ms",
+                f"p95: {stats[95] * 1000:.1f} ms",
+                f"p99: {stats[99] * 1000:.1f} ms",
+                f"Jitter buffer: {receiver.pcm_buffer.fill_ms(INPUT_BYTES_PER_SECOND):.0f} ms (target {JITTER_BUFFER_MS} ms)",
+            ]
+            await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+        except Exception as e:
+            await ctx.send(f"Error getting latency: {str(e)}")
+
+    @commands.command(name='history')
+    async def play_history(self, ctx, *, query: str = None):
+        """Recent plays: `!history [n]`, `!history artist:<name>`, or what played `!history 20m` ago"""
+        if self.history is None:
+            await ctx.send("Play history is disabled (`PLAY_HISTORY_DIR`).")
+            return
+        query = (query or '').strip()
+        try:
+            if query.lower().startswith('artist:'):
+                artist, plays = self.history.by_artist(query[len('artist:'):].strip(), HISTORY_LINES)
+                header = f"Last plays by {artist}" if artist else None
+            elif query[-1:] in HISTORY_UNITS and query[:-1].isdigit():
+                seconds = int(query[:-1]) * HISTORY_UNITS[query[-1]]
+                plays = self.history.at(time.time() - seconds, 5)
+                header = f"Playing {query} ago, and before"
+            elif not query or query.isdigit():
+                plays = self.history.recent(min(int(query or 10), HISTORY_LINES))
+                header = "Recently played"
+            else:
+                await ctx.send("Usage: `!history [n]`, `!history artist:<name>` or `!history <n>m|h|d`")
+                return
+        except Exception as e:
+            await ctx.send(f"Error reading the play history: {str(e)}")
+            return
+
+        if not plays:
+            await ctx.send("Nothing found in the play history.")
+            return
+        show_receiver = len(self.receivers) > 1
+        lines = [header]
+        for play in plays:
+            line = f"{time.strftime('%m-%d %H:%M', time.localtime(play.time))}  {play.artist} - {play.title}"
+            if show_receiver:
+                line += f" ({play.receiver})"
+            lines.append(line[:120])
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
+    @commands.command(name='top')
+    async def top_plays(self, ctx):
+        """Most played tracks and artists"""
+        if self.history is None:
+            await ctx.send("Play history is disabled (`PLAY_HISTORY_DIR`).")
+            return
+        tracks, artists = self.history.top(10)
+        if not tracks:
+            await ctx.send("Nothing played yet.")
+            return
+        lines = [f"Top tracks ({len(self.history)} plays)"]
+        lines += [f"{count:>5}  {artist} - {title}"[:120] for title, artist, count in tracks]
+        lines += ["", "Top artists"]
+        lines += [f"{count:>5}  {artist}"[:120] for artist, count in artists]
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
     @commands.command(name='status')
     async def status(self, ctx):
-        """Check bot status"""
-        if self.voice_client and self.voice_client.is_connected():
-            channel_name = self.voice_client.channel.name
-            is_playing = self.voice_client.is_playing()
-            monitoring = self.metadata_task and not self.metadata_task.done()
-            
+        """Check bot status for this server"""
+        session = self.sessions.get(ctx.guild.id)
+        if session and session.voice_client.is_connected():
+            receiver = session.receiver
+            channel_name = session.voice_client.channel.name
+            is_playing = session.voice_client.is_playing() and receiver.broadcaster.is_running()
+            monitoring = receiver.metadata_reader.is_running()
+
             status_msg = f"Connected to: {channel_name}\nPlaying audio: {is_playing}\nMetadata monitoring: {monitoring}"
-            
-            if any(self.current_song.values()):
-                title = self.current_song['title'] or 'Unknown'
-                artist = self.current_song['artist'] or 'Unknown'
+            if len(self.receivers) > 1:
+                status_msg += f"\nAirPlay receiver: {receiver.config.airplay_name}"
+            if receiver.stream_idle:
+                status_msg += "\nSuspended: no audio, resumes as soon as AirPlay plays again"
+            control = receiver.bitrate_control
+            cap = getattr(session.voice_client.channel, 'bitrate', None)
+            status_msg += f"\nBitrate: {control.bitrate} kbps ({control.reason}"
+            status_msg += f", channel allows {cap // 1000} kbps)" if cap else ")"
+            status_msg += f"\nVolume: {receiver.volume_text()}"
+            if len(receiver.sessions) > 1:
+                status_msg += f"\nAlso streaming to {len(receiver.sessions) - 1} other server(s)"
+
+            if any(receiver.current_song.values()):
+                title = receiver.current_song['title'] or 'Unknown'
+                artist = receiver.current_song['artist'] or 'Unknown'
                 status_msg += f"\nCurrent song: {artist} - {title}"
-            
+
             await ctx.send(status_msg)
         else:
             await ctx.send("Not connected to any voice channel")
 
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print(f'Bot is in {len(bot.guilds)} guilds')
     logger.info(f'{bot.user} has connected to Discord!')
+    logger.info(f'Bot is in {len(bot.guilds)} guilds')
 
 @bot.event
 async def on_command_error(ctx, error):
@@ -670,16 +1451,12 @@ async def on_command_error(ctx, error):
 async def on_error(event, *args, **kwargs):
     logger.error(f"Bot error in event {event}: {args}")
     logger.error(traceback.format_exc())
-    print(f"Bot error in event {event}: {args}")
-    print(traceback.format_exc())
 
 # Global exception handler
 def handle_exception(loop, context):
     logger.error(f"Caught exception: {context}")
-    print(f"Caught exception: {context}")
     if 'exception' in context:
         logger.error(f"Exception details: {context['exception']}")
-        print(f"Exception details: {context['exception']}")
 
 # Add the cog to the bot
 async def main():
@@ -693,7 +1470,7 @@ async def main():
 
 if __name__ == "__main__":
     if not TOKEN:
-        print("Please set the DISCORD_BOT_TOKEN environment variable")
+        logger.error("Please set the DISCORD_BOT_TOKEN environment variable")
         exit(1)
     
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,291 @@
+import binascii
+import collections
+import hashlib
+import logging
+
+from logging_config import RateLimitedLogger
+
+logger = logging.getLogger(__name__)
+log_throttled = RateLimitedLogger(logger)
+
+MetadataItem = collections.namedtuple('MetadataItem', ['type', 'code', 'payload'])
+# Payload of a streamed item: the decoded bytes and their SHA-1 hex digest
+StreamedPayload = collections.namedtuple('StreamedPayload', ['data', 'digest'])
+
+# Fixed layout of an item header written by shairport-sync:
+# <item><type>XXXXXXXX</type><code>XXXXXXXX</code><length>N</length>
+ITEM_START = b'<item><type>'
+ITEM_END = b'</item>'
+TYPE_END_CODE_START = b'</type><code>'
+CODE_END_LENGTH_START = b'</code><length>'
+LENGTH_END = b'</length>'
+DATA_START = b'<data encoding="base64">'
+DATA_END = b'</data>'
+
+TYPE_OFFSET = len(ITEM_START)
+CODE_OFFSET = TYPE_OFFSET + 8 + len(TYPE_END_CODE_START)
+LENGTH_OFFSET = CODE_OFFSET + 8 + len(CODE_END_LENGTH_START)
+MAX_HEADER_BYTES = LENGTH_OFFSET + 16 + len(LENGTH_END)
+
+# Streamed payloads are base64-decoded this many characters at a time (a multiple of 4)
+DECODE_CHUNK = 16384
+WHITESPACE = b' \t\r\n'
+
+
+class _StreamState:
+    """Progress through one streamed item: header -> data -> tail (up to </item>)"""
+
+    def __init__(self, item_type, code, limit):
+        self.item_type = item_type
+        self.code = code
+        self.limit = limit
+        self.phase = 'header'
+        self.data = bytearray()
+        self.hash = hashlib.sha1()
+        self.carry = b''
+        self.failed = False
+
+
+def hex4(name):
+    """Hex form of a 4-character type/code as it appears on the pipe, e.g. 'core' -> b'636f7265'"""
+    return name.encode('ascii').hex().encode('ascii')
+
+
+class ShairportMetadataParser:
+    """Incremental, byte-level parser for the shairport-sync metadata pipe
+
+    Feed it raw chunks of any size; it returns the complete items found so far.
+    Type and code are compared in their hex form against precomputed constants, so
+    items we don't want (progress, volume, ...) are skipped without decoding their
+    payload or even keeping it in memory.
+
+    Items listed in `streamed` (cover art) can be far larger than `max_item_bytes`.
+    Their base64 is decoded in DECODE_CHUNK pieces as it arrives and hashed on the
+    way, so only the decoded bytes are ever held, and they come back as a
+    StreamedPayload.
+    """
+
+    def __init__(self, wanted, max_item_bytes=65536, streamed=None, max_streamed_bytes=8 * 1024 * 1024):
+        # wanted: {'core': None, 'ssnc': {'mden', 'pvol'}} - None means every code of that type
+        self.wanted = {}
+        for item_type, codes in wanted.items():
+            self.wanted[hex4(item_type)] = None if codes is None else {hex4(c) for c in codes}
+        # streamed: {'ssnc': {'PICT'}}
+        self.streamed = set()
+        for item_type, codes in (streamed or {}).items():
+            self.streamed.update((hex4(item_type), hex4(c)) for c in codes)
+        self.max_item_bytes = max_item_bytes
+        self.max_streamed_bytes = max_streamed_bytes
+        # base64 expands 3 -> 4 and shairport adds a little markup around it
+        self._max_buffered = max_item_bytes * 4 // 3 + 256
+        self._names = {}
+        self._buf = bytearray()
+        self._skipping = False
+        self._pending = None  # (type hex, code hex) of the wanted item being collected
+        self._stream = None  # _StreamState of the streamed item being decoded
+
+        self.items_parsed = 0
+        self.items_skipped = 0
+        self.items_dropped = 0
+
+    def _name(self, hex_bytes):
+        name = self._names.get(hex_bytes)
+        if name is None:
+            name = bytes.fromhex(hex_bytes.decode('ascii')).decode('ascii', errors='replace')
+            self._names[bytes(hex_bytes)] = name
+        return name
+
+    def _is_wanted(self, item_type, code):
+        codes = self.wanted.get(item_type, False)
+        if codes is False:
+            return False
+        return codes is None or code in codes
+
+    def reset(self):
+        self._buf.clear()
+        self._skipping = False
+        self._pending = None
+        self._stream = None
+
+    def feed(self, data):
+        """Consume a chunk of pipe data and return a list of complete MetadataItems"""
+        buf = self._buf
+        buf += data
+        items = []
+        pos = 0
+
+        while True:
+            if self._stream is not None:
+                pos, done = self._continue_stream(buf, pos)
+                if not done:
+                    break
+                item = self._finish_stream()
+                if item is not None:
+                    items.append(item)
+                continue
+
+            if self._skipping:
+                end = buf.find(ITEM_END, pos)
+                if end < 0:
+                    # Keep only enough to recognise an end marker split across chunks
+                    pos = max(pos, len(buf) - len(ITEM_END) + 1)
+                    break
+                pos = end + len(ITEM_END)
+                self._skipping = False
+                self.items_skipped += 1
+                continue
+
+            if self._pending is not None:
+                end = buf.find(ITEM_END, pos)
+                if end < 0:
+                    if len(buf) - pos > self._max_buffered:
+                        # Oversized or unterminated item: give up on it without growing further
+                        self.items_dropped += 1
+                        self._pending = None
+                        self._skipping = True
+                        pos = len(buf) - len(ITEM_END) + 1
+                    break
+                item_type, code = self._pending
+                self._pending = None
+                payload = self._decode(buf, pos, end)
+                pos = end + len(ITEM_END)
+                if payload is None:
+                    self.items_dropped += 1
+                    continue
+                self.items_parsed += 1
+                items.append(MetadataItem(self._name(item_type), self._name(code), payload))
+                continue
+
+            start = buf.find(ITEM_START, pos)
+            if start < 0:
+                pos = max(pos, len(buf) - len(ITEM_START) + 1)
+                break
+            if start > pos and buf[pos:start].strip():
+                # Garbage between items
+                self.items_dropped += 1
+
+            length_end = buf.find(LENGTH_END, start + LENGTH_OFFSET, start + MAX_HEADER_BYTES)
+            if length_end < 0:
+                if len(buf) - start < MAX_HEADER_BYTES:
+                    # Header not complete yet
+                    pos = start
+                    break
+                # Malformed header: resync on the next item
+                self.items_dropped += 1
+                pos = start + 1
+                continue
+
+            if (buf[start + TYPE_OFFSET + 8:start + CODE_OFFSET] != TYPE_END_CODE_START or
+                    buf[start + CODE_OFFSET + 8:start + LENGTH_OFFSET] != CODE_END_LENGTH_START):
+                self.items_dropped += 1
+                pos = start + 1
+                continue
+
+            item_type = bytes(buf[start + TYPE_OFFSET:start + TYPE_OFFSET + 8])
+            code = bytes(buf[start + CODE_OFFSET:start + CODE_OFFSET + 8])
+            pos = length_end + len(LENGTH_END)
+
+            if (item_type, code) in self.streamed:
+                try:
+                    length = int(buf[start + LENGTH_OFFSET:length_end])
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= self.max_streamed_bytes:
+                    self.items_dropped += 1
+                    self._skipping = True
+                    continue
+                self._stream = _StreamState(item_type, code, length)
+                continue
+
+            if not self._is_wanted(item_type, code):
+                self._skipping = True
+                continue
+
+            try:
+                length = int(buf[start + LENGTH_OFFSET:length_end])
+            except ValueError:
+                self.items_dropped += 1
+                self._skipping = True
+                continue
+            if length > self.max_item_bytes:
+                self.items_dropped += 1
+                self._skipping = True
+                continue
+            self._pending = (item_type, code)
+
+        del buf[:pos]
+        return items
+
+    def _continue_stream(self, buf, pos):
+        """Advance the streamed item as far as the buffer allows; returns (new pos, finished)"""
+        state = self._stream
+        if state.phase == 'header':
+            data_start = buf.find(DATA_START, pos)
+            item_end = buf.find(ITEM_END, pos)
+            if item_end >= 0 and (data_start < 0 or item_end < data_start):
+                # An item without data (e.g. a track with no artwork)
+                return item_end + len(ITEM_END), True
+            if data_start < 0:
+                return max(pos, len(buf) - len(DATA_START) + 1), False
+            pos = data_start + len(DATA_START)
+            state.phase = 'data'
+
+        if state.phase == 'data':
+            data_end = buf.find(DATA_END, pos)
+            if data_end < 0:
+                # Decode what we have, keeping enough to spot an end marker split across chunks
+                end = max(pos, len(buf) - len(DATA_END) + 1)
+                self._stream_decode(state, buf, pos, end, final=False)
+                return end, False
+            self._stream_decode(state, buf, pos, data_end, final=True)
+            pos = data_end + len(DATA_END)
+            state.phase = 'tail'
+
+        item_end = buf.find(ITEM_END, pos)
+        if item_end < 0:
+            return max(pos, len(buf) - len(ITEM_END) + 1), False
+        return item_end + len(ITEM_END), True
+
+    def _stream_decode(self, state, buf, start, end, final):
+        if state.failed or start >= end:
+            return
+        data = state.carry + bytes(buf[start:end]).translate(None, WHITESPACE)
+        usable = len(data) if final else len(data) - len(data) % 4
+        try:
+            for offset in range(0, usable, DECODE_CHUNK):
+                decoded = binascii.a2b_base64(data[offset:min(offset + DECODE_CHUNK, usable)])
+                if len(state.data) + len(decoded) > state.limit:
+                    raise ValueError("payload longer than its declared length")
+                state.hash.update(decoded)
+                state.data += decoded
+        except (binascii.Error, ValueError) as e:
+            log_throttled.warning(f"Dropping streamed metadata item {self._name(state.code)}: {e}")
+            state.failed = True
+            state.data = bytearray()
+            return
+        state.carry = data[usable:]
+
+    def _finish_stream(self):
+        state = self._stream
+        self._stream = None
+        if state.failed or state.carry:
+            self.items_dropped += 1
+            return None
+        self.items_parsed += 1
+        payload = StreamedPayload(bytes(state.data), state.hash.hexdigest())
+        return MetadataItem(self._name(state.item_type), self._name(state.code), payload)
+
+    def _decode(self, buf, start, end):
+        """Decode the base64 <data> between start and end, or b'' for items without data"""
+        data_start = buf.find(DATA_START, start, end)
+        if data_start < 0:
+            return b''
+        data_start += len(DATA_START)
+        data_end = buf.find(DATA_END, data_start, end)
+        if data_end < 0:
+            return None
+        try:
+            # a2b_base64 skips the newlines shairport puts around the payload
+            return binascii.a2b_base64(buf[data_start:data_end])
+        except binascii.Error:
+            return None
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import os
+
+from logging_config import RateLimitedLogger
+
+logger = logging.getLogger(__name__)
+log_throttled = RateLimitedLogger(logger)
+
+
+class MetadataPipeReader:
+    """Reads the shairport-sync metadata FIFO on the event loop via loop.add_reader
+
+    The pipe is opened non-blocking, and we also hold a write end of our own so the
+    reader never sees EOF when shairport-sync closes its side between sessions (an fd
+    at EOF is always readable and would spin the loop). Items are handed to `on_item`
+    on the loop as soon as they are complete; stopping is instant.
+    """
+
+    def __init__(self, path, parser, on_item, read_size=65536, retry_delay=5):
+        self.path = path
+        self.parser = parser
+        self.on_item = on_item
+        self.read_size = read_size
+        self.retry_delay = retry_delay
+        self.bytes_read = 0
+        self._loop = None
+        self._read_fd = None
+        self._hold_fd = None
+        self._retry_handle = None
+
+    def is_running(self):
+        return self._read_fd is not None
+
+    def start(self):
+        """Start reading; if the pipe doesn't exist yet, retry until it does"""
+        if self.is_running():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._retry_handle = None
+        try:
+            self._read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self._hold_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except FileNotFoundError:
+            self._close()
+            logger.warning(f"Metadata pipe {self.path} does not exist, retrying in {self.retry_delay}s")
+            self._retry_handle = self._loop.call_later(self.retry_delay, self.start)
+            return
+        except OSError as e:
+            self._close()
+            logger.error(f"Could not open metadata pipe {self.path}: {e}")
+            self._retry_handle = self._loop.call_later(self.retry_delay, self.start)
+            return
+
+        self.parser.reset()
+        self._loop.add_reader(self._read_fd, self._on_readable)
+        logger.info(f"Metadata pipe {self.path} opened, waiting for data...")
+
+    def stop(self):
+        if self._retry_handle:
+            self._retry_handle.cancel()
+            self._retry_handle = None
+        if self._read_fd is not None and self._loop is not None:
+            self._loop.remove_reader(self._read_fd)
+        self._close()
+
+    def _close(self):
+        for fd in (self._read_fd, self._hold_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._read_fd = None
+        self._hold_fd = None
+
+    def _on_readable(self):
+        # Drain what's available, but yield back to the loop after a few chunks so a
+        # flood of items can't starve gateway and voice work
+        for _ in range(8):
+            if self._read_fd is None:
+                return
+            try:
+                chunk = os.read(self._read_fd, self.read_size)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logger.error(f"Error reading metadata pipe: {e}")
+                self.stop()
+                self._retry_handle = self._loop.call_later(self.retry_delay, self.start)
+                return
+            if not chunk:
+                return
+
+            self.bytes_read += len(chunk)
+            for item in self.parser.feed(chunk):
+                try:
+                    self.on_item(item)
+                except Exception as e:
+                    log_throttled.error(f"Error handling metadata item {item.type}/{item.code}: {e}")
@@ -0,0 +1,356 @@
+import logging
+import time
+
+import numpy as np
+import discord
+from discord import opus
+from discord.player import OPUS_SILENCE
+
+from metrics import ENCODE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# shairport-sync writes 16-bit little-endian stereo PCM at 44.1 kHz
+INPUT_SAMPLE_RATE = 44100
+OUTPUT_SAMPLE_RATE = opus.Encoder.SAMPLING_RATE  # 48000
+CHANNELS = opus.Encoder.CHANNELS  # 2
+SAMPLE_WIDTH = 2
+
+FRAME_MS = opus.Encoder.FRAME_LENGTH  # 20
+INPUT_FRAME_SAMPLES = INPUT_SAMPLE_RATE * FRAME_MS // 1000  # 882
+OUTPUT_FRAME_SAMPLES = opus.Encoder.SAMPLES_PER_FRAME  # 960
+INPUT_FRAME_BYTES = INPUT_FRAME_SAMPLES * CHANNELS * SAMPLE_WIDTH  # 3528
+INPUT_SAMPLE_BYTES = CHANNELS * SAMPLE_WIDTH
+INPUT_BYTES_PER_SECOND = INPUT_SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+OUTPUT_FRAME_BYTES = opus.Encoder.FRAME_SIZE  # 3840
+
+
+class PolyphaseResampler:
+    """Vectorized polyphase resampler for fixed-size interleaved int16 frames"""
+
+    def __init__(self, up=160, down=147, taps_per_phase=24, rolloff=0.92, beta=8.0,
+                 frame_samples=INPUT_FRAME_SAMPLES, channels=CHANNELS):
+        if (frame_samples * up) % down:
+            raise ValueError("frame size must map to a whole number of output samples")
+
+        self.up = up
+        self.down = down
+        self.taps = taps_per_phase
+        self.channels = channels
+        self.frame_samples = frame_samples
+        self.out_samples = frame_samples * up // down
+
+        # Windowed-sinc prototype low-pass at the upsampled rate, split into `up` phases
+        length = up * taps_per_phase
+        t = np.arange(length) - (length - 1) / 2.0
+        cutoff = rolloff / (2.0 * max(up, down))
+        prototype = 2.0 * cutoff * np.sinc(2.0 * cutoff * t) * np.kaiser(length, beta)
+        prototype *= up / prototype.sum()
+        bank = prototype.reshape(taps_per_phase, up).T
+
+        # Output sample n reads input (n * down) // up with filter phase (n * down) % up.
+        # Because every frame maps to a whole number of outputs the pattern repeats per
+        # frame, so the gather indices and coefficient rows are computed once here.
+        positions = np.arange(self.out_samples) * down
+        phases = positions % up
+        bases = positions // up + (taps_per_phase - 1)
+        self._coeffs = bank[phases][:, ::-1].astype(np.float32)
+        self._index = bases[:, None] - np.arange(taps_per_phase)[::-1][None, :]
+
+        # History of the previous frame's tail followed by the current frame
+        self._buffer = np.zeros((taps_per_phase - 1 + frame_samples, channels), dtype=np.float32)
+
+    def reset(self):
+        """Clear filter history (e.g. between unrelated streams)"""
+        self._buffer.fill(0)
+
+    def process(self, pcm, gain=None):
+        """Resample one frame of interleaved s16le PCM (or a float array of samples) and return s16le bytes
+
+        gain: optional scale applied before clipping, a float or one value per output sample
+        """
+        if isinstance(pcm, np.ndarray):
+            samples = pcm
+        else:
+            samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.channels)
+        if samples.shape[0] != self.frame_samples:
+            raise ValueError(f"expected {self.frame_samples} samples, got {samples.shape[0]}")
+
+        history = self.taps - 1
+        self._buffer[:history] = self._buffer[-history:]
+        self._buffer[history:] = samples
+
+        windows = self._buffer[self._index]  # (out_samples, taps, channels)
+        out = np.einsum('nk,nkc->nc', self._coeffs, windows)
+        if gain is not None:
+            out *= gain
+        np.clip(out, -32768, 32767, out=out)
+        return out.astype(np.int16).tobytes()
+
+
+class FractionalResampler:
+    """Stretches the input PCM by a small, changing ratio ahead of the polyphase resampler
+
+    Each frame consumes about frame_samples * (1 + ratio) input samples and returns exactly
+    frame_samples, interpolated with a cubic (Catmull-Rom) kernel. The fractional read
+    position carries over between frames, so the stream stays continuous. At a ratio of 0
+    and no fraction left over, samples pass through unchanged.
+    """
+
+    def __init__(self, frame_samples=INPUT_FRAME_SAMPLES, channels=CHANNELS, max_ratio=0.01):
+        self.frame_samples = frame_samples
+        self.channels = channels
+        self.max_ratio = max_ratio
+        self.max_input_samples = int(frame_samples * (1 + max_ratio)) + 4
+        self._buffer = np.zeros((self.max_input_samples + 4, channels), dtype=np.float32)
+        # Samples held in _buffer; the one before the read position is kernel history
+        self._have = 1
+        self._pos = 1.0
+        self._steps = np.arange(frame_samples, dtype=np.float64)
+        self._out = np.empty((frame_samples, channels), dtype=np.float32)
+
+    def samples_needed(self, ratio):
+        """New input samples the next process() call needs at `ratio`"""
+        ratio = max(-self.max_ratio, min(self.max_ratio, ratio))
+        last = self._pos + (self.frame_samples - 1) * (1 + ratio)
+        return max(0, int(last) + 3 - self._have)
+
+    def process(self, pcm, ratio):
+        """Add samples_needed(ratio) samples of s16le PCM; returns one float32 frame"""
+        ratio = max(-self.max_ratio, min(self.max_ratio, ratio))
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(-1, self.channels)
+        have = self._have
+        buffer = self._buffer
+        buffer[have:have + samples.shape[0]] = samples
+        have += samples.shape[0]
+        step = 1.0 + ratio
+        out = self._out
+
+        if ratio == 0.0 and self._pos == 1.0:
+            out[:] = buffer[1:1 + self.frame_samples]
+        else:
+            positions = self._pos + self._steps * step
+            index = positions.astype(np.intp)
+            t = (positions - index).astype(np.float32)[:, None]
+            before, x0, x1, x2 = buffer[index - 1], buffer[index], buffer[index + 1], buffer[index + 2]
+            # Catmull-Rom: ((c3 * t + c2) * t + c1) * t + x0
+            c1 = 0.5 * (x1 - before)
+            c2 = before - 2.5 * x0 + 2.0 * x1 - 0.5 * x2
+            c3 = 0.5 * (x2 - before) + 1.5 * (x0 - x1)
+            np.multiply(c3, t, out=out)
+            out += c2
+            out *= t
+            out += c1
+            out *= t
+            out += x0
+
+        end = self._pos + self.frame_samples * step
+        consumed = int(end) - 1
+        remaining = have - consumed
+        buffer[:remaining] = buffer[consumed:have]
+        self._have = remaining
+        self._pos = end - consumed
+        return out
+
+
+class SilenceDetector:
+    """Decides when the incoming PCM has been silent long enough to idle the pipeline
+
+    A frame is silent when every sample lies within `threshold` of zero; that takes two
+    NumPy reductions over an int16 view of the frame, without copying it. Frames that
+    never arrived (the pipe has no writer) count as silent too. Any loud frame ends
+    idling immediately.
+    """
+
+    def __init__(self, threshold=16, idle_after_frames=500):
+        self.threshold = threshold
+        self.idle_after_frames = idle_after_frames
+        self.silent_frames = 0
+        self.idle = False
+        self.idle_periods = 0
+
+    def reset(self):
+        self.silent_frames = 0
+        self.idle = False
+
+    def is_silent(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        return int(samples.max()) <= self.threshold and int(samples.min()) >= -self.threshold
+
+    def update(self, pcm):
+        """Account for one frame (None if none was available) and return whether we're idle"""
+        if pcm is not None and not self.is_silent(pcm):
+            self.silent_frames = 0
+            self.idle = False
+            return False
+
+        self.silent_frames += 1
+        if not self.idle and self.silent_frames >= self.idle_after_frames:
+            self.idle = True
+            self.idle_periods += 1
+        return self.idle
+
+
+class VolumeControl:
+    """AirPlay volume applied to the PCM, ramped linearly over one frame on every change
+
+    The AirPlay slider runs from -30 (quietest) to 0 (full), with -144 meaning mute; it is
+    mapped onto `range_db` of attenuation. set_airplay_volume() may be called from any
+    thread; the encoder calls next_gain() once per frame and skips encoding while muted.
+    """
+
+    MUTE = -144.0
+
+    def __init__(self, range_db=60.0, frame_samples=OUTPUT_FRAME_SAMPLES):
+        self.range_db = range_db
+        self.airplay_volume = 0.0
+        self.target = 1.0
+        self.gain = 1.0  # reached at the end of the last frame
+        self._ramp = (np.arange(1, frame_samples + 1, dtype=np.float32) / frame_samples)[:, None]
+        self._gains = np.empty_like(self._ramp)
+
+    def set_airplay_volume(self, airplay_volume):
+        self.airplay_volume = airplay_volume
+        if airplay_volume <= self.MUTE:
+            self.target = 0.0
+        else:
+            self.target = 10 ** (self.to_db(airplay_volume, self.range_db) / 20)
+
+    @staticmethod
+    def to_db(airplay_volume, range_db):
+        return max(-30.0, min(0.0, airplay_volume)) / 30.0 * range_db
+
+    @property
+    def muted(self):
+        return self.target == 0.0 and self.gain == 0.0
+
+    def next_gain(self):
+        """Gain for the next frame: None at full volume, a float when steady, else a ramp per sample"""
+        target = self.target
+        if target == self.gain:
+            return None if target == 1.0 else target
+        np.multiply(self._ramp, target - self.gain, out=self._gains)
+        self._gains += self.gain
+        self.gain = target
+        return self._gains
+
+
+def create_encoder(bitrate=128, application=opus.APPLICATION_AUDIO):
+    """Create a discord Opus encoder tuned for music"""
+    encoder = opus.Encoder(application=application)
+    encoder.set_bitrate(bitrate)
+    encoder.set_signal_type('music')
+    return encoder
+
+
+class PCMOpusAudio(discord.AudioSource):
+    """In-process audio source: PCM ring buffer -> 48 kHz resample -> Opus frames
+
+    The FIFO itself is read by a FIFOReader thread into `ring`; this source only
+    drains whole frames from it, so it never blocks on the pipe.
+    """
+
+    def __init__(self, ring, bitrate=128, application=opus.APPLICATION_AUDIO, latency=None,
+                 silence=None, on_idle_change=None, volume=None, drift=None):
+        self.ring = ring
+        self.bitrate = bitrate
+        self.latency = latency
+        # Optional SilenceDetector; while idle the encoder is skipped entirely
+        self.silence = silence
+        self.on_idle_change = on_idle_change
+        # Optional VolumeControl; while muted the encoder is skipped as well
+        self.volume = volume
+        # Optional DriftEstimator; its correction stretches the input to hold the buffer at its target
+        self.drift = drift
+        self.ratio = 0.0
+        self.stretch = None
+        if drift is not None:
+            self.stretch = FractionalResampler(max_ratio=drift.max_ppm * 1e-6)
+            self._input = bytearray(self.stretch.max_input_samples * INPUT_SAMPLE_BYTES)
+            self._input_view = memoryview(self._input)
+            self._ring_marks = self._marks()
+        self.resampler = PolyphaseResampler()
+        self.encoder = create_encoder(bitrate, application)
+        # perf_counter time the current packet's PCM left the FIFO (None for silence)
+        self.last_origin = None
+        self._frame = bytearray(INPUT_FRAME_BYTES)
+        self._view = memoryview(self._frame)
+        self.created_at = time.perf_counter()
+        self.first_packet_at = None
+        self.primed = False
+        self.frames_encoded = 0
+        self._pending_bitrate = None
+
+    def set_bitrate(self, kbps):
+        """Change the bitrate from another thread; applied before the next frame is encoded"""
+        self._pending_bitrate = kbps
+
+    def prime(self):
+        """Run one silent frame through the resampler and encoder so a standby starts warm"""
+        pcm = self.resampler.process(bytes(INPUT_FRAME_BYTES))
+        self.encoder.encode(pcm, OUTPUT_FRAME_SAMPLES)
+        self.primed = True
+
+    def read(self):
+        frame = self._view
+        if self.stretch is not None:
+            frame = self._input_view[:self.stretch.samples_needed(self.ratio) * INPUT_SAMPLE_BYTES]
+        if not self.ring.read_into(frame):
+            # Jitter buffer is priming or ran dry: send silence rather than ending the stream
+            self.last_origin = None
+            self._track_silence(None)
+            return OPUS_SILENCE
+
+        if self.drift is not None:
+            self._track_drift()
+
+        if self._track_silence(frame):
+            # Idle: hand out the prebuilt silence frame instead of encoding
+            self.last_origin = None
+            return OPUS_SILENCE
+
+        if self.volume is not None and self.volume.muted:
+            self.last_origin = None
+            return OPUS_SILENCE
+
+        if self.latency is not None:
+            self.last_origin = self.latency.origin_of(self.ring.last_read_pos)
+
+        if self._pending_bitrate is not None:
+            self.bitrate, self._pending_bitrate = self._pending_bitrate, None
+            self.encoder.set_bitrate(self.bitrate)
+
+        started = time.perf_counter()
+        samples = self.stretch.process(frame, self.ratio) if self.stretch is not None else frame
+        pcm = self.resampler.process(samples, self.volume.next_gain() if self.volume is not None else None)
+        packet = self.encoder.encode(pcm, OUTPUT_FRAME_SAMPLES)
+        ENCODE_SECONDS.observe(time.perf_counter() - started)
+        self.frames_encoded += 1
+        if self.first_packet_at is None:
+            self.first_packet_at = time.perf_counter()
+            if not self.primed:
+                logger.info(f"First Opus packet after {(self.first_packet_at - self.created_at) * 1000:.1f} ms")
+        return packet
+
+    def _marks(self):
+        return self.ring.underruns, self.ring.overruns, self.ring.trimmed
+
+    def _track_drift(self):
+        marks = self._marks()
+        if marks != self._ring_marks:
+            # Underruns and dropped audio move the fill level without any drift
+            self._ring_marks = marks
+            self.drift.reset()
+        self.ratio = self.drift.update(self.ring.fill())
+
+    def _track_silence(self, pcm):
+        if self.silence is None:
+            return False
+        was_idle = self.silence.idle
+        idle = self.silence.update(pcm)
+        if idle != was_idle and self.on_idle_change:
+            self.on_idle_change(idle)
+        return idle
+
+    def is_opus(self):
+        return True
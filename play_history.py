@@ -0,0 +1,280 @@
+import array
+import bisect
+import collections
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# One play: time, then the ids of its title, artist, album and receiver name
+RECORD = struct.Struct('<dIIII')
+# A string table entry: its UTF-8 length, then the bytes
+STRING_LENGTH = struct.Struct('<H')
+MAX_STRING_BYTES = 1024
+# Most artists a partial !history artist: name is matched against
+MAX_PREFIX_MATCHES = 50
+
+Play = collections.namedtuple('Play', 'time title artist album receiver')
+
+
+class Leaderboard:
+    """Play counts per key, bucketed by count
+
+    add() moves a key up one bucket; the counts that have a bucket are kept sorted, so
+    top(k) walks only non-empty buckets down from the highest count and never looks at
+    the long tail of rarely played keys. Within a count, keys that reached it first
+    come first.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._buckets = {}  # count -> {key: None}, in insertion order
+        self._sorted_counts = []  # counts with a non-empty bucket, ascending
+
+    def add(self, key):
+        count = self.counts.get(key, 0)
+        if count:
+            bucket = self._buckets[count]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[count]
+                del self._sorted_counts[bisect.bisect_left(self._sorted_counts, count)]
+        count += 1
+        self.counts[key] = count
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = {}
+            bisect.insort(self._sorted_counts, count)
+        bucket[key] = None
+
+    def top(self, limit):
+        """Up to `limit` (key, count) pairs, most played first"""
+        result = []
+        for count in reversed(self._sorted_counts):
+            for key in self._buckets[count]:
+                result.append((key, count))
+                if len(result) == limit:
+                    return result
+        return result
+
+
+class PlayHistory:
+    """Append-only log of every track played, with indexes for !history and !top
+
+    Plays are fixed-width records in `plays.bin`. Titles, artists, albums and receiver
+    names are interned: each is stored once in `strings.bin` and referenced by id, and
+    in memory a play is five numbers in typed arrays. Indexes:
+    - by time: play times are appended in order, so bisect finds what played at any moment
+    - by artist: the positions of each artist's plays, looked up case-insensitively,
+      and the artist names in sorted order for prefix lookups
+    - top tracks and artists: Leaderboards of play counts
+
+    record() updates memory right away and queues the bytes; a writer thread appends
+    them to disk, so the metadata path never waits for the file system.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.plays_path = os.path.join(directory, 'plays.bin')
+        self.strings_path = os.path.join(directory, 'strings.bin')
+        self.times = array.array('d')
+        self._titles = array.array('I')
+        self._artists = array.array('I')
+        self._albums = array.array('I')
+        self._receivers = array.array('I')
+        self._strings = ['']
+        self._string_ids = {'': 0}
+        self._by_artist = {}  # casefolded artist -> array of play positions
+        self._artist_names = []  # the keys of _by_artist, sorted
+        self.top_tracks = Leaderboard()  # (title id, artist id)
+        self.top_artists = Leaderboard()  # artist id
+        self.write_errors = 0
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def load(self):
+        """Read the log back into memory; blocks, so run it in an executor"""
+        os.makedirs(self.directory, exist_ok=True)
+        started = time.perf_counter()
+        data = self._read(self.strings_path)
+        offset = 0
+        while offset + STRING_LENGTH.size <= len(data):
+            (length,) = STRING_LENGTH.unpack_from(data, offset)
+            end = offset + STRING_LENGTH.size + length
+            if end > len(data):
+                break
+            self._add_string(data[offset + STRING_LENGTH.size:end].decode('utf-8', errors='replace'))
+            offset = end
+        self._truncate(self.strings_path, offset, len(data))
+
+        data = self._read(self.plays_path)
+        # Sorted once at the end rather than kept sorted record by record
+        self._artist_names = None
+        complete = len(data) - len(data) % RECORD.size
+        self._truncate(self.plays_path, complete, len(data))
+        skipped = 0
+        for played_at, title, artist, album, receiver in RECORD.iter_unpack(memoryview(data)[:complete]):
+            if max(title, artist, album, receiver) >= len(self._strings):
+                # Its strings never made it to disk
+                skipped += 1
+                continue
+            self._index(played_at, title, artist, album, receiver)
+        self._artist_names = sorted(self._by_artist)
+        if skipped:
+            logger.warning(f"Skipped {skipped} play history records with missing strings")
+        logger.info(f"Loaded {len(self)} plays and {len(self._strings)} strings from {self.directory} "
+                    f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def start(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._write_loop, name='play-history-writer', daemon=True)
+            self._writer.start()
+
+    def close(self, timeout=2.0):
+        """Write what is queued and stop the writer thread"""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout)
+            self._writer = None
+
+    def record(self, receiver, title, artist, album=None, played_at=None):
+        """Log one play; returns immediately"""
+        played_at = played_at or time.time()
+        if self.times and played_at < self.times[-1]:
+            # Keep the time index sorted if the wall clock steps back
+            played_at = self.times[-1]
+        ids = [self._intern(value or '') for value in (title, artist, album, receiver)]
+        self._index(played_at, *ids)
+        self._queue.put((self.plays_path, RECORD.pack(played_at, *ids)))
+
+    def recent(self, limit):
+        """The last `limit` plays, newest first"""
+        return [self._play(index) for index in range(len(self) - 1, max(-1, len(self) - 1 - limit), -1)]
+
+    def at(self, moment, limit):
+        """The play that was on at `moment` and up to `limit - 1` before it, newest first"""
+        end = bisect.bisect_right(self.times, moment)
+        return [self._play(index) for index in range(end - 1, max(-1, end - 1 - limit), -1)]
+
+    def by_artist(self, name, limit):
+        """The artist's last `limit` plays, newest first, and the artist name as stored
+
+        An exact (case-insensitive) name is a dict lookup. Otherwise the most played of
+        the first MAX_PREFIX_MATCHES artists whose name starts with `name` is used,
+        found by bisecting the sorted names.
+        """
+        key = name.casefold()
+        positions = self._by_artist.get(key)
+        if positions is None:
+            names = self._artist_names
+            start = bisect.bisect_left(names, key)
+            end = min(bisect.bisect_left(names, key + '\U0010ffff'), start + MAX_PREFIX_MATCHES)
+            if not key or start >= end:
+                return None, []
+            positions = max((self._by_artist[artist] for artist in names[start:end]), key=len)
+        plays = [self._play(positions[i]) for i in range(len(positions) - 1, max(-1, len(positions) - 1 - limit), -1)]
+        return plays[0].artist, plays
+
+    def top(self, limit):
+        """([(title, artist, plays)], [(artist, plays)]), most played first"""
+        strings = self._strings
+        tracks = [(strings[title], strings[artist], count) for (title, artist), count in self.top_tracks.top(limit)]
+        artists = [(strings[artist], count) for artist, count in self.top_artists.top(limit)]
+        return tracks, artists
+
+    def _play(self, index):
+        strings = self._strings
+        return Play(self.times[index], strings[self._titles[index]], strings[self._artists[index]],
+                    strings[self._albums[index]], strings[self._receivers[index]])
+
+    def _index(self, played_at, title, artist, album, receiver):
+        position = len(self.times)
+        self.times.append(played_at)
+        self._titles.append(title)
+        self._artists.append(artist)
+        self._albums.append(album)
+        self._receivers.append(receiver)
+        key = self._strings[artist].casefold()
+        positions = self._by_artist.get(key)
+        if positions is None:
+            positions = self._by_artist[key] = array.array('I')
+            if self._artist_names is not None:
+                bisect.insort(self._artist_names, key)
+        positions.append(position)
+        self.top_tracks.add((title, artist))
+        self.top_artists.add(artist)
+
+    def _intern(self, value):
+        encoded = value.encode('utf-8')[:MAX_STRING_BYTES]
+        value = encoded.decode('utf-8', errors='ignore')
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = self._add_string(value)
+            encoded = value.encode('utf-8')
+            # Queued before any record that uses it, so the strings file is always ahead
+            self._queue.put((self.strings_path, STRING_LENGTH.pack(len(encoded)) + encoded))
+        return string_id
+
+    def _add_string(self, value):
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(value)
+            self._string_ids[value] = string_id
+        return string_id
+
+    def _write_loop(self):
+        files = {}
+        try:
+            while True:
+                item = self._queue.get()
+                batch = [item]
+                # Whatever else is queued goes out in the same write
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                chunks = {}
+                for entry in batch:
+                    if entry is not None:
+                        chunks.setdefault(entry[0], []).append(entry[1])
+                # Strings first, so no record on disk refers to a string that isn't
+                for path in sorted(chunks, key=lambda p: p != self.strings_path):
+                    try:
+                        if path not in files:
+                            files[path] = open(path, 'ab')
+                        files[path].write(b''.join(chunks[path]))
+                        files[path].flush()
+                    except OSError as e:
+                        self.write_errors += 1
+                        logger.error(f"Could not write play history to {path}: {e}")
+                if stop:
+                    return
+        finally:
+            for f in files.values():
+                f.close()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    @staticmethod
+    def _truncate(path, length, size):
+        # A partial entry at the end is from a crash mid-write; appends must start after the last whole one
+        if length < size:
+            logger.warning(f"Dropping {size - length} trailing bytes of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(length)
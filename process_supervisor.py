@@ -0,0 +1,475 @@
+"""Container entry point: starts dbus, avahi, nqptp, shairport-sync and the bot, and keeps them running.
+
+Each child is started as soon as the children it depends on are ready. Readiness is
+checked directly (a socket or FIFO exists, a port is bound, the AirPlay service is
+visible over mDNS) instead of sleeping. A child that
+exits is restarted with exponential backoff. Child states are written to a JSON status
+file that the bot's !debug command shows.
+
+Usage: python3 process_supervisor.py [--status-file /tmp/bizzitybot-supervisor.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import signal
+import stat
+import sys
+import time
+
+from logging_config import TEXT_FORMAT
+from receivers import load_receivers, shairport_config
+
+logger = logging.getLogger(__name__)
+
+STATUS_PATH = os.getenv('SUPERVISOR_STATUS_PATH', '/tmp/bizzitybot-supervisor.json')
+
+
+class PathExists:
+    """Ready once `path` exists, optionally as a particular kind of file ('socket' or 'fifo')"""
+
+    KINDS = {'socket': stat.S_ISSOCK, 'fifo': stat.S_ISFIFO}
+
+    def __init__(self, path, kind=None):
+        self.path = path
+        self.kind = kind
+        self.description = f"{kind or 'path'} {path}"
+
+    async def check(self, service):
+        try:
+            mode = os.stat(self.path).st_mode
+        except OSError:
+            return False
+        return self.kind is None or self.KINDS[self.kind](mode)
+
+
+class PortBound:
+    """Ready once any of `ports` is bound (UDP) or listening (TCP), read from /proc/net"""
+
+    TCP_LISTEN = '0A'
+
+    def __init__(self, protocol, *ports):
+        self.protocol = protocol
+        self.ports = {f'{port:04X}' for port in ports}
+        self.description = f"{protocol} port {'/'.join(str(p) for p in ports)}"
+
+    async def check(self, service):
+        for table in (f'/proc/net/{self.protocol}', f'/proc/net/{self.protocol}6'):
+            try:
+                with open(table) as f:
+                    next(f)
+                    for line in f:
+                        fields = line.split()
+                        port = fields[1].rsplit(':', 1)[1]
+                        if port in self.ports and (self.protocol != 'tcp' or fields[3] == self.TCP_LISTEN):
+                            return True
+            except (OSError, StopIteration, IndexError):
+                continue
+        return False
+
+
+class MDNSRegistered:
+    """Ready once avahi lists a `service_type` service whose name contains `name`
+
+    Passes straight away when avahi isn't running, since there is nothing to ask.
+    """
+
+    def __init__(self, service_type, name, avahi_socket='/run/avahi-daemon/socket', interval=0.5):
+        self.service_type = service_type
+        self.name = name
+        self.avahi_socket = avahi_socket
+        self.interval = interval
+        self.description = f"mDNS {service_type} '{name}'"
+        self._last_query = 0.0
+
+    async def check(self, service):
+        if not os.path.exists(self.avahi_socket) or not shutil.which('avahi-browse'):
+            return True
+        # avahi-browse takes a while; don't run it on every poll
+        if time.monotonic() - self._last_query < self.interval:
+            return False
+        self._last_query = time.monotonic()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                'avahi-browse', '--parsable', '--terminate', '--no-db-lookup', self.service_type,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+            )
+            output, _ = await asyncio.wait_for(process.communicate(), timeout=5)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        return self.name in output.decode(errors='replace')
+
+
+class Service:
+    """One supervised child process
+
+    requires: names of services that must be ready before this one starts
+    ready: checks that must all pass before this service counts as ready
+    required: if False, dependants go ahead when it isn't ready within `ready_timeout`;
+              if True, a child that doesn't get ready in time is restarted
+    prepare: optional callable run before each start (directories, stale pid files)
+    capture_output: forward the child's output through our log
+    """
+
+    def __init__(self, name, argv, requires=(), ready=(), required=True, ready_timeout=30.0,
+                 prepare=None, capture_output=True):
+        self.name = name
+        self.argv = argv
+        self.requires = tuple(requires)
+        self.ready = list(ready)
+        self.required = required
+        self.ready_timeout = ready_timeout
+        self.prepare = prepare
+        self.capture_output = capture_output
+
+        self.state = 'waiting'
+        self.process = None
+        self.pid = None
+        self.restarts = 0
+        self.failures = 0  # consecutive, drives the backoff
+        self.started_at = None
+        self.ready_seconds = None
+        self.last_exit_code = None
+        self.last_exit_at = None
+        self.waiting_for = None
+        self.settled = asyncio.Event()  # ready, or given up on if not required
+
+    def status(self):
+        return {
+            'state': self.state,
+            'pid': self.pid,
+            'restarts': self.restarts,
+            'started_at': self.started_at,
+            'ready_seconds': self.ready_seconds,
+            'last_exit_code': self.last_exit_code,
+            'last_exit_at': self.last_exit_at,
+            'waiting_for': self.waiting_for,
+        }
+
+
+class ProcessSupervisor:
+    """Starts services in dependency order and restarts any that exit
+
+    The backoff before a restart doubles from `backoff_base` up to `backoff_max`, and
+    resets once a child has stayed up for `healthy_after` seconds.
+    """
+
+    def __init__(self, services, status_path=STATUS_PATH, poll_interval=0.05, backoff_base=1.0,
+                 backoff_max=60.0, healthy_after=60.0, stop_timeout=5.0):
+        self.services = {service.name: service for service in services}
+        self.status_path = status_path
+        self.poll_interval = poll_interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.healthy_after = healthy_after
+        self.stop_timeout = stop_timeout
+        self.started_at = time.time()
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def run(self):
+        tasks = [asyncio.create_task(self._supervise(service)) for service in self.services.values()]
+        self.write_status()
+        await self._stopping.wait()
+        logger.info("Stopping children")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Dependants first: the bot, then shairport-sync, then what it needs
+        for service in reversed(list(self.services.values())):
+            await self._terminate(service)
+        self.write_status()
+
+    async def _supervise(self, service):
+        while True:
+            service.state = 'waiting'
+            for name in service.requires:
+                dependency = self.services[name]
+                if not dependency.settled.is_set():
+                    service.waiting_for = name
+                    self.write_status()
+                    await dependency.settled.wait()
+            service.waiting_for = None
+
+            ran_for = await self._run_once(service)
+
+            service.settled.clear()
+            if ran_for >= self.healthy_after:
+                service.failures = 0
+            delay = min(self.backoff_max, self.backoff_base * (2 ** service.failures))
+            service.failures += 1
+            service.restarts += 1
+            service.state = 'backoff'
+            self.write_status()
+            logger.warning(f"{service.name} exited with code {service.last_exit_code} after {ran_for:.1f}s; "
+                           f"restarting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _run_once(self, service):
+        """Start the child, wait for it to get ready, then until it exits; returns how long it ran"""
+        if service.prepare:
+            try:
+                service.prepare()
+            except Exception as e:
+                logger.warning(f"Preparing {service.name} failed: {e}")
+
+        started = time.monotonic()
+        try:
+            service.process = await asyncio.create_subprocess_exec(
+                *service.argv,
+                stdout=asyncio.subprocess.PIPE if service.capture_output else None,
+                stderr=asyncio.subprocess.STDOUT if service.capture_output else None,
+                start_new_session=True,  # our SIGTERM handling decides when children stop
+            )
+        except OSError as e:
+            logger.error(f"Could not start {service.name}: {e}")
+            service.last_exit_code = None
+            service.last_exit_at = time.time()
+            return 0.0
+
+        service.pid = service.process.pid
+        service.started_at = time.time()
+        service.ready_seconds = None
+        service.state = 'starting'
+        logger.info(f"Started {service.name} (pid {service.pid})")
+        self.write_status()
+
+        output_task = asyncio.create_task(self._forward_output(service)) if service.capture_output else None
+        ready_task = asyncio.create_task(self._await_ready(service, started))
+        try:
+            await service.process.wait()
+            if output_task:
+                # Let the last lines through, unless a grandchild still holds the pipe
+                await asyncio.wait([output_task], timeout=1)
+        finally:
+            ready_task.cancel()
+            if output_task:
+                output_task.cancel()
+
+        service.last_exit_code = service.process.returncode
+        service.last_exit_at = time.time()
+        service.process = None
+        service.pid = None
+        service.waiting_for = None
+        return time.monotonic() - started
+
+    async def _await_ready(self, service, started):
+        deadline = started + service.ready_timeout
+        pending = list(service.ready)
+        while pending:
+            pending = [check for check in pending if not await check.check(service)]
+            if not pending:
+                break
+            service.waiting_for = pending[0].description
+            if time.monotonic() > deadline:
+                if service.required:
+                    logger.error(f"{service.name} not ready after {service.ready_timeout:g}s "
+                                 f"(waiting for {service.waiting_for}), restarting it")
+                    service.process.terminate()
+                    return
+                logger.warning(f"{service.name} not ready after {service.ready_timeout:g}s "
+                               f"(waiting for {service.waiting_for}), continuing without it")
+                service.state = 'unready'
+                service.settled.set()
+                self.write_status()
+                # Keep checking: it may still come up
+                deadline = float('inf')
+            await asyncio.sleep(self.poll_interval)
+
+        service.ready_seconds = time.monotonic() - started
+        service.waiting_for = None
+        service.state = 'ready'
+        service.settled.set()
+        logger.info(f"{service.name} ready after {service.ready_seconds:.2f}s")
+        self.write_status()
+
+    async def _forward_output(self, service):
+        while True:
+            line = await service.process.stdout.readline()
+            if not line:
+                return
+            logger.info(f"[{service.name}] {line.decode(errors='replace').rstrip()}")
+
+    async def _terminate(self, service):
+        process = service.process
+        if process is None or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=self.stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{service.name} did not stop, killing it")
+            process.kill()
+            await process.wait()
+        service.state = 'stopped'
+
+    def write_status(self):
+        status = {
+            'pid': os.getpid(),
+            'started_at': self.started_at,
+            'updated_at': time.time(),
+            'services': {name: service.status() for name, service in self.services.items()},
+        }
+        # Written to the side and renamed, so the bot never reads half a file
+        temporary = f"{self.status_path}.tmp"
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(status, f)
+            os.replace(temporary, self.status_path)
+        except OSError as e:
+            logger.warning(f"Could not write supervisor status to {self.status_path}: {e}")
+
+
+def read_status(path=STATUS_PATH):
+    """The supervisor's last status, or None when it isn't running (e.g. a native install)"""
+    try:
+        with open(path) as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.kill(status['pid'], 0)
+    except ProcessLookupError:
+        return None
+    except (PermissionError, KeyError, TypeError):
+        pass
+    return status
+
+
+def describe_status(status, now=None):
+    """One line per child for !debug"""
+    now = time.time() if now is None else now
+    lines = []
+    for name, child in status.get('services', {}).items():
+        state = child['state']
+        if state in ('ready', 'starting', 'unready') and child.get('started_at'):
+            state += f" pid {child['pid']}, up {_format_duration(now - child['started_at'])}"
+            if child.get('ready_seconds') is not None:
+                state += f", ready in {child['ready_seconds']:.1f}s"
+        if child.get('waiting_for'):
+            state += f", waiting for {child['waiting_for']}"
+        if child.get('restarts'):
+            state += f", {child['restarts']} restart(s), last exit code {child.get('last_exit_code')}"
+        lines.append(f"{name}: {state}")
+    return lines
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+
+def _make_fifo(path):
+    if not os.path.exists(path):
+        os.mkfifo(path)
+
+
+def _config_name(config_path, default='Bizzitybot'):
+    """The AirPlay name from shairport-sync.conf's general section"""
+    try:
+        with open(config_path) as f:
+            match = re.search(r'^\s*name\s*=\s*"([^"]+)"', f.read(), re.MULTILINE)
+    except OSError:
+        return default
+    return match.group(1) if match else default
+
+
+def receiver_services(receivers, config_path, ignore_volume=False):
+    """One shairport-sync per AirPlay receiver, each with its own generated config
+
+    ignore_volume: the bot's audio engine applies the AirPlay volume, so shairport-sync must not
+    """
+    if len(receivers) == 1 and receivers[0].port is None and not ignore_volume:
+        # A plain setup: run the shared config as it is
+        return [Service('shairport-sync', ['shairport-sync', '-c', config_path, '-v'], requires=['avahi', 'nqptp'],
+                        ready=[PortBound('tcp', 7000, 5000), MDNSRegistered('_raop._tcp', _config_name(config_path))],
+                        required=False)]
+
+    with open(config_path) as f:
+        template = f.read()
+    services = []
+    for receiver in receivers:
+        path = f"/tmp/shairport-sync-{receiver.name}.conf"
+        with open(path, 'w') as f:
+            f.write(shairport_config(template, receiver, ignore_volume=ignore_volume))
+        ports = (receiver.port,) if receiver.port is not None else (7000, 5000)
+        services.append(Service(
+            f"shairport-sync-{receiver.name}", ['shairport-sync', '-c', path, '-v'], requires=['avahi', 'nqptp'],
+            ready=[PortBound('tcp', *ports), MDNSRegistered('_raop._tcp', receiver.airplay_name)],
+            required=False
+        ))
+    return services
+
+
+def default_services(config_path='/etc/shairport-sync.conf', bot_dir=None, receivers=None, ignore_volume=False):
+    """The container's process tree, in start order"""
+    bot_dir = bot_dir or os.path.dirname(os.path.abspath(__file__))
+    receivers = receivers or load_receivers(None, '/tmp/shairport-sync-audio', '/tmp/shairport-sync-metadata')
+
+    def prepare_dbus():
+        os.makedirs('/run/dbus', exist_ok=True)
+        # A pid file left by a previous run makes dbus-daemon refuse to start
+        if os.path.exists('/run/dbus/pid'):
+            os.unlink('/run/dbus/pid')
+
+    def prepare_avahi():
+        for path in ('/var/run/avahi-daemon', '/var/lib/avahi-autoipd'):
+            os.makedirs(path, exist_ok=True)
+        if os.path.exists('/var/run/avahi-daemon/pid'):
+            os.unlink('/var/run/avahi-daemon/pid')
+
+    return [
+        Service('dbus', ['dbus-daemon', '--system', '--nofork', '--nopidfile'],
+                ready=[PathExists('/run/dbus/system_bus_socket', 'socket')], prepare=prepare_dbus),
+        # shairport-sync falls back to its built-in mDNS without avahi
+        Service('avahi', ['avahi-daemon', '--no-rlimits'], requires=['dbus'],
+                ready=[PathExists('/run/avahi-daemon/socket', 'socket')], required=False,
+                ready_timeout=10.0, prepare=prepare_avahi),
+        Service('nqptp', ['nqptp'], ready=[PortBound('udp', 319, 320)]),
+        *receiver_services(receivers, config_path, ignore_volume),
+        # The bot only needs the FIFOs, which exist before anything starts: it waits for
+        # shairport-sync on the pipes itself, so it logs in to Discord in parallel
+        Service('bot', [sys.executable, os.path.join(bot_dir, 'main.py')], capture_output=False),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--status-file', default=STATUS_PATH)
+    parser.add_argument('--config', default='/etc/shairport-sync.conf', help='shairport-sync config')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=TEXT_FORMAT)
+    # Same receivers as main.py: one shairport-sync and one pair of pipes each
+    receivers = load_receivers(os.getenv('RECEIVERS_CONFIG'),
+                               os.getenv('SHAIRPORT_PIPE_PATH', '/tmp/shairport-sync-audio'),
+                               os.getenv('SHAIRPORT_METADATA_PIPE_PATH', '/tmp/shairport-sync-metadata'),
+                               os.getenv('AIRPLAY_NAME', 'Bizzitybot'))
+    for receiver in receivers:
+        _make_fifo(receiver.audio_pipe)
+        _make_fifo(receiver.metadata_pipe)
+
+    async def run():
+        # The native and process engines apply the AirPlay volume themselves, with ramps
+        ignore_volume = os.getenv('AUDIO_ENGINE', 'ffmpeg').lower() in ('native', 'process')
+        supervisor = ProcessSupervisor(default_services(args.config, receivers=receivers, ignore_volume=ignore_volume),
+                                       status_path=args.status_file)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, supervisor.stop)
+        await supervisor.run()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
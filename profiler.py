@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import cProfile
+import collections
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the loop lag histogram buckets, in ms
+LAG_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+# Functions threads wait in; left out of the hot spots in the summary (not the full dump)
+IDLE_FUNCTIONS = {'select', 'poll', 'epoll', 'sleep', 'wait'}
+
+
+class ThreadSampler:
+    """Samples the Python stack of every thread that is on a CPU, at a fixed interval
+
+    The bot's work is spread over the event loop and threads (PCM reader, encoder,
+    voice players, executors, log writer), and cProfile only sees the thread it runs in.
+    A thread only counts when the kernel reports it running or runnable (Linux
+    /proc/self/task/<tid>/stat), so threads blocked in a wait don't bury the hot spots.
+    Per-thread CPU time comes from each thread's CPU clock. Stacks are folded into
+    'thread;outer;...;inner' keys with sample counts, the format flame graph tools read.
+    """
+
+    def __init__(self, interval=0.005, max_depth=48):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = collections.Counter()  # folded stack -> samples
+        self.frames = collections.Counter()  # (thread, innermost frame) -> samples
+        self.cpu = collections.Counter()  # thread name -> CPU seconds
+        self.samples = 0
+        self._clocks = {}  # thread ident -> (clock id, CPU time at the first sample)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    @staticmethod
+    def _on_cpu(native_id):
+        try:
+            with open(f'/proc/self/task/{native_id}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            # Not Linux, or the thread just ended: count it rather than lose the sample
+            return True
+        return stat[stat.rindex(b')') + 2:stat.rindex(b')') + 3] == b'R'
+
+    def _track_cpu(self, thread):
+        try:
+            if thread.ident not in self._clocks:
+                clock = time.pthread_getcpuclockid(thread.ident)
+                self._clocks[thread.ident] = (clock, time.clock_gettime(clock))
+            clock, first = self._clocks[thread.ident]
+            self.cpu[thread.name] = time.clock_gettime(clock) - first
+        except (OSError, AttributeError):
+            pass  # The thread ended, or the platform has no thread CPU clocks
+
+    def _run(self):
+        me = threading.get_ident()
+        # Jittered, so samples don't line up with the 5 and 20 ms timers of the threads being sampled
+        while not self._stop_event.wait(self.interval * random.uniform(0.5, 1.5)):
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident == me or thread is None:
+                    continue
+                self._track_cpu(thread)
+                if not self._on_cpu(thread.native_id):
+                    continue
+                frames = []
+                while frame is not None and len(frames) < self.max_depth:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join([thread.name] + frames[::-1])] += 1
+                self.frames[(thread.name, frames[0])] += 1
+            self.samples += 1
+
+    def hot_spots(self, limit):
+        """[((thread, frame), samples)] for the innermost frames seen on a CPU most often
+
+        A thread that has just been woken is runnable while its frame still shows the
+        wait, so frames of IDLE_FUNCTIONS are skipped.
+        """
+        busy = [(key, count) for key, count in self.frames.most_common()
+                if key[1].split(' ', 1)[0] not in IDLE_FUNCTIONS]
+        return busy[:limit]
+
+
+class LoopLagSampler:
+    """Times a short sleep on the event loop over and over; the overshoot is the scheduling lag"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        try:
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(self.interval)
+                self.lags.append(max(0.0, time.perf_counter() - started - self.interval))
+        except asyncio.CancelledError:
+            pass
+
+    def histogram(self):
+        """[(bucket upper bound in ms or None for the rest, count)]"""
+        counts = [0] * (len(LAG_BUCKETS_MS) + 1)
+        for lag in self.lags:
+            counts[bisect.bisect_left(LAG_BUCKETS_MS, lag * 1000)] += 1
+        return list(zip(list(LAG_BUCKETS_MS) + [None], counts))
+
+    def percentile(self, point):
+        if not self.lags:
+            return 0.0
+        ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(round(point / 100 * (len(ordered) - 1))))]
+
+
+class ProfileRun:
+    """One !profile capture: cProfile of the event loop, stack samples of every thread,
+    a tracemalloc diff and the loop lag, all while the bot keeps running
+
+    run() must be awaited on the event loop, because cProfile only profiles the thread that
+    enables it. The full results go to a directory under `directory`; summary() is short
+    enough for a chat message.
+    """
+
+    def __init__(self, seconds, directory, sample_interval=0.005, trace_frames=10):
+        self.seconds = seconds
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.trace_frames = trace_frames
+        self.profile = cProfile.Profile()
+        self.sampler = ThreadSampler(sample_interval)
+        self.lag = LoopLagSampler()
+        self.allocations = []
+        self.cpu_seconds = 0.0
+        self.path = None
+
+    async def run(self):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(self.trace_frames)
+        before = tracemalloc.take_snapshot()
+        cpu = time.process_time()
+        self.sampler.start()
+        self.lag.start()
+        self.profile.enable()
+        try:
+            await asyncio.sleep(self.seconds)
+        finally:
+            self.profile.disable()
+            self.lag.stop()
+            self.sampler.stop()
+            self.cpu_seconds = time.process_time() - cpu
+            after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+        # The profiler's own bookkeeping isn't what we're looking for
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        self.allocations = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'lineno')
+        self.path = await asyncio.get_running_loop().run_in_executor(None, self.write)
+        return self.path
+
+    def write(self):
+        """Write the full dump; blocks, so run it in an executor"""
+        path = os.path.join(self.directory, time.strftime('profile-%Y%m%d-%H%M%S'))
+        os.makedirs(path, exist_ok=True)
+        self.profile.dump_stats(os.path.join(path, 'event_loop.pstats'))
+        with open(os.path.join(path, 'event_loop.txt'), 'w') as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats()
+            stats.sort_stats('tottime').print_stats(100)
+        with open(os.path.join(path, 'threads.folded'), 'w') as f:
+            for stack, count in self.sampler.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(os.path.join(path, 'allocations.txt'), 'w') as f:
+            for stat in self.allocations[:200]:
+                f.write(f"{stat}\n")
+        with open(os.path.join(path, 'loop_lag.txt'), 'w') as f:
+            f.write(f"{len(self.lag.lags)} samples every {self.lag.interval * 1000:.0f} ms\n")
+            for bound, count in self.lag.histogram():
+                f.write(f"<= {bound} ms: {count}\n" if bound else f"> {LAG_BUCKETS_MS[-1]} ms: {count}\n")
+        logger.info(f"Profile written to {path}")
+        return path
+
+    def summary(self, limit=5):
+        lines = [f"{self.seconds} s, {self.cpu_seconds:.2f} s CPU ({self.cpu_seconds / self.seconds:.0%}), "
+                 f"{self.sampler.samples} stack samples"]
+
+        lines.append("Event loop, most time in:")
+        stats = pstats.Stats(self.profile)
+        entries = sorted(((key, value) for key, value in stats.stats.items() if not _is_idle(key)),
+                         key=lambda item: -item[1][2])  # by own time
+        for (filename, line, name), (_, calls, own, total, _) in entries[:limit]:
+            lines.append(f"  {own * 1000:7.1f} ms  {name} ({os.path.basename(filename)}:{line}), {calls} calls")
+
+        lines.append("Threads by CPU: " + ", ".join(f"{thread} {cpu / self.seconds:.0%}"
+                                                    for thread, cpu in self.sampler.cpu.most_common(limit)))
+        lines.append("All threads, on CPU in:")
+        for (thread, frame), count in self.sampler.hot_spots(limit):
+            lines.append(f"  {count:5d}  {thread}: {frame}")
+
+        lines.append("Memory, top growth:")
+        for stat in self.allocations[:3]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size_diff / 1024:+8.1f} KiB  {os.path.basename(frame.filename)}:{frame.lineno} "
+                         f"({stat.count_diff:+d} blocks)")
+
+        lag = self.lag
+        lines.append(f"Loop lag: p50 {lag.percentile(50) * 1000:.1f} ms, p99 {lag.percentile(99) * 1000:.1f} ms, "
+                     f"max {max(lag.lags, default=0) * 1000:.1f} ms")
+        lines.append("  " + ", ".join(f"<={bound}ms: {count}" if bound else f">{LAG_BUCKETS_MS[-1]}ms: {count}"
+                                      for bound, count in lag.histogram() if count))
+        return "\n".join(line[:150] for line in lines)
+
+
+def _is_idle(key):
+    """True for a pstats entry of a builtin the event loop blocks in, like epoll.poll"""
+    filename, _, name = key
+    if filename != '~':
+        return False
+    # Builtins are named like "<method 'poll' of 'select.epoll' objects>" or "<built-in method time.sleep>"
+    words = name.replace("'", ' ').replace('.', ' ').replace('>', ' ').split()
+    return any(word in IDLE_FUNCTIONS for word in words[:3])
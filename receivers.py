@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# shairport-sync's AirPlay 2 port, and the block of UDP ports each instance uses for audio
+BASE_PORT = 7000
+BASE_UDP_PORT = 6001
+UDP_PORT_RANGE = 10
+
+
+class ReceiverConfig:
+    """One AirPlay target: a shairport-sync instance with its own pipes, and where it streams to
+
+    guilds / voice_channels: ids routed to this receiver by !join
+    cpus: cores for this receiver's reader and encoder threads (None = no pinning)
+    port / udp_port_base / device_id_offset: None keeps shairport-sync.conf's settings
+    """
+
+    def __init__(self, name, airplay_name, audio_pipe, metadata_pipe, port=None, udp_port_base=None,
+                 device_id_offset=None, guilds=(), voice_channels=(), cpus=None, default=False):
+        self.name = name
+        self.airplay_name = airplay_name
+        self.audio_pipe = audio_pipe
+        self.metadata_pipe = metadata_pipe
+        self.port = port
+        self.udp_port_base = udp_port_base
+        self.device_id_offset = device_id_offset
+        self.guilds = {int(g) for g in guilds}
+        self.voice_channels = {int(c) for c in voice_channels}
+        self.cpus = set(cpus) if cpus else None
+        self.default = default
+
+    def __repr__(self):
+        return f"ReceiverConfig({self.name!r}, airplay_name={self.airplay_name!r})"
+
+
+def load_receivers(path, audio_pipe, metadata_pipe, airplay_name='Bizzitybot'):
+    """Receivers from the JSON file at `path`, or the single receiver of a plain setup
+
+    The file holds {"receivers": [{"name": "lounge", "guilds": [...]}, ...]}. Anything a
+    receiver leaves out is derived from its name and position: the AirPlay name, pipe
+    paths, ports and device id offset, so that the instances don't collide.
+    """
+    if not path or not os.path.exists(path):
+        if path:
+            logger.warning(f"Receiver config {path} not found, using a single receiver")
+        return [ReceiverConfig('default', airplay_name, audio_pipe, metadata_pipe, default=True)]
+
+    with open(path) as f:
+        entries = json.load(f).get('receivers', [])
+    if not entries:
+        raise ValueError(f"{path} lists no receivers")
+
+    receivers = []
+    for index, entry in enumerate(entries):
+        name = entry['name']
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+            raise ValueError(f"Receiver name {name!r} may only use letters, digits, '-' and '_'")
+        receivers.append(ReceiverConfig(
+            name,
+            entry.get('airplay_name', f"{airplay_name}-{name}"),
+            entry.get('audio_pipe', f"/tmp/shairport-sync-{name}-audio"),
+            entry.get('metadata_pipe', f"/tmp/shairport-sync-{name}-metadata"),
+            port=entry.get('port', BASE_PORT + index * UDP_PORT_RANGE),
+            udp_port_base=entry.get('udp_port_base', BASE_UDP_PORT + index * UDP_PORT_RANGE),
+            device_id_offset=entry.get('device_id_offset', index),
+            guilds=entry.get('guilds', ()),
+            voice_channels=entry.get('voice_channels', ()),
+            cpus=entry.get('cpus'),
+            default=entry.get('default', False),
+        ))
+
+    names = [r.name for r in receivers]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate receiver names in {path}")
+    if not any(r.default for r in receivers):
+        receivers[0].default = True
+    assign_cpus(receivers)
+    return receivers
+
+
+def assign_cpus(receivers, available=None):
+    """Give receivers without explicit `cpus` disjoint sets of cores, round-robin
+
+    Each receiver's reader and encoder threads then run on their own cores instead of
+    competing with the other receivers. With fewer cores than receivers, nothing is pinned.
+    """
+    unpinned = [r for r in receivers if r.cpus is None]
+    if len(receivers) < 2 or not unpinned or not hasattr(os, 'sched_getaffinity'):
+        return
+    cores = sorted((available or os.sched_getaffinity(0)) - set().union(*(r.cpus or set() for r in receivers)))
+    if len(cores) < len(unpinned):
+        return
+    for index, receiver in enumerate(unpinned):
+        receiver.cpus = set(cores[index::len(unpinned)])
+
+
+def _set_option(text, section, key, value):
+    """Set `key = value;` inside `section = { ... };` of a libconfig file, adding it if missing"""
+    block = re.search(rf'(^\s*{section}\s*=\s*\{{)(.*?)(^\s*\}};)', text, re.MULTILINE | re.DOTALL)
+    rendered = f'"{value}"' if isinstance(value, str) else str(value)
+    if block is None:
+        return text + f"\n{section} = {{\n    {key} = {rendered};\n}};\n"
+    body = block.group(2)
+    pattern = rf'^(\s*){key}\s*=\s*[^;]*;'
+    if re.search(pattern, body, re.MULTILINE):
+        body = re.sub(pattern, lambda m: f"{m.group(1)}{key} = {rendered};", body, count=1, flags=re.MULTILINE)
+    else:
+        body = body.rstrip('\n') + f"\n    {key} = {rendered};\n"
+    return text[:block.start(2)] + body + text[block.end(2):]
+
+
+def shairport_config(template, receiver, ignore_volume=False):
+    """shairport-sync.conf text for one receiver, based on the shared config
+
+    ignore_volume: the bot applies the AirPlay volume itself, so shairport-sync writes full-scale PCM
+    """
+    text = _set_option(template, 'general', 'name', receiver.airplay_name)
+    if receiver.port is not None:
+        text = _set_option(text, 'general', 'port', receiver.port)
+    if receiver.udp_port_base is not None:
+        text = _set_option(text, 'general', 'udp_port_base', receiver.udp_port_base)
+        text = _set_option(text, 'general', 'udp_port_range', UDP_PORT_RANGE)
+    if receiver.device_id_offset is not None:
+        # Each AirPlay 2 instance on a host needs its own device id
+        text = _set_option(text, 'general', 'airplay_device_id_offset', receiver.device_id_offset)
+    if ignore_volume:
+        text = _set_option(text, 'general', 'ignore_volume_control', 'yes')
+    text = _set_option(text, 'pipe', 'name', receiver.audio_pipe)
+    text = _set_option(text, 'metadata', 'pipe_name', receiver.metadata_pipe)
+    return text
@@ -0,0 +1,274 @@
+import logging
+import os
+import select
+import threading
+import time
+import traceback
+
+from metrics import PCM_BYTES_READ, FIFO_READ_LATENCY
+
+logger = logging.getLogger(__name__)
+
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread to `cpus` (Linux); other threads keep their affinity"""
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning(f"Could not pin {threading.current_thread().name} to CPUs {sorted(cpus)}: {e}")
+
+
+class PCMRingBuffer:
+    """Preallocated, fixed-size byte ring used as a jitter buffer for raw PCM
+
+    One writer thread fills it with readinto() straight into the free region and one
+    consumer drains whole frames into a caller-owned buffer, so nothing is allocated
+    per frame. Positions are absolute byte counts; the buffer offset is pos % capacity.
+    """
+
+    def __init__(self, capacity, frame_bytes, target_depth):
+        if target_depth > capacity:
+            raise ValueError("target depth cannot exceed the buffer capacity")
+        # Keep capacity a whole number of frames so dropping frames keeps sample alignment
+        capacity -= capacity % frame_bytes
+        self.capacity = capacity
+        self.frame_bytes = frame_bytes
+        self.target_depth = target_depth
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._read_pos = 0
+        self._write_pos = 0
+        self._lock = threading.Lock()
+        # Wait for target_depth bytes before draining, and again after every underrun
+        self._priming = True
+        # Absolute position of the first byte of the frame most recently drained
+        self.last_read_pos = 0
+
+        self.bytes_written = 0
+        self.frames_read = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.trimmed = 0
+
+    def fill(self):
+        """Bytes currently buffered"""
+        return self._write_pos - self._read_pos
+
+    def fill_ms(self, bytes_per_second):
+        return self.fill() * 1000 / bytes_per_second
+
+    def reset(self):
+        with self._lock:
+            self._read_pos = self._write_pos
+            self._priming = True
+
+    def trim(self, max_fill):
+        """Drop the oldest whole frames until at most `max_fill` bytes are buffered; returns bytes dropped"""
+        with self._lock:
+            excess = self._write_pos - self._read_pos - max_fill
+            if excess <= 0:
+                return 0
+            excess += -excess % self.frame_bytes
+            self._read_pos += excess
+            self.trimmed += excess
+            return excess
+
+    def write_view(self, max_bytes=65536):
+        """Return a writable memoryview over the next contiguous free region
+
+        If the buffer is full the oldest frame is dropped (an overrun) so a stalled
+        consumer can't hold latency up forever.
+        """
+        with self._lock:
+            if self._write_pos - self._read_pos >= self.capacity:
+                self._read_pos += self.frame_bytes
+                self.overruns += 1
+            free = self.capacity - (self._write_pos - self._read_pos)
+            start = self._write_pos % self.capacity
+            length = min(free, self.capacity - start, max_bytes)
+        return self._view[start:start + length]
+
+    def commit_write(self, count):
+        """Mark `count` bytes written into the last write_view(); returns the new write position"""
+        with self._lock:
+            self._write_pos += count
+            self.bytes_written += count
+            return self._write_pos
+
+    def read_into(self, out):
+        """Copy one frame into `out` (a writable memoryview); False on underrun or while priming"""
+        size = len(out)
+        with self._lock:
+            available = self._write_pos - self._read_pos
+            if self._priming:
+                if available < max(self.target_depth, size):
+                    return False
+                self._priming = False
+            if available < size:
+                self.underruns += 1
+                self._priming = True
+                return False
+
+            start = self._read_pos % self.capacity
+            first = min(size, self.capacity - start)
+            out[:first] = self._view[start:start + first]
+            if first < size:
+                out[first:size] = self._view[:size - first]
+            self.last_read_pos = self._read_pos
+            self._read_pos += size
+            self.frames_read += 1
+        return True
+
+
+class FIFOReader:
+    """Dedicated thread that moves bytes from a named pipe into a PCMRingBuffer
+
+    cpus: optional set of cores the thread is pinned to; name: suffix for the thread name
+    """
+
+    def __init__(self, path, ring, chunk_bytes=16384, latency=None, cpus=None, name=None):
+        self.path = path
+        self.ring = ring
+        self.chunk_bytes = chunk_bytes
+        self.latency = latency
+        self.cpus = cpus
+        self.thread_name = f"fifo-reader-{name}" if name else 'fifo-reader'
+        self.eof_count = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop_event,),
+                                        name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=0.5):
+        """Stop the reader and wait briefly for it so two readers never share the ring"""
+        self._stop_event.set()
+        self._wake()
+        thread = self._thread
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout)
+        if not (thread and thread.is_alive()):
+            self._thread = None
+
+    def _wake(self):
+        # A reader blocked in open() waits for a writer; briefly becoming one lets it
+        # see EOF and notice the stop flag instead of lingering until shairport returns
+        try:
+            os.close(os.open(self.path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            pass
+
+    def _run(self, stop_event):
+        pin_current_thread(self.cpus)
+        while not stop_event.is_set():
+            try:
+                # Blocks until shairport-sync opens the pipe for writing
+                with open(self.path, 'rb', buffering=0) as pipe:
+                    logger.info(f"PCM pipe {self.path} opened")
+                    poller = select.poll()
+                    poller.register(pipe.fileno(), select.POLLIN)
+                    while not stop_event.is_set():
+                        # Wait in short slices so stop() is noticed even if the writer goes quiet
+                        if not poller.poll(100):
+                            continue
+                        view = self.ring.write_view(self.chunk_bytes)
+                        started = time.perf_counter()
+                        count = pipe.readinto(view)
+                        read_at = time.perf_counter()
+                        view.release()
+                        if not count:
+                            # Writer went away; keep the buffer and wait for the next one
+                            self.eof_count += 1
+                            logger.info(f"PCM pipe {self.path} reached EOF, reopening")
+                            break
+                        end_pos = self.ring.commit_write(count)
+                        PCM_BYTES_READ.inc(count)
+                        FIFO_READ_LATENCY.observe(read_at - started)
+                        if self.latency is not None:
+                            self.latency.mark_read(end_pos, read_at)
+            except FileNotFoundError:
+                logger.warning(f"PCM pipe {self.path} does not exist, waiting...")
+                time.sleep(1)
+            except Exception as e:
+                logger.error(f"FIFO reader error: {e}")
+                logger.error(traceback.format_exc())
+                time.sleep(1)
+
+
+class FIFOHolder:
+    """Keeps both ends of a named pipe open in the bot so its readers never see EOF
+
+    A FIFO reports EOF once its last writer closes, which happens whenever an AirPlay
+    client disconnects and shairport-sync closes the pipe. Holding a write end means the
+    pipe always has a writer; the real reader (FIFOReader, FFmpeg or the audio worker)
+    simply waits for the next session's audio. The read end is opened first, non-blocking,
+    so opening the write end never blocks, and it keeps shairport-sync from getting EPIPE
+    while a reader restarts. Nothing is ever written; the read end only discards audio that
+    piled up while no reader was running (drain()).
+    """
+
+    def __init__(self, path, scratch_bytes=65536, scratch_count=4):
+        self.path = path
+        self.drained_bytes = 0
+        self._read_fd = None
+        self._write_fd = None
+        # A pipe holds 64 KiB by default; one readv() call empties it into these
+        self._scratch = [bytearray(scratch_bytes) for _ in range(scratch_count)]
+
+    def is_open(self):
+        return self._write_fd is not None
+
+    def open(self):
+        """Open both ends unless they are open already; False if the pipe isn't there"""
+        if self.is_open():
+            return True
+        try:
+            self._read_fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            self._write_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            logger.warning(f"Could not hold PCM pipe {self.path} open: {e}")
+            self.close()
+            return False
+        logger.info(f"Holding PCM pipe {self.path} open")
+        return True
+
+    def drain(self):
+        """Discard whatever is queued in the pipe; returns the number of bytes dropped"""
+        if self._read_fd is None:
+            return 0
+        dropped = 0
+        while True:
+            try:
+                count = os.readv(self._read_fd, self._scratch)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.warning(f"Could not drain PCM pipe {self.path}: {e}")
+                break
+            dropped += count
+            if count < sum(len(buffer) for buffer in self._scratch):
+                break
+        if dropped:
+            self.drained_bytes += dropped
+            logger.info(f"Dropped {dropped} stale bytes from PCM pipe {self.path}")
+        return dropped
+
+    def close(self):
+        for fd in (self._write_fd, self._read_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._read_fd = None
+        self._write_fd = None
@@ -0,0 +1,181 @@
+import asyncio
+import collections
+import logging
+import time
+import traceback
+
+from logging_config import RateLimitedLogger
+from metrics import PIPELINE_RESTARTS
+
+logger = logging.getLogger(__name__)
+log_throttled = RateLimitedLogger(logger)
+
+
+class Stage:
+    """One supervised part of the pipeline
+
+    progress: returns a counter that moves while the stage works (bytes, frames)
+    restart: coroutine function that restarts just this stage
+    alive: optional, returns False if the stage's worker is gone (None = unknown)
+    expected: optional, returns False while the stage is legitimately idle
+    """
+
+    def __init__(self, name, progress, restart, alive=None, expected=None):
+        self.name = name
+        self.progress = progress
+        self.restart = restart
+        self.alive = alive
+        self.expected = expected
+        self.last_value = None
+        self.last_change = time.monotonic()
+        self.failures = 0  # consecutive, drives the backoff
+        self.last_restart = 0.0
+        self.restart_times = collections.deque()
+        self.breaker_open_until = 0.0
+        self.restarting = False
+
+
+class StreamSupervisor:
+    """Watches stage throughput every `interval` and restarts only the stage that failed
+
+    A stage that makes no progress for `stall_seconds` while it is expected to, whose
+    worker has died, or that reports a failure event is restarted after an exponential
+    backoff. More than `breaker_threshold` restarts inside `breaker_window` opens the
+    stage's circuit breaker: no automatic restarts until `breaker_cooldown` has passed.
+    """
+
+    def __init__(self, stall_seconds=1.0, interval=0.25, backoff_base=0.5, backoff_max=30.0,
+                 healthy_after=10.0, breaker_threshold=5, breaker_window=60.0, breaker_cooldown=120.0,
+                 on_breaker_open=None):
+        self.stall_seconds = stall_seconds
+        self.interval = interval
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.healthy_after = healthy_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_window = breaker_window
+        self.breaker_cooldown = breaker_cooldown
+        self.on_breaker_open = on_breaker_open
+        self.stages = {}
+        self.history = collections.deque(maxlen=50)  # (wall time, stage, reason, backoff)
+        self.restarts = 0
+        self._task = None
+
+    def add_stage(self, stage):
+        self.stages[stage.name] = stage
+
+    def remove_stage(self, name):
+        self.stages.pop(name, None)
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.is_running():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self, name=None):
+        """Clear backoff and close breakers (e.g. after a manual !restart)"""
+        for stage in self.stages.values():
+            if name is None or stage.name == name:
+                stage.failures = 0
+                stage.restart_times.clear()
+                stage.breaker_open_until = 0.0
+
+    def report_failure(self, name, reason):
+        """Event from a stage (e.g. the source ended with an error): restart without waiting for a stall"""
+        stage = self.stages.get(name)
+        if stage:
+            self._schedule_restart(stage, reason, time.monotonic())
+
+    def breaker_open(self, name):
+        stage = self.stages.get(name)
+        return bool(stage and stage.breaker_open_until > time.monotonic())
+
+    async def _run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                for stage in list(self.stages.values()):
+                    try:
+                        self._check(stage, now)
+                    except Exception as e:
+                        log_throttled.error(f"Health check for {stage.name} failed: {e}", key=stage.name)
+        except asyncio.CancelledError:
+            pass
+
+    def _check(self, stage, now):
+        value = stage.progress()
+        if value != stage.last_value:
+            stage.last_value = value
+            stage.last_change = now
+            if stage.failures and now - stage.last_restart > self.healthy_after:
+                stage.failures = 0
+
+        if stage.restarting:
+            return
+
+        if stage.alive is not None and stage.alive() is False:
+            self._schedule_restart(stage, "worker stopped", now)
+            return
+
+        if stage.expected is not None and not stage.expected():
+            # Idle is fine; start the stall clock fresh when work is expected again
+            stage.last_change = now
+            return
+
+        stalled_for = now - stage.last_change
+        if stalled_for > self.stall_seconds:
+            self._schedule_restart(stage, f"no progress for {stalled_for:.1f}s", now)
+
+    def _schedule_restart(self, stage, reason, now):
+        if stage.restarting or stage.breaker_open_until > now:
+            return
+
+        while stage.restart_times and now - stage.restart_times[0] > self.breaker_window:
+            stage.restart_times.popleft()
+        if len(stage.restart_times) >= self.breaker_threshold:
+            stage.breaker_open_until = now + self.breaker_cooldown
+            self.history.append((time.time(), stage.name, f"circuit breaker open after: {reason}", None))
+            logger.error(f"{stage.name}: {len(stage.restart_times)} restarts in {self.breaker_window:.0f}s, "
+                         f"pausing automatic restarts for {self.breaker_cooldown:.0f}s")
+            if self.on_breaker_open:
+                self.on_breaker_open(stage.name, reason)
+            return
+
+        delay = min(self.backoff_max, self.backoff_base * (2 ** stage.failures))
+        stage.failures += 1
+        stage.restarting = True
+        stage.restart_times.append(now)
+        self.history.append((time.time(), stage.name, reason, delay))
+        logger.warning(f"{stage.name}: {reason}; restarting in {delay:.1f}s")
+        asyncio.create_task(self._restart(stage, delay))
+
+    async def _restart(self, stage, delay):
+        try:
+            await asyncio.sleep(delay)
+            if self.stages.get(stage.name) is not stage:
+                return  # Removed while we waited
+            self.restarts += 1
+            # Per-guild voice stages share one series
+            PIPELINE_RESTARTS.labels(stage.name.split(':', 1)[0]).inc()
+            await stage.restart()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Restarting {stage.name} failed: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            stage.restarting = False
+            stage.last_restart = time.monotonic()
+            stage.last_change = stage.last_restart
+            try:
+                stage.last_value = stage.progress()
+            except Exception:
+                stage.last_value = None